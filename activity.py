@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+# Время последней траты каждого пользователя ("" -- трат еще не было).
+# Обновляется при сохранении траты, поэтому напоминание выбирает получателей
+# без чтения листов. Снимок хранится в JSON и при отсутствии пересобирается
+# из хранилища (Repository.last_expense_dates).
+class ActivityIndex:
+    def __init__(self, path: str = "activity.json"):
+        self.path = path
+        self._last = {}  # user_id -> "%Y-%m-%d %H:%M:%S" или ""
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._last)
+
+    def load(self) -> bool:
+        # Возвращает False, если снимка нет или он поврежден
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._last = json.load(f)
+        except ValueError as e:
+            logger.error(f"Не удалось прочитать {self.path}: {e}")
+            return False
+        logger.info(f"Загружена активность {len(self._last)} пользователей")
+        return True
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._last, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def replace(self, dates: dict):
+        # Новые траты, записанные во время пересборки, не теряем
+        for user_id, date in self._last.items():
+            if date > dates.get(user_id, ""):
+                dates[user_id] = date
+        self._last = dates
+        self._dirty = True
+
+    def touch(self, user_id, date: str = ""):
+        user_id = str(user_id)
+        last = self._last.get(user_id)
+        if last is None or date > last:
+            self._last[user_id] = date
+            self._dirty = True
+
+    def last_expense(self, user_id):
+        return self._last.get(str(user_id))
+
+    def users(self):
+        return [int(user_id) for user_id in self._last]
+
+    def is_inactive(self, user_id, day: str) -> bool:
+        return self._last.get(str(user_id), "")[:10] < day
+
+    def inactive_on(self, day: str):
+        # Пользователи без трат за день day ("%Y-%m-%d") и позже
+        return [int(user_id) for user_id, last in self._last.items() if last[:10] < day]
@@ -0,0 +1,98 @@
+import logging
+from datetime import date
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMPTY_DAYS = np.array([], dtype="datetime64[D]")
+
+
+# Траты в колоночном виде: дни (datetime64[D]), суммы (float64) и коды категорий
+# (int32, индексы в categories). Суммы по категориям, дням и месяцам считаются
+# одним np.bincount по маске периода, поэтому отчет за год по многолетней истории
+# стоит столько же, сколько отчет за неделю.
+class ExpenseFrame:
+    __slots__ = ("days", "amounts", "codes", "categories")
+
+    def __init__(self, days=EMPTY_DAYS, amounts=None, codes=None, categories=None):
+        self.days = days
+        self.amounts = amounts if amounts is not None else np.zeros(0, dtype=np.float64)
+        self.codes = codes if codes is not None else np.zeros(0, dtype=np.int32)
+        self.categories = categories if categories is not None else np.array([], dtype=object)
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    def from_rows(cls, rows):
+        # rows -- итерируемое из (дата "ГГГГ-ММ-ДД[ ...]", категория, сумма); битые строки пропускаются
+        days, categories, amounts = [], [], []
+        for day, category, amount in rows:
+            day = str(day)[:10]
+            try:
+                amount = float(amount)
+                np.datetime64(day, "D")
+            except ValueError:
+                logger.warning(f"Пропущена трата с датой {day!r} и суммой {amount!r}")
+                continue
+            days.append(day)
+            categories.append(str(category))
+            amounts.append(amount)
+        if not days:
+            return cls()
+
+        labels, codes = np.unique(np.array(categories, dtype=object), return_inverse=True)
+        return cls(
+            np.array(days, dtype="datetime64[D]"),
+            np.array(amounts, dtype=np.float64),
+            codes.astype(np.int32).ravel(),
+            labels
+        )
+
+    @classmethod
+    def concat(cls, frames):
+        # Склейка кадров нескольких листов (личного и семейного) с общим справочником категорий
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return cls()
+        if len(frames) == 1:
+            return frames[0]
+        labels = np.unique(np.concatenate([frame.categories for frame in frames]))
+        return cls(
+            np.concatenate([frame.days for frame in frames]),
+            np.concatenate([frame.amounts for frame in frames]),
+            np.concatenate([
+                np.searchsorted(labels, frame.categories).astype(np.int32)[frame.codes] for frame in frames
+            ]),
+            labels
+        )
+
+    def first_day(self):
+        return self.days.min().astype(date) if len(self) else None
+
+    def _mask(self, start_date, end_date):
+        return (self.days >= np.datetime64(start_date, "D")) & (self.days <= np.datetime64(end_date, "D"))
+
+    def category_totals(self, start_date, end_date):
+        mask = self._mask(start_date, end_date)
+        totals = np.bincount(self.codes[mask], weights=self.amounts[mask], minlength=len(self.categories))
+        return {
+            self.categories[code]: float(totals[code])
+            for code in np.flatnonzero(np.abs(totals) > 1e-9)
+        }
+
+    def total(self, start_date, end_date) -> float:
+        return float(self.amounts[self._mask(start_date, end_date)].sum())
+
+    def breakdown(self, start_date, end_date, unit: str = "D"):
+        # Суммы по дням (unit="D") или месяцам ("M") периода: [(первый день, сумма)],
+        # периоды без трат пропускаются
+        mask = self._mask(start_date, end_date)
+        first = np.datetime64(start_date, unit)
+        slots = (self.days[mask].astype(f"datetime64[{unit}]") - first).astype(np.int64)
+        size = int((np.datetime64(end_date, unit) - first).astype(np.int64)) + 1
+        totals = np.bincount(slots, weights=self.amounts[mask], minlength=size)
+        return [
+            ((first + slot).astype("datetime64[D]").astype(date), float(totals[slot]))
+            for slot in np.flatnonzero(np.abs(totals) > 1e-9)
+        ]
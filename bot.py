@@ -15,41 +15,127 @@ from oauth2client.service_account import ServiceAccountCredentials
 import asyncio
 import random
 import string
-from config import Config
 from typing import Union
+import sys
 import uuid
 import pytz
-from collections import defaultdict
+import signal
+import time
+from functools import partial
+from repository import Repository, SheetsRepository, Expense, DATE_FORMAT
+from sqlite_repository import SQLiteRepository
+from sheets import background_priority
+from metrics import registry as metrics, serve_metrics
+from activity import ActivityIndex
+from broadcast import Broadcaster
+from reminders import ReminderScheduler
+from fsm_storage import SQLiteStorage
+from drafts import DRAFT_KEY, DraftSweeper, ExpenseDraft
+from webhook import run_webhook, serve_webhook, wait_for_stop_signal
+from sharding import ShardSupervisor, UserSerialFeeder, create_front_app, poll_updates, shard_of, update_user_id
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler("bot.log"),  # Логи записываются в файл bot.log
-        logging.StreamHandler()  # Логи выводятся в консоль
-    ]
-)
 logger = logging.getLogger(__name__)
 
 # Настройки
 GOOGLE_SHEETS_CREDS = 'creds.json'  # Путь к JSON-ключу
 
-# Подключение к Google Sheets
-scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDS, scope)
-client = gspread.authorize(creds)
-spreadsheet = client.open_by_url(Config.SPREADSHEET_URL)
+# Объекты приложения создаются в create_app(), а не при импорте модуля:
+# импорт не читает ключи, не ходит в сеть и не требует config.py
+Config = None
+bot: Bot = None
+repo: Repository = None
+activity: ActivityIndex = None  # Время последней траты каждого пользователя
+broadcaster: Broadcaster = None  # Рассылки напоминаний с учетом лимитов Telegram
+reminders: ReminderScheduler = None  # Очередь напоминаний по пользователям
+drafts: DraftSweeper = None  # Очистка брошенных черновиков трат
+shard = None  # (номер рабочего процесса, число процессов) при запуске с Config.WORKERS > 1
 
-# Инициализация бота
-bot = Bot(
-    token=Config.BOT_TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)  # Указываем parse_mode здесь
-)
 dp = Dispatcher(storage=MemoryStorage())
 
-# Словарь для хранения временных данных пользователя
-user_data = {}
+# Устанавливается, когда хранилище прогрето (см. warm_up)
+app_ready = asyncio.Event()
+
+# Настройка логирования
+def setup_logging():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[
+            logging.FileHandler("bot.log"),  # Логи записываются в файл bot.log
+            logging.StreamHandler()  # Логи выводятся в консоль
+        ]
+    )
+
+def load_config():
+    from config import Config
+    return Config
+
+# Подключение к Google Sheets. Вызывается хранилищем при старте в пуле потоков
+def open_spreadsheet(settings):
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_SHEETS_CREDS, scope)
+    client = gspread.authorize(creds)
+    return client.open_by_url(settings.SPREADSHEET_URL)
+
+# Хранилище данных: Google Sheets или локальная SQLite с зеркалом в таблицу
+# (выбирается через Config.STORAGE_BACKEND = "sheets" | "sqlite")
+def create_sheets_repository(settings) -> SheetsRepository:
+    return SheetsRepository(
+        open_spreadsheet=partial(open_spreadsheet, settings),
+        max_workers=getattr(settings, "SHEETS_WORKERS", 4),
+        journal_path=getattr(settings, "WRITE_JOURNAL_PATH", "pending_rows.jsonl"),
+        flush_interval=getattr(settings, "WRITE_FLUSH_INTERVAL", 2.0),
+        batch_size=getattr(settings, "WRITE_BATCH_SIZE", 50),
+        reconcile_interval=getattr(settings, "FAMILIES_RECONCILE_INTERVAL", 600),
+        rollups_path=getattr(settings, "ROLLUPS_PATH", "rollups.json"),
+        # Строки старше ARCHIVE_AFTER_DAYS дней переносятся в листы "<лист>-<год>"
+        archive_after_days=getattr(settings, "ARCHIVE_AFTER_DAYS", None),
+        archive_interval=getattr(settings, "ARCHIVE_INTERVAL", 3600),
+        # Квота Google Sheets API на сервисный аккаунт: SHEETS_QUOTA_PER_MINUTE запросов в минуту,
+        # не больше SHEETS_QUOTA_BURST подряд; последние SHEETS_QUOTA_RESERVE токенов -- только
+        # для запросов пользователей (None -- без ограничения, остаются только повторы 429/5xx)
+        quota_per_minute=getattr(settings, "SHEETS_QUOTA_PER_MINUTE", 60),
+        quota_burst=getattr(settings, "SHEETS_QUOTA_BURST", 10),
+        quota_reserve=getattr(settings, "SHEETS_QUOTA_RESERVE", 3)
+    )
+
+def create_repository(settings, drain_mirror: bool = True) -> Repository:
+    if getattr(settings, "STORAGE_BACKEND", "sheets") == "sqlite":
+        return SQLiteRepository(
+            getattr(settings, "SQLITE_PATH", "bot.db"),
+            mirror=create_sheets_repository(settings),
+            drain_mirror=drain_mirror
+        )
+    return create_sheets_repository(settings)
+
+# Апдейты, пришедшие до окончания прогрева, ждут его, а не обращаются к холодному хранилищу
+@dp.update.outer_middleware()
+async def wait_until_ready(handler, event, data):
+    await app_ready.wait()
+    return await handler(event, data)
+
+# Время обработчиков и запросов к Telegram для /metrics: по ним видно, где медленно --
+# в Telegram, в таблице (bot_sheets_*) или в коде самого обработчика
+handler_seconds = metrics.histogram("bot_handler_seconds", "Время работы обработчиков апдейтов", ("handler",))
+handler_errors = metrics.counter("bot_handler_errors_total", "Исключения в обработчиках апдейтов", ("handler",))
+telegram_seconds = metrics.histogram("bot_telegram_request_seconds", "Запросы к Telegram Bot API", ("method",))
+
+@dp.message.middleware()
+@dp.callback_query.middleware()
+async def measure_handler(handler, event, data):
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        handler_errors.inc(name)
+        raise
+    finally:
+        handler_seconds.observe(time.perf_counter() - started, name)
+
+async def measure_telegram_request(make_request, bot, method):
+    with telegram_seconds.time(type(method).__name__):
+        return await make_request(bot, method)
 
 # Обновленный список категорий
 CATEGORIES = [
@@ -74,6 +160,12 @@ CATEGORIES = [
     "💼 Прочее"
 ]
 
+# Черновик траты хранится в данных FSM (см. ExpenseDraft)
+class AddExpense(StatesGroup):
+    ENTER_AMOUNT = State()
+    SELECT_TYPE = State()
+    ENTER_COMMENT = State()
+
 # Класс для хранения состояний
 class EditExpense(StatesGroup):
     SELECT_FIELD = State()
@@ -82,6 +174,7 @@ class EditExpense(StatesGroup):
 # Добавляем состояния статистики
 class StatsPeriod(StatesGroup):
     WAITING_PERIOD = State()
+    WAITING_RANGE = State()  # Ввод своего периода
 
 # Добавляем класс бюджетов
 class BudgetStates(StatesGroup):
@@ -158,8 +251,27 @@ def get_stats_type_keyboard():
 def get_period_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="За неделю", callback_data="week")],
-            [InlineKeyboardButton(text="За месяц", callback_data="month")]
+            [
+                InlineKeyboardButton(text="За неделю", callback_data="week"),
+                InlineKeyboardButton(text="За месяц", callback_data="month")
+            ],
+            [
+                InlineKeyboardButton(text="За квартал", callback_data="quarter"),
+                InlineKeyboardButton(text="За год", callback_data="year")
+            ],
+            [InlineKeyboardButton(text="Свой период", callback_data="custom")]
+        ]
+    )
+
+# Разбивка отчета по дням, а для периодов длиннее двух месяцев -- по месяцам
+def get_breakdown_keyboard(stats_type: str, start_date, end_date):
+    by_month = (end_date - start_date).days > 62
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(
+                text="📅 По месяцам" if by_month else "📅 По дням",
+                callback_data=f"breakdown:{stats_type}:{start_date:%Y%m%d}:{end_date:%Y%m%d}"
+            )]
         ]
     )
 
@@ -176,8 +288,8 @@ def get_expense_actions_keyboard(expense_id: str):
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="❌ Удалить", callback_data=f"delete_{expense_id}")#,
-                #InlineKeyboardButton(text="✏️ Редактировать", callback_data=f"edit_{expense_id}")
+                InlineKeyboardButton(text="❌ Удалить", callback_data=f"delete_{expense_id}"),
+                InlineKeyboardButton(text="✏️ Редактировать", callback_data=f"edit_{expense_id}")
             ]
         ]
     )
@@ -197,47 +309,9 @@ def escape_markdown(text):
     escape_chars = r"\_*[]()~`>#+-=|{}.!"
     return re.sub(f"([{re.escape(escape_chars)}])", r"\\\1", text)
 
-###
-### Раздел с определением листов в гугл доке
-###
-
-def get_user_sheet(user_id):
-    try:
-        sheet = spreadsheet.worksheet(str(user_id))
-        # Проверяем наличие колонки ID
-        if sheet.row_values(1)[0] != "ID":
-            sheet.insert_cols([{"values": ["ID"]}], 1)  # Добавляем колонку ID в начало
-        return sheet
-    except gspread.WorksheetNotFound:
-        sheet = spreadsheet.add_worksheet(title=str(user_id), rows=100, cols=11)
-        sheet.append_row(["ID", "Дата", "Категория", "Сумма", "Теги", "Тип", "Комментарий"])
-        return sheet
-
-# Лист со списком семей
-def setup_families_list():
-    try:
-        return spreadsheet.worksheet("families_list")
-    except gspread.WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(title="families_list", rows=100, cols=3)
-        worksheet.append_row(["family_id", "user_id", "role"])
-        return worksheet
-
-def get_family_sheet(family_id):
-    try:
-        sheet = spreadsheet.worksheet(family_id)
-        if sheet.row_values(1)[0] != "ID":
-            sheet.insert_cols([{"values": ["ID"]}], 1)
-        return sheet
-    except gspread.WorksheetNotFound:
-        return None
-
-def get_budgets_sheet():
-    try:
-        return spreadsheet.worksheet("budgets")
-    except gspread.WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(title="budgets", rows=100, cols=3)
-        worksheet.append_row(["user_id", "category", "budget"])
-        return worksheet
+# Единое правило "уже состоит в семье" для создания семьи и вступления в нее
+async def is_in_family(user_id) -> bool:
+    return await repo.family_of(user_id) is not None
 
 def generate_family_id():
     # Генерация случайного идентификатора семьи (6 символов)
@@ -247,33 +321,65 @@ def generate_family_id():
 @dp.message(Command("start"))
 async def send_welcome(message: Message):
     user_id = message.from_user.id
-    get_user_sheet(user_id)  # Создаем лист при первом обращении
+    await repo.ensure_user(user_id)  # Создаем лист при первом обращении
+    activity.touch(user_id)
+    reminders.ensure_user(user_id)
     await message.reply(
         "Добро пожаловать! 🤑\nВыберите действие:",
         reply_markup=get_main_menu()
     )
 
+# Часовой пояс для напоминаний: /timezone Asia/Yekaterinburg
+@dp.message(Command("timezone"))
+async def set_timezone(message: Message):
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.reply(
+            f"Текущий часовой пояс: {reminders.timezone_of(message.from_user.id).zone}\n"
+            "Чтобы изменить, отправьте /timezone Europe/Moscow"
+        )
+        return
+    try:
+        reminders.set_timezone(message.from_user.id, parts[1].strip())
+    except pytz.UnknownTimeZoneError:
+        await message.reply("❌ Неизвестный часовой пояс. Пример: /timezone Europe/Moscow")
+        return
+    await message.reply(f"✅ Часовой пояс: {parts[1].strip()}")
+
+# Время ежедневного напоминания: /reminder 21:30 или /reminder off
+@dp.message(Command("reminder"))
+async def set_reminder_time(message: Message):
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        current = reminders.daily_time_of(message.from_user.id)
+        await message.reply(
+            f"Ежедневное напоминание: {current or 'выключено'}\n"
+            "Чтобы изменить, отправьте /reminder 21:30 или /reminder off"
+        )
+        return
+    value = parts[1].strip()
+    try:
+        reminders.set_daily_time(message.from_user.id, None if value.lower() == "off" else value)
+    except ValueError:
+        await message.reply("❌ Укажите время в формате ЧЧ:ММ, например /reminder 21:30")
+        return
+    await message.reply("✅ Ежедневное напоминание выключено" if value.lower() == "off" else f"✅ Напоминание в {value}")
+
 @dp.message(lambda message: message.text == "Создать семью")
 async def create_family(message: Message):
     user_id = message.from_user.id
 
     # Проверяем, не состоит ли пользователь уже в семье
-    families_list = setup_families_list()
-    records = families_list.get_all_records()
-    if any(str(user_id) == record.get("user_id") for record in records):
+    if await is_in_family(user_id):
         await message.reply("Вы уже состоите в семье. Создание новой семьи невозможно.")
         return
 
     # Генерация идентификатора семьи
     family_id = generate_family_id()
 
-    # Создание листа для семьи
+    # Создание семьи (в таблице -- отдельный лист и строка в families_list)
     try:
-        family_sheet = spreadsheet.add_worksheet(title=f"family-{family_id}", rows=100, cols=10)
-        family_sheet.append_row(["Дата", "Категория", "Сумма", "Теги", "Тип", "user_id"])
-        
-        # Добавляем создателя семьи в families_list
-        families_list.append_row([family_id, str(user_id), "creator"])
+        await repo.create_family(family_id, user_id)
         logger.info(f"Семья создана: {family_id}, создатель: {user_id}")
     except Exception as e:
         logger.error(f"Ошибка при создании семьи: {e}")
@@ -287,12 +393,9 @@ async def join_family(message: Message):
     user_id = message.from_user.id
 
     # Проверяем, не состоит ли пользователь уже в семье
-    for sheet in spreadsheet.worksheets():
-        if sheet.title.startswith('family-'):
-            records = sheet.get_all_records()
-            if any(record.get("user_id") == str(user_id) for record in records):
-                await message.reply("Вы уже состоите в семье.")
-                return
+    if await is_in_family(user_id):
+        await message.reply("Вы уже состоите в семье.")
+        return
 
     await message.reply("Введите идентификатор семьи:")
 
@@ -302,20 +405,18 @@ async def handle_family_id(message: Message):
     family_id = message.text
 
     # Проверяем, существует ли такая семья
-    families_list = setup_families_list()
-    records = families_list.get_all_records()
-    if not any(family_id == record.get("family_id") for record in records):
+    if not await repo.family_exists(family_id):
         await message.reply("Семья с таким идентификатором не найдена. Пожалуйста, проверьте идентификатор и попробуйте снова.")
         return
 
     # Проверяем, не состоит ли пользователь уже в семье
-    if any(str(user_id) == record.get("user_id") for record in records):
+    if await is_in_family(user_id):
         await message.reply("Вы уже состоите в семье.")
         return
 
     # Добавляем пользователя в семью
     try:
-        families_list.append_row([family_id, str(user_id), "member"])
+        await repo.join_family(family_id, user_id)
         logger.info(f"Пользователь {user_id} вступил в семью {family_id}")
     except Exception as e:
         logger.error(f"Ошибка при вступлении в семью: {e}")
@@ -326,8 +427,7 @@ async def handle_family_id(message: Message):
 
 @dp.message(lambda message: message.text == "Записать расход")
 async def start_add_expense(message: Message, state: FSMContext):
-    await state.clear()  # Очищаем все состояния
-    #user_data[user_id] = {}  # Сбрасываем временные данные
+    await state.clear()  # Очищаем все состояния и черновик траты
     await message.reply(
         "Выберите категорию:",
         reply_markup=get_categories_keyboard()
@@ -390,30 +490,32 @@ async def save_budget(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    budgets_sheet = get_budgets_sheet()
-    records = budgets_sheet.get_all_records()
-    
-    # Удаляем старый бюджет для категории
-    for idx, record in enumerate(records):
-        if str(record["user_id"]) == str(user_id) and record["category"] == data["category"]:
-            budgets_sheet.delete_rows(idx + 2)  # +2 из-за заголовка и нумерации с 1
-    
-    # Добавляем новый бюджет
-    budgets_sheet.append_row([str(user_id), data["category"], float(message.text)])
+    # Заменяем старый бюджет для категории новым
+    await repo.set_budget(user_id, data["category"], float(message.text))
     
     await message.answer(f"Бюджет для {data['category']} установлен: {message.text} руб/мес")
     await state.clear()
 
+# Черновик траты из данных FSM; устаревший (старше DRAFT_TTL) считается отсутствующим
+async def get_draft(state: FSMContext):
+    draft = ExpenseDraft.unpack((await state.get_data()).get(DRAFT_KEY))
+    if draft and draft.expired(getattr(Config, "DRAFT_TTL", 86400)):
+        return None
+    return draft
+
+async def save_draft(state: FSMContext, draft: ExpenseDraft):
+    await state.update_data({DRAFT_KEY: draft.pack()})
+
 @dp.callback_query(
     lambda query: query.data in CATEGORIES,
     ~StateFilter(BudgetStates.SELECT_CATEGORY)
 )
-async def handle_category(query: CallbackQuery):
+async def handle_category(query: CallbackQuery, state: FSMContext):
     logger.info(f"[ТРАТА] Начинается выбор категории траты")
-    # Сохраняем выбранную категорию в словаре user_data
-    user_id = query.from_user.id
+    # Начинаем новый черновик траты с выбранной категорией
     category = query.data
-    user_data[user_id] = {"category": category}  # Сохраняем категорию
+    await state.set_state(AddExpense.ENTER_AMOUNT)
+    await state.set_data({DRAFT_KEY: ExpenseDraft(category).pack()})
     
     # Отправляем сообщение с запросом суммы и включаем числовую клавиатуру
     await query.message.answer(
@@ -422,33 +524,28 @@ async def handle_category(query: CallbackQuery):
         parse_mode=None  # Отключаем форматирование Markdown
     )
 
-    # Логи
-    #print(user_data)
-    
     # Подтверждаем обработку callback
     await query.answer()
 
 @dp.message(
     lambda message: message.text.replace('.', '', 1).isdigit(),
     ~StateFilter(BudgetStates.ENTER_AMOUNT),
-    ~StateFilter(StatsPeriod.WAITING_PERIOD)  # Исключаем другие состояния
+    ~StateFilter(StatsPeriod.WAITING_PERIOD),  # Исключаем другие состояния
+    ~StateFilter(EditExpense.ENTER_NEW_VALUE, AddExpense.ENTER_COMMENT)
 )
-async def handle_amount(message: Message):
+async def handle_amount(message: Message, state: FSMContext):
     logger.info(f"[ТРАТА] Обработка для пользователя {message.from_user.id}")
-    user_id = message.from_user.id
 
     # Явная проверка, что процесс записи траты начат корректно
-    if user_id not in user_data or 'category' not in user_data[user_id]:
+    draft = await get_draft(state)
+    if not draft:
         await message.answer("⚠️ Сначала выберите категорию через меню 'Записать расход'")
         return
 
-    amount = float(message.text)
-    
-    # Сохраняем сумму в временных данных пользователя
-    user_data[user_id]["amount"] = amount
-    
-    # Логи
-    #print(user_data)
+    # Сохраняем сумму в черновике траты
+    draft.amount = float(message.text)
+    await save_draft(state, draft)
+    await state.set_state(AddExpense.SELECT_TYPE)
 
     # Запрашиваем тип траты
     await message.reply(
@@ -457,15 +554,14 @@ async def handle_amount(message: Message):
     )
 
 @dp.callback_query(lambda query: query.data in ["personal", "family"])
-async def handle_expense_type(query: CallbackQuery):
-    user_id = query.from_user.id
-    expense_type = query.data
-    user_data[user_id] = {
-        "category": user_data.get(user_id, {}).get("category"),
-        "amount": user_data.get(user_id, {}).get("amount"),
-        "expense_type": expense_type,
-        "awaiting_comment": True  # Флаг ожидания комментария
-    }
+async def handle_expense_type(query: CallbackQuery, state: FSMContext):
+    draft = await get_draft(state)
+    if not draft or draft.amount is None:
+        await query.answer("⚠️ Сначала выберите категорию через меню 'Записать расход'")
+        return
+    draft.expense_type = query.data
+    await save_draft(state, draft)
+    await state.set_state(AddExpense.ENTER_COMMENT)  # Ждем комментарий
     
     await query.message.answer(
         "Введите комментарий к трате:",
@@ -474,78 +570,62 @@ async def handle_expense_type(query: CallbackQuery):
     await query.answer()
 
 @dp.callback_query(lambda query: query.data == "skip_comment")
-async def handle_skip_comment(query: CallbackQuery):
-    user_id = query.from_user.id
-    user_data[user_id]["comment"] = ""  # Пустой комментарий
-    await process_expense(user_id, query.message)
+async def handle_skip_comment(query: CallbackQuery, state: FSMContext):
+    draft = await get_draft(state)
+    if not draft or draft.expense_type is None:
+        await query.answer("⚠️ Сначала выберите категорию через меню 'Записать расход'")
+        return
+    draft.comment = ""  # Пустой комментарий
+    await process_expense(query.from_user.id, query.message, state, draft)
     await query.answer()
 
-@dp.message(lambda message: user_data.get(message.from_user.id, {}).get("awaiting_comment"))
-async def handle_comment(message: Message):
-    user_id = message.from_user.id
-    user_data[user_id]["comment"] = message.text.strip()
-    await process_expense(user_id, message)
+@dp.message(AddExpense.ENTER_COMMENT)
+async def handle_comment(message: Message, state: FSMContext):
+    draft = await get_draft(state)
+    if not draft:
+        await state.clear()
+        await message.answer("⚠️ Черновик траты устарел, начните заново", reply_markup=get_main_menu())
+        return
+    draft.comment = message.text.strip()
+    await process_expense(message.from_user.id, message, state, draft)
 
-async def process_expense(user_id: int, message: Union[Message, CallbackQuery]):
-    data = user_data.get(user_id, {})
-    comment = data.get("comment", "")
+async def process_expense(user_id: int, message: Union[Message, CallbackQuery], state: FSMContext, draft: ExpenseDraft):
+    comment = draft.comment
     expense_id = str(uuid.uuid4())  # Генерируем UUID
     
     try:
-        if data["expense_type"] == "personal":
-            sheet = get_user_sheet(user_id)
-            row = [
-                expense_id,
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                data["category"],
-                data["amount"],
-                "",  # Теги
-                "Личная",
-                comment  # Комментарий
-            ]
-            sheet.append_row(row)
+        expense = Expense(
+            id=expense_id,
+            date=datetime.now().strftime(DATE_FORMAT),
+            category=draft.category,
+            amount=draft.amount,
+            user_id=str(user_id),
+            comment=comment
+        )
+        if draft.expense_type == "personal":
+            if await repo.add_expense(expense):
+                activity.touch(user_id, expense.date)
             
-        elif data["expense_type"] == "family":
-            families_list = setup_families_list()
-            family_id = next(
-                (r["family_id"] for r in families_list.get_all_records() 
-                if str(user_id) == str(r["user_id"])), None
-            )
+        elif draft.expense_type == "family":
+            expense.family_id = await repo.family_of(user_id)
             
-            if family_id:
-                logger.info(f"Найдена семья: {family_id}")  # <--- Логируем family_id
-                family_sheet = get_family_sheet(f"family-{family_id}")
-                if family_sheet:
-                    logger.info(f"Лист семьи найден: {family_sheet.title}") 
-                    row = [
-                        expense_id,
-                        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        data["category"],
-                        data["amount"],
-                        "",  # Теги
-                        "Семейная",
-                        str(user_id),
-                        comment  # Комментарий
-                    ]
-                    family_sheet.append_row(row)
-                else:
-                    logger.error("Лист семьи не найден!")  # <--- Ошибка
+            if expense.family_id:
+                logger.info(f"Найдена семья: {expense.family_id}")  # <--- Логируем family_id
+                if await repo.add_expense(expense):
+                    activity.touch(user_id, expense.date)
             else:
                 logger.warning("Пользователь не состоит в семье!")  # <--- Предупреждение
         
-        # Очистка данных и возврат в меню
-        del user_data[user_id]
-        #print(data)
-        category_p = data["category"]
-        amount_p = data["amount"]
-        expense_type_p = data["expense_type"]
+        # Очистка черновика и возврат в меню
+        await state.clear()
         await message.answer(
-            f"✅ Трата сохранена! Категория: {category_p} Сумма: {amount_p} Тип: {expense_type_p} Комментарий: {comment if comment else 'нет'}",
+            f"✅ Трата сохранена! Категория: {draft.category} Сумма: {draft.amount} Тип: {draft.expense_type} Комментарий: {comment if comment else 'нет'}",
             reply_markup=get_main_menu()
         )
         
     except Exception as e:
         logger.error(f"Ошибка сохранения: {e}")
+        await state.clear()  # Черновик не оставляем: пользователь начнет запись заново
         await message.answer("❌ Ошибка, попробуйте снова", reply_markup=get_main_menu())
 
 @dp.message(lambda message: message.text == "Посмотреть статистику")
@@ -555,41 +635,13 @@ async def show_stats_menu(message: Message):
         reply_markup=get_stats_type_keyboard()
     )
 
-# Общая функция расчета статистики
+# Общая функция расчета статистики. Суммы берутся из сводок, а пока сводка листа не собрана --
+# чтением строк одного периода (сводка собирается в фоне). Кадр всей истории (expense_frame)
+# нужен только для разбивки по дням и месяцам, которую запрашивают после отчета
 async def calculate_stats(user_id: int, stats_type: str, start_date: datetime.date, end_date: datetime.date):
-    stats = defaultdict(float)
-    budgets = {}
-
-    # Получаем бюджеты пользователя
-    budgets_sheet = get_budgets_sheet()
-    for record in budgets_sheet.get_all_records():
-        if str(record["user_id"]) == str(user_id):
-            budgets[record["category"]] = float(record["budget"])
-
-    # Личные траты
-    if stats_type in ["stats_personal", "stats_all"]:
-        personal_sheet = get_user_sheet(user_id)
-        records = personal_sheet.get_all_records()
-        for record in records:
-            record_date = datetime.strptime(record["Дата"], "%Y-%m-%d %H:%M:%S").date()
-            if start_date <= record_date <= end_date:
-                stats[record["Категория"]] += float(record["Сумма"])
-    
-    # Семейные траты
-    if stats_type in ["stats_family", "stats_all"]:
-        families_list = setup_families_list()
-        for family in filter(lambda r: str(user_id) == str(r["user_id"]), families_list.get_all_records()):
-            family_sheet = get_family_sheet(f"family-{family['family_id']}")
-            if family_sheet:
-                records = family_sheet.get_all_records()
-                for record in records:
-                    record_date = datetime.strptime(record["Дата"], "%Y-%m-%d %H:%M:%S").date()
-                    if start_date <= record_date <= end_date:
-                        stats[record["Категория"]] += float(record["Сумма"])
-    
     return {
-        "stats": stats,
-        "budgets": budgets
+        "stats": await repo.category_totals(user_id, stats_type, start_date, end_date),
+        "budgets": await repo.get_budgets(user_id)
     }
 
 # Обработчик выбора типа статистики
@@ -603,54 +655,74 @@ async def handle_stats_type(query: CallbackQuery, state: FSMContext):
     await state.set_state(StatsPeriod.WAITING_PERIOD)
     await query.answer()
 
+# Границы стандартного периода, его заголовок и множитель месячного бюджета
+def period_range(period: str, today):
+    if period == "week":
+        start_date = today - timedelta(days=today.weekday())
+        end_date = start_date + timedelta(days=6)
+        return start_date, end_date, f"неделю ({start_date:%d.%m} - {end_date:%d.%m})", 1 / 4
+    if period == "month":
+        start_date = today.replace(day=1)
+        end_date = (start_date + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return start_date, end_date, f"месяц ({start_date:%m.%Y})", 1
+    if period == "quarter":
+        quarter = (today.month - 1) // 3
+        start_date = today.replace(month=quarter * 3 + 1, day=1)
+        end_date = (start_date + timedelta(days=92)).replace(day=1) - timedelta(days=1)
+        return start_date, end_date, f"{quarter + 1} квартал {today.year}", 3
+    start_date = today.replace(month=1, day=1)
+    end_date = today.replace(month=12, day=31)
+    return start_date, end_date, f"{today.year} год", 12
+
+# Отчет по категориям с бюджетами; месячный бюджет пересчитывается на длину периода
+async def send_stats_report(message: Message, user_id: int, stats_type: str, start_date, end_date,
+                            period_title: str, budget_factor: float):
+    stats_data = await calculate_stats(
+        user_id=user_id,
+        stats_type=stats_type,
+        start_date=start_date,
+        end_date=end_date
+    )
+    stats = stats_data["stats"]
+    budgets = stats_data["budgets"]
+
+    # Формируем сообщение
+    text = f"📊 *Статистика за {period_title}*\n\n"
+    for category, amount in stats.items():
+        budget = budgets.get(category, 0) * budget_factor
+        if budget > 0:
+            percent = (amount / budget) * 100
+            text += f"{category}: {amount:.2f} / {budget:.2f} руб. ({percent:.0f}%)\n"
+        else:
+            text += f"{category}: {amount:.2f} руб.\n"
+
+    text += f"\n💵 *Итого:* {sum(stats.values()):.2f} руб."
+
+    await message.answer(
+        text,
+        parse_mode="Markdown",
+        reply_markup=get_breakdown_keyboard(stats_type, start_date, end_date) if stats else None
+    )
+
 # Обработчик выбора периода
-@dp.callback_query(StatsPeriod.WAITING_PERIOD, lambda query: query.data in ["week", "month"])
+@dp.callback_query(StatsPeriod.WAITING_PERIOD, lambda query: query.data in ["week", "month", "quarter", "year", "custom"])
 async def handle_stats_period(query: CallbackQuery, state: FSMContext):
     user_id = query.from_user.id
     data = await state.get_data()
     stats_type = data["stats_type"]
     period = query.data
 
+    if period == "custom":
+        await query.message.answer("Введите период в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ, например 01.01.2025-31.03.2025")
+        await state.set_state(StatsPeriod.WAITING_RANGE)
+        await query.answer()
+        return
+
     try:
         # Определяем даты периода
         today = datetime.now(pytz.timezone('Europe/Moscow')).date()
-        
-        if period == "week":
-            start_date = today - timedelta(days=today.weekday())
-            end_date = start_date + timedelta(days=6)
-            period_title = f"неделю ({start_date:%d.%m} - {end_date:%d.%m})"
-        else:
-            start_date = today.replace(day=1)
-            end_date = (start_date + timedelta(days=32)).replace(day=1) - timedelta(days=1)
-            period_title = f"месяц ({start_date:%m.%Y})"
-
-        # Получаем статистику
-        #print(user_id,stats_type,start_date,end_date)
-        stats_data = await calculate_stats(
-            user_id=user_id,
-            stats_type=stats_type,
-            start_date=start_date,
-            end_date=end_date
-        )
-        stats = stats_data["stats"]
-        budgets = stats_data["budgets"]
-
-        # Формируем сообщение
-        message = f"📊 *Статистика за {period_title}*\n\n"
-        for category, amount in stats.items():
-            budget = budgets.get(category, 0)
-            if budget > 0:
-                if period == "week":
-                    budget = budget / 4
-                percent = (amount / budget) * 100 if budget != 0 else 0
-                message += f"{category}: {amount:.2f} / {budget:.2f} руб. ({percent:.0f}%)\n"
-            else:
-                message += f"{category}: {amount:.2f} руб.\n"
-
-        message += f"\n💵 *Итого:* {sum(stats.values()):.2f} руб."
-
-        await query.message.answer(message, parse_mode="Markdown")
-    
+        start_date, end_date, period_title, budget_factor = period_range(period, today)
+        await send_stats_report(query.message, user_id, stats_type, start_date, end_date, period_title, budget_factor)
     except Exception as e:
         logger.error(f"Ошибка статистики: {e}")
         await query.answer("❌ Не удалось сформировать отчет")
@@ -658,123 +730,125 @@ async def handle_stats_period(query: CallbackQuery, state: FSMContext):
     await state.clear()
     await query.answer()
 
+# Обработчик ввода своего периода (кнопки меню в это время работают как обычно)
+@dp.message(StatsPeriod.WAITING_RANGE, lambda message: (message.text or "")[:1].isdigit())
+async def handle_stats_range(message: Message, state: FSMContext):
+    match = re.fullmatch(r"\s*(\d{1,2}\.\d{1,2}\.\d{4})\s*[-–—]\s*(\d{1,2}\.\d{1,2}\.\d{4})\s*", message.text or "")
+    try:
+        start_date, end_date = (datetime.strptime(value, "%d.%m.%Y").date() for value in match.groups())
+    except (AttributeError, ValueError):
+        await message.reply("❌ Не удалось разобрать период. Пример: 01.01.2025-31.03.2025")
+        return
+    if start_date > end_date:
+        start_date, end_date = end_date, start_date
+
+    data = await state.get_data()
+    try:
+        await send_stats_report(
+            message, message.from_user.id, data["stats_type"], start_date, end_date,
+            f"{start_date:%d.%m.%Y} - {end_date:%d.%m.%Y}",
+            ((end_date - start_date).days + 1) / 30
+        )
+    except Exception as e:
+        logger.error(f"Ошибка статистики: {e}")
+        await message.reply("❌ Не удалось сформировать отчет")
+    await state.clear()
+
+# Обработчик разбивки отчета по дням или месяцам
+@dp.callback_query(lambda query: query.data.startswith("breakdown:"))
+async def handle_stats_breakdown(query: CallbackQuery):
+    try:
+        _, stats_type, start, end = query.data.split(":")
+        start_date = datetime.strptime(start, "%Y%m%d").date()
+        end_date = datetime.strptime(end, "%Y%m%d").date()
+        by_month = (end_date - start_date).days > 62
+
+        frame = await repo.expense_frame(query.from_user.id, stats_type)
+        rows = frame.breakdown(start_date, end_date, "M" if by_month else "D")
+
+        text = f"📅 *{'По месяцам' if by_month else 'По дням'}: {start_date:%d.%m.%Y} - {end_date:%d.%m.%Y}*\n\n"
+        for day, amount in rows:
+            text += f"{day:%m.%Y}: {amount:.2f} руб.\n" if by_month else f"{day:%d.%m}: {amount:.2f} руб.\n"
+        if not rows:
+            text += "Трат за период нет"
+        await query.message.answer(text, parse_mode="Markdown")
+    except Exception as e:
+        logger.error(f"Ошибка разбивки статистики: {e}")
+        await query.answer("❌ Не удалось сформировать отчет")
+        return
+    await query.answer()
+
 # Обновленная функция для получения последних трат
-async def get_last_expenses(user_id: int, limit: int = 5):
-    expenses = []
-    seen_ids = set()  # Множество для отслеживания уникальных ID
-
-    # Личные траты
-    personal_sheet = get_user_sheet(user_id)
-    personal_records = personal_sheet.get_all_records()
-    for record in personal_records:
-        if record["ID"] not in seen_ids:
-            seen_ids.add(record["ID"])
-            expenses.append({
-                "id": record["ID"],
-                "type": "personal",
-                "data": record
-            })
-
-    # Семейные траты
-    families_list = setup_families_list()
-    user_families = {r["family_id"] for r in families_list.get_all_records() if str(r["user_id"]) == str(user_id)}
-    
-    for family_id in user_families:
-        family_sheet = get_family_sheet(f"family-{family_id}")
-        if family_sheet:
-            family_records = family_sheet.get_all_records()
-            for record in family_records:
-                if record["ID"] not in seen_ids:
-                    seen_ids.add(record["ID"])
-                    expenses.append({
-                        "id": record["ID"],
-                        "type": "family",
-                        "data": record
-                    })
-
-    # Сортировка и ограничение
-    expenses.sort(
-        key=lambda x: datetime.strptime(x["data"]["Дата"], "%Y-%m-%d %H:%M:%S"),
-        reverse=True
-    )
-    return expenses[:limit]
+async def get_last_expenses(user_id: int, limit: int = 5, cursor: str = None):
+    return await repo.last_expenses(user_id, limit, cursor)
 
-# Обновленный обработчик последних трат
-@dp.message(lambda message: message.text == "Последние траты")
-async def show_last_expenses(message: Message):
-    user_id = message.from_user.id
-    expenses = await get_last_expenses(user_id)
+# Клавиатура подгрузки следующей страницы трат
+def get_more_expenses_keyboard(cursor: str):
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="Ещё 5", callback_data=f"more_{cursor}")]]
+    )
+
+# Отправка страницы трат; курсор продолжает чтение с места, где закончилась прошлая страница
+async def send_expenses_page(message: Message, user_id: int, cursor: str = None):
+    expenses, next_cursor = await get_last_expenses(user_id, cursor=cursor)
     
     if not expenses:
-        await message.answer("📭 У вас пока нет записанных трат.")
+        await message.answer("📭 У вас пока нет записанных трат." if not cursor else "📭 Больше трат нет.")
         return
     
     for expense in expenses:
-        emoji = "👤" if expense["type"] == "personal" else "👨👩👧👦"
+        emoji = "👤" if expense.kind == "personal" else "👨👩👧👦"
         text = (
-            f"{emoji} *{'Личная' if expense['type'] == 'personal' else 'Семейная'} трата*\n"
-            f"🗓 {expense['data']['Дата']}\n"
-            f"🏷 {expense['data']['Категория']}\n"
-            f"💵 {expense['data']['Сумма']} руб.\n"
-            f"📝 {expense['data'].get('Комментарий', 'нет комментария')}"
+            f"{emoji} *{'Личная' if expense.kind == 'personal' else 'Семейная'} трата*\n"
+            f"🗓 {expense.date}\n"
+            f"🏷 {expense.category}\n"
+            f"💵 {expense.amount} руб.\n"
+            f"📝 {expense.comment or 'нет комментария'}"
         )
         
-        callback_data = f"delete_{expense['id']}"
-        
         await message.answer(
             text,
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(
-                    text="❌ Удалить", 
-                    callback_data=callback_data
-                )]]
-            ),
+            reply_markup=get_expense_actions_keyboard(expense.id),
             parse_mode="Markdown"
         )
 
+    if next_cursor:
+        await message.answer("Показать более ранние траты?", reply_markup=get_more_expenses_keyboard(next_cursor))
+
+# Обновленный обработчик последних трат
+@dp.message(lambda message: message.text == "Последние траты")
+async def show_last_expenses(message: Message):
+    await send_expenses_page(message, message.from_user.id)
+
+# Следующая страница последних трат
+@dp.callback_query(lambda query: query.data.startswith("more_"))
+async def show_more_expenses(query: CallbackQuery):
+    await query.message.edit_reply_markup(reply_markup=None)  # Кнопка больше не нужна
+    await send_expenses_page(query.message, query.from_user.id, cursor=query.data[len("more_"):])
+    await query.answer()
+
 # Обновленный обработчик удаления
 @dp.callback_query(lambda query: query.data.startswith("delete_"))
 async def handle_delete_expense(query: CallbackQuery):
     try:
         expense_id = query.data.split("_")[1]
         
-        # Ищем трату во всех листах пользователя
+        # Ищем трату среди личных и семейных трат пользователя
         user_id = query.from_user.id
-        
-        # 1. Проверяем личные траты
-        personal_sheet = get_user_sheet(user_id)
-        cell = personal_sheet.find(expense_id)
-        if cell:
-            personal_sheet.delete_rows(cell.row)
+        kind = await repo.delete_expense(user_id, expense_id)
+        if kind == "personal":
             await query.message.edit_text("✅ Личная трата удалена!")
-            return
-        
-        # 2. Проверяем семейные траты
-        families_list = setup_families_list()
-        user_families = [
-            r["family_id"] for r in families_list.get_all_records() 
-            if str(r["user_id"]) == str(user_id)
-        ]
-        
-        for family_id in user_families:
-            family_sheet = get_family_sheet(f"family-{family_id}")
-            if not family_sheet:
-                continue
-            cell = family_sheet.find(expense_id)
-            if cell:
-                family_sheet.delete_rows(cell.row)
-                await query.message.edit_text("✅ Семейная трата удалена!")
-                return
-        
-        # Если не найдено
-        await query.answer("❌ Трата не найдена")
+        elif kind == "family":
+            await query.message.edit_text("✅ Семейная трата удалена!")
+        else:
+            await query.answer("❌ Трата не найдена")
     
     except Exception as e:
         logger.error(f"Ошибка удаления: {e}")
         await query.answer("❌ Ошибка при удалении")
 
-# Обработчик редактирования
-@dp.callback_query(lambda query: query.data.startswith("edit_"), EditExpense.SELECT_FIELD)
+# Обработчик редактирования (трата ищется по ID в личном и семейном листах)
+@dp.callback_query(lambda query: query.data.startswith("edit_"))
 async def handle_edit_expense(query: CallbackQuery, state: FSMContext):
     expense_id = query.data.split("_")[1]
     await state.update_data(expense_id=expense_id)
@@ -800,19 +874,20 @@ async def handle_select_field(query: CallbackQuery, state: FSMContext):
 async def handle_new_value(message: Message, state: FSMContext):
     user_id = message.from_user.id
     data = await state.get_data()
-    
+
+    if data['field'] == "amount":
+        try:
+            float(message.text)
+        except ValueError:
+            await message.answer("❌ Введите число!")
+            return
+
     try:
-        sheet = get_user_sheet(user_id)
-        row = int(data['expense_id'])
-        col = {
-            "category": 2,  # B столбец
-            "amount": 3,    # C столбец
-            "comment": 6     # F столбец
-        }[data['field']]
-        
-        # Обновляем ячейку
-        sheet.update_cell(row, col, message.text)
-        await message.answer("✅ Трата обновлена!")
+        # Обновляем поле траты
+        if await repo.update_expense(user_id, data['expense_id'], data['field'], message.text):
+            await message.answer("✅ Трата обновлена!")
+        else:
+            await message.answer("❌ Трата не найдена")
     except Exception as e:
         logger.error(f"Ошибка редактирования: {e}")
         await message.answer("❌ Не удалось обновить трату")
@@ -822,29 +897,19 @@ async def handle_new_value(message: Message, state: FSMContext):
 async def show_user_budgets(query: CallbackQuery):
     #logger.info(f"Показываем бюджеты пользователя")
     user_id = query.from_user.id
-    budgets_sheet = get_budgets_sheet()
-    records = budgets_sheet.get_all_records()
+    user_budgets = await repo.get_budgets(user_id)
     
     logger.info(f"Показываем бюджеты. Пользователь {user_id}")
-    #print(records)
-    
-    user_budgets = []
-    for r in records:
-        #print(r)
-        #print(user_id)
-        if str(r["user_id"]) == str(user_id):
-            user_budgets.append(r)
     
-    #print(user_budgets)
     if not user_budgets:
         await query.message.answer("У вас нет установленных бюджетов")
         return
     
     text = "Ваши текущие бюджеты:\n\n"
     total_money = 0
-    for budget in user_budgets:
-        text += f"{budget['category']}: {budget['budget']} руб/мес\n"
-        total_money += int(budget['budget'])
+    for category, budget in user_budgets.items():
+        text += f"{category}: {budget:g} руб/мес\n"
+        total_money += int(budget)
 
     text += f"\n"
     text += f"Итого: {total_money} руб/мес"
@@ -856,105 +921,315 @@ async def show_user_budgets(query: CallbackQuery):
 async def handle_unknown(message: Message):
     await message.reply("Пожалуйста, выберите действие из меню.", reply_markup=get_main_menu())
 
-# Функция для отправки ежедневного напоминания
-async def send_daily_reminder(bot: Bot):
-    msk = pytz.timezone('Europe/Moscow')  # Московский часовой пояс
-    
-    while True:
-        now = datetime.now(msk)  # Текущее время в МСК
-        target_time = now.replace(hour=21, minute=0, second=0, microsecond=0, tzinfo=msk)
-        
-        # Если текущее время позже целевого, переносим на завтра
-        if now > target_time:
-            target_time += timedelta(days=1)
-        
-        # Ждем до целевого времени
-        wait_seconds = (target_time - now).total_seconds()
-        await asyncio.sleep(wait_seconds)
-        
-        # Текущая дата в МСК
-        today = now.strftime("%Y-%m-%d")
-        
-        # Проверяем все листы
-        for worksheet in spreadsheet.worksheets():
-            # Пропускаем семейные и нечисловые листы
-            if worksheet.title.startswith('family-') or not worksheet.title.isdigit():
-                continue
-            
-            try:
-                user_id = int(worksheet.title)
-                records = worksheet.get_all_records()
-                
-                # Пропускаем пустые листы или без колонки "Дата"
-                if not records or "Дата" not in records[0]:
-                    continue
-                
-                # Ищем сегодняшние траты
-                today_expenses = [
-                    record for record in records 
-                    if record.get("Дата", "").startswith(today)
-                ]
-                
-                # Отправляем уведомление, если трат нет
-                if not today_expenses:
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text="Неужели ничего не потратили? Давайте вспомним и запишем основные категории.",
-                        reply_markup=get_categories_keyboard()
-                    )
-                    
-            except Exception as e:
-                logger.error(f"Ошибка у пользователя {worksheet.title}: {str(e)}")
-
-# Функция для отправки еженедельного напоминания
-async def send_weekly_reminder(bot: Bot):
-    msk = pytz.timezone('Europe/Moscow')  # Часовой пояс Москвы
-    
+# Ежедневное напоминание тем, у кого нет трат за сегодняшний день по их часовому поясу
+async def send_daily_reminder(user_ids):
+    # Индекс активности, без чтения таблицы
+    recipients = [user_id for user_id in user_ids if activity.is_inactive(user_id, reminders.local_date(user_id))]
+    await broadcaster.send(
+        "daily",
+        recipients,
+        "Неужели ничего не потратили? Давайте вспомним и запишем основные категории.",
+        reply_markup=get_categories_keyboard()
+    )
+
+# Еженедельное напоминание
+async def send_weekly_reminder(user_ids):
+    await broadcaster.send(
+        "weekly",
+        user_ids,
+        "Все траты за неделю записаны? Время посмотреть статистику!",
+        reply_markup=get_main_menu()
+    )
+
+# Индекс активности загружается из снимка; если снимка нет (первый запуск
+# или файл удален вручную), он пересобирается по последним тратам в хранилище
+async def load_activity():
+    if activity.load():
+        return
+    try:
+        with background_priority():
+            dates = await repo.last_expense_dates()
+        activity.replace({user_id: date for user_id, date in dates.items() if owns_user(user_id)})
+        activity.save()
+        logger.info(f"Индекс активности пересобран: {len(activity)} пользователей")
+    except Exception as e:
+        logger.error(f"Ошибка пересборки индекса активности: {e}")
+
+# Очередь напоминаний загружается в warm_up, до приема апдейтов. После индекса активности
+# пользователям, которых в очереди нет, ставятся напоминания по умолчанию
+async def run_reminders():
+    await load_activity()
+    for user_id in activity.users():
+        reminders.ensure_user(user_id)
+    await reminders.run()
+
+async def save_snapshots():
     while True:
-        now = datetime.now(msk)  # Текущее время в МСК
-        target_time = now.replace(hour=11, minute=0, second=0, microsecond=0, tzinfo=msk)
-        
-        # Вычисляем дни до следующего воскресенья
-        days_until_sunday = (6 - now.weekday()) % 7  # 6 - воскресенье в Python
-        
-        # Если сегодня воскресенье и время уже прошло:
-        if days_until_sunday == 0 and now > target_time:
-            days_until_sunday = 7  # Ждем следующее воскресенье
-        
-        target_time += timedelta(days=days_until_sunday)
-        
-        # Если target_time всё равно в прошлом (например, из-за перехода на летнее время)
-        if target_time < now:
-            target_time += timedelta(days=7)
-        
-        # Ждем до целевого времени
-        wait_seconds = (target_time - now).total_seconds()
-        await asyncio.sleep(wait_seconds)
-        
-        # Отправка уведомлений...
-        for worksheet in spreadsheet.worksheets():
-            if worksheet.title.startswith('family-'):
-                continue
-            
-            user_id = worksheet.title
-            try:
-                await bot.send_message(
-                    chat_id=int(user_id),
-                    text="Все траты за неделю записаны? Время посмотреть статистику!",
-                    reply_markup=get_main_menu()
-                )
-            except Exception as e:
-                logger.error(f"Ошибка отправки: {user_id} - {e}")
+        await asyncio.sleep(60)
+        try:
+            activity.save()
+            reminders.save()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения индекса активности и очереди напоминаний: {e}")
+
+###
+### Сборка и запуск приложения
+###
+
+# В режиме нескольких процессов каждый обслуживает только своих пользователей
+def owns_user(user_id) -> bool:
+    return shard is None or shard_of(user_id, shard[1]) == shard[0]
+
+# Снимки индекса активности и очереди напоминаний у каждого процесса свои: activity.json -> activity.1.json
+def shard_path(path: str) -> str:
+    if shard is None:
+        return path
+    root, dot, ext = path.rpartition(".")
+    return f"{root}.{shard[0]}.{ext}" if dot else f"{path}.{shard[0]}"
+
+# Хранилище состояний диалогов и черновиков трат (Config.FSM_STORAGE):
+# "sqlite" -- файл, общий для процессов на одной машине, "redis" -- общий для
+# процессов на разных машинах (нужен пакет redis), "memory" -- только для отладки
+def create_fsm_storage(settings):
+    kind = getattr(settings, "FSM_STORAGE", "sqlite")
+    if kind == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+        # Брошенные черновики и состояния Redis удаляет сам по истечении TTL
+        ttl = getattr(settings, "DRAFT_TTL", 86400)
+        return RedisStorage.from_url(settings.REDIS_URL, state_ttl=ttl, data_ttl=ttl)
+    if kind == "sqlite":
+        return SQLiteStorage(getattr(settings, "FSM_SQLITE_PATH", "fsm.db"))
+    return MemoryStorage()
+
+# Создает бота, хранилище и остальные объекты приложения. Сетевых вызовов здесь нет:
+# таблица открывается и кэши прогреваются в warm_up() параллельно с запуском polling
+def create_app(settings=None, storage: Repository = None, fsm_storage=None, worker=None):
+    global Config, bot, repo, activity, broadcaster, reminders, drafts, shard
+    Config = settings or load_config()
+    shard = worker
+    workers = shard[1] if shard else 1
+
+    dp.fsm.storage = fsm_storage or create_fsm_storage(Config)
+    if hasattr(dp.fsm.storage, "create_isolation"):
+        # Redis: апдейты одного пользователя не обрабатываются разными процессами одновременно
+        dp.fsm.events_isolation = dp.fsm.storage.create_isolation()
+    drafts = DraftSweeper(
+        dp.fsm.storage,
+        ttl=getattr(Config, "DRAFT_TTL", 86400),
+        interval=getattr(Config, "DRAFT_SWEEP_INTERVAL", 600)
+    )
+
+    bot = Bot(
+        token=Config.BOT_TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)  # Указываем parse_mode здесь
+    )
+    # Очередь зеркала в таблицу разбирает только первый процесс
+    repo = storage or create_repository(Config, drain_mirror=shard is None or shard[0] == 0)
+    activity = ActivityIndex(shard_path(getattr(Config, "ACTIVITY_PATH", "activity.json")))
+    # Лимит Telegram общий на бота -- делим его между процессами
+    broadcaster = Broadcaster(
+        bot,
+        rate=getattr(Config, "BROADCAST_RATE", 25) / workers,
+        concurrency=getattr(Config, "BROADCAST_CONCURRENCY", 10)
+    )
+    # Часовой пояс и время напоминания пользователи меняют командами /timezone и /reminder
+    reminders = ReminderScheduler(
+        {"daily": send_daily_reminder, "weekly": send_weekly_reminder},
+        path=shard_path(getattr(Config, "REMINDERS_PATH", "reminders.json")),
+        default_tz=getattr(Config, "DEFAULT_TIMEZONE", "Europe/Moscow"),
+        daily_time=getattr(Config, "DAILY_REMINDER_TIME", "21:00"),
+        weekly_time=getattr(Config, "WEEKLY_REMINDER_TIME", "11:00"),
+        spread=getattr(Config, "REMINDER_SPREAD", 900)
+    )
+    bot.session.middleware(measure_telegram_request)
+    register_gauges()
+    return bot
+
+# Глубины очередей и расход квоты считываются в момент выгрузки /metrics
+def register_gauges():
+    def quota(key):
+        return lambda: repo.sheets_quota().get(key)
+
+    metrics.gauge("bot_ready", "1, когда хранилище прогрето и апдейты обрабатываются", lambda: int(app_ready.is_set()))
+    metrics.gauge("bot_pending_writes", "Изменения, еще не записанные в таблицу", lambda: repo.pending_writes())
+    metrics.gauge("bot_reminders_scheduled", "Пользователи в очереди напоминаний", lambda: len(reminders))
+    metrics.gauge("bot_drafts_live", "Незавершенные черновики трат", lambda: drafts.live)
+    metrics.gauge("bot_sheets_calls_in_flight", "Вызовы таблицы в пуле потоков и в ожидании квоты", quota("calls_in_flight"))
+    metrics.gauge("bot_sheets_quota_tokens", "Свободные токены квоты Google Sheets API", quota("tokens"))
+    metrics.gauge("bot_sheets_requests_last_minute", "Запросы к Google Sheets API за последнюю минуту",
+                  quota("requests_last_minute"))
+    metrics.gauge(
+        "bot_sheets_quota_waiting", "Вызовы, ждущие токен квоты",
+        lambda: {(priority,): count for priority, count in (repo.sheets_quota().get("waiting") or {}).items()},
+        ("priority",)
+    )
+
+# Метрики в формате Prometheus на локальном порту (Config.METRICS_PORT, None -- выключены).
+# Рабочие процессы слушают METRICS_PORT + номер процесса
+async def start_metrics():
+    port = getattr(Config, "METRICS_PORT", 9108)
+    if port is None:
+        return None
+    port += shard[0] if shard else 0
+    try:
+        return await serve_metrics(getattr(Config, "METRICS_HOST", "127.0.0.1"), port)
+    except OSError as e:
+        logger.error(f"Не удалось открыть порт метрик {port}: {e}")
+        return None
 
 # Запуск планировщика
 async def scheduler(bot: Bot):
-    asyncio.create_task(send_daily_reminder(bot))
-    asyncio.create_task(send_weekly_reminder(bot))
+    for task in repo.background_tasks():
+        asyncio.create_task(task)
+    asyncio.create_task(run_reminders())
+    asyncio.create_task(save_snapshots())
+    asyncio.create_task(drafts.run())
+
+# Прогрев хранилища (открытие таблицы, кэши листов, семей и бюджетов) и запуск
+# фоновых задач. Пока он идет, polling уже принимает апдейты, а обработчики их ждут
+async def warm_up():
+    while True:
+        try:
+            await repo.start()
+            break
+        except Exception as e:
+            logger.error(f"Ошибка запуска хранилища, повтор через 5 с: {e}")
+            await asyncio.sleep(5)
+    # Снимок очереди напоминаний читается до app_ready: загруженный позже, он затер бы
+    # изменения от /timezone, /reminder и ensure_user, сделанные за время пересборки активности
+    reminders.load()
+    await scheduler(bot)  # Запускаем планировщик
+    app_ready.set()
+    logger.info("Хранилище готово")
+
+# Состояние для GET /health в режиме вебхука
+def health_status():
+    return app_ready.is_set(), {
+        "pending_writes": repo.pending_writes(),
+        "drafts": drafts.live,
+        "sheets_quota": repo.sheets_quota()
+    }
 
-# Запуск бота
+# Рабочий процесс (Config.WORKERS > 1): получает апдейты своих пользователей от переднего
+# процесса через очередь. Запускается ShardSupervisor'ом в отдельном интерпретаторе
+def run_worker(index: int, workers: int, queue, heartbeats):
+    setup_logging()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Останавливаемся по сигналу из очереди, а не по Ctrl+C
+    asyncio.run(worker_main(index, workers, queue, heartbeats))
+
+async def worker_main(index: int, workers: int, queue, heartbeats):
+    create_app(worker=(index, workers))
+    metrics_runner = await start_metrics()
+    warm_up_task = asyncio.create_task(warm_up())
+    feeder = UserSerialFeeder(partial(dp.feed_raw_update, bot))
+
+    # Heartbeat обновляется из цикла событий: если цикл завис, передний процесс перезапустит рабочего
+    async def heartbeat():
+        while True:
+            heartbeats[index] = time.time()
+            await asyncio.sleep(5)
+    heartbeat_task = asyncio.create_task(heartbeat())
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            update = await loop.run_in_executor(None, queue.get)
+            if update is None:
+                break
+            feeder.submit(update_user_id(update), update)
+        await feeder.drain()
+    finally:
+        heartbeat_task.cancel()
+        warm_up_task.cancel()
+        activity.save()
+        reminders.save()
+        await repo.close()
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        logger.info(f"Рабочий процесс {index} остановлен")
+
+# Передний процесс: принимает апдейты и раскладывает их по рабочим по user_id, так что
+# апдейты одного пользователя всегда обрабатываются одним процессом и по порядку.
+# Процессы делят одну базу, поэтому режим доступен только с STORAGE_BACKEND = "sqlite":
+# кэши SheetsRepository (сводки, индекс семей) у каждого процесса разошлись бы
+async def run_sharded(settings):
+    if getattr(settings, "STORAGE_BACKEND", "sheets") != "sqlite":
+        raise SystemExit("Config.WORKERS > 1 требует STORAGE_BACKEND = \"sqlite\"")
+    supervisor = ShardSupervisor(
+        run_worker,
+        workers=settings.WORKERS,
+        heartbeat_timeout=getattr(settings, "WORKER_HEARTBEAT_TIMEOUT", 60)
+    )
+    supervisor.start()
+    monitor_task = asyncio.create_task(supervisor.monitor())
+    front_bot = Bot(token=settings.BOT_TOKEN)
+    allowed_updates = dp.resolve_used_update_types()
+    try:
+        if getattr(settings, "RUN_MODE", "polling") == "webhook":
+            await serve_webhook(create_front_app(supervisor, settings), front_bot, settings, allowed_updates)
+        else:
+            await front_bot.delete_webhook()
+            poll_task = asyncio.create_task(poll_updates(front_bot, supervisor, allowed_updates))
+            try:
+                await wait_for_stop_signal()
+            finally:
+                poll_task.cancel()
+    finally:
+        monitor_task.cancel()
+        await asyncio.get_running_loop().run_in_executor(None, supervisor.stop)
+        await front_bot.session.close()
+
+# Запуск бота: Config.RUN_MODE = "webhook" для продакшена, "polling" (по умолчанию) для разработки.
+# Записи, накопленные в очередях, сбрасываются в таблицу после остановки приема апдейтов
 async def main():
-    await scheduler(bot)  # Запускаем планировщик
-    await dp.start_polling(bot)
+    settings = load_config()
+    if getattr(settings, "WORKERS", 1) > 1:
+        await run_sharded(settings)
+        return
+    create_app(settings)
+    metrics_runner = await start_metrics()
+    warm_up_task = asyncio.create_task(warm_up())
+    try:
+        if getattr(Config, "RUN_MODE", "polling") == "webhook":
+            await run_webhook(dp, bot, Config, health=health_status)
+        else:
+            await bot.delete_webhook()  # Telegram не отдает апдейты через getUpdates, пока задан вебхук
+            await dp.start_polling(bot)
+    finally:
+        warm_up_task.cancel()
+        activity.save()
+        reminders.save()
+        await repo.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+# Импорт текущих листов таблицы в SQLite: python bot.py migrate
+async def migrate():
+    settings = load_config()
+    source = create_sheets_repository(settings)
+    target = SQLiteRepository(getattr(settings, "SQLITE_PATH", "bot.db"))
+    try:
+        await target.import_from_sheets(source)
+    finally:
+        await target.close()
+        await source.close()
+
+# Пересборка сводок статистики из листов (запускать при остановленном боте):
+# python bot.py rebuild-rollups
+async def rebuild_rollups():
+    source = create_sheets_repository(load_config())
+    await source.start()
+    try:
+        await source.rebuild_rollups()
+    finally:
+        await source.close()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    setup_logging()
+    if sys.argv[1:] == ["migrate"]:
+        asyncio.run(migrate())
+    elif sys.argv[1:] == ["rebuild-rollups"]:
+        asyncio.run(rebuild_rollups())
+    else:
+        asyncio.run(main())
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class BroadcastResult:
+    name: str
+    total: int = 0
+    sent: int = 0
+    blocked: int = 0  # Пользователь заблокировал бота
+    failed: int = 0
+    retries: int = 0
+    duration: float = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def __str__(self):
+        return (
+            f"{self.name}: отправлено {self.sent} из {self.total}, заблокировали бота {self.blocked}, "
+            f"ошибок {self.failed}, повторов {self.retries}, за {self.duration:.1f} с"
+        )
+
+
+# Рассылка сообщений многим пользователям. Общий темп ограничен ведром токенов
+# (Telegram допускает около 30 сообщений в секунду на бота), одновременных запросов
+# не больше concurrency. На flood control (RetryAfter) вся рассылка ставится на паузу,
+# на сетевые и серверные ошибки -- повтор с экспоненциальной задержкой.
+class Broadcaster:
+    def __init__(self, bot, rate: float = 25, concurrency: int = 10, max_retries: int = 3,
+                 backoff: float = 1.0, max_backoff: float = 30.0, progress_every: int = 500):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)  # Общее на все рассылки бота
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.progress_every = progress_every
+
+    async def _deliver(self, chat_id, text: str, reply_markup, result: BroadcastResult):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+                result.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                logger.warning(f"Flood control, рассылка {result.name} приостановлена на {e.retry_after} с")
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError:
+                result.blocked += 1
+                return
+            except TelegramBadRequest as e:
+                # Чат не найден и подобное -- повтор не поможет
+                logger.error(f"Ошибка отправки {chat_id}: {e}")
+                result.failed += 1
+                return
+            except Exception as e:
+                logger.error(f"Ошибка отправки {chat_id} (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(min(self.max_backoff, self.backoff * 2 ** attempt))
+            if attempt < self.max_retries:
+                result.retries += 1
+        result.failed += 1
+
+    async def send(self, name: str, chat_ids, text: str, reply_markup=None, on_progress=None):
+        # chat_ids -- любая коллекция; задачи не создаются на каждого получателя,
+        # concurrency обработчиков разбирают общую очередь
+        chat_ids = list(chat_ids)
+        result = BroadcastResult(name=name, total=len(chat_ids))
+        queue = iter(chat_ids)
+        started = time.monotonic()
+        logger.info(f"Рассылка {name}: {result.total} получателей")
+
+        async def worker():
+            for chat_id in queue:
+                await self._deliver(chat_id, text, reply_markup, result)
+                if result.done % self.progress_every == 0:
+                    logger.info(f"Рассылка {name}: {result.done}/{result.total}")
+                    if on_progress:
+                        on_progress(result)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, result.total))))
+        result.duration = time.monotonic() - started
+        logger.info(f"Рассылка завершена. {result}")
+        return result
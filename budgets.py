@@ -0,0 +1,59 @@
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+# Кэш листа budgets: (user_id, категория) -> (номер строки, сумма).
+# Загружается одним чтением листа, дальше обновляется при каждой записи,
+# поэтому чтение бюджетов для статистики не обращается к таблице.
+class BudgetStore:
+    def __init__(self):
+        self._rows = {}  # (user_id, category) -> номер строки в листе
+        self._budgets = defaultdict(dict)  # user_id -> {category: amount}
+        self.loaded = False
+
+    def load(self, values):
+        # values -- все строки листа (get_all_values), первая строка -- заголовок
+        rows = {}
+        budgets = defaultdict(dict)
+        for row, record in enumerate(values[1:], start=2):
+            if len(record) < 3:
+                continue
+            user_id, category = str(record[0]).strip(), str(record[1])
+            try:
+                amount = float(record[2])
+            except ValueError:
+                continue
+            if not user_id or not category:
+                continue
+            # Дубли от старой версии бота: действует последняя строка, как и раньше
+            rows[(user_id, category)] = row
+            budgets[user_id][category] = amount
+
+        self._rows = rows
+        self._budgets = budgets
+        self.loaded = True
+        logger.info(f"Бюджеты загружены: {len(rows)} записей")
+
+    def budgets_of(self, user_id):
+        return dict(self._budgets.get(str(user_id), {}))
+
+    def row_of(self, user_id, category: str):
+        return self._rows.get((str(user_id), category))
+
+    def set(self, user_id, category: str, amount: float, row: int):
+        user_id = str(user_id)
+        self._rows[(user_id, category)] = row
+        self._budgets[user_id][category] = amount
+
+    def items(self):
+        # Все бюджеты в виде (user_id, категория, сумма)
+        return [
+            (user_id, category, amount)
+            for user_id, categories in self._budgets.items()
+            for category, amount in categories.items()
+        ]
+
+    def __len__(self):
+        return len(self._rows)
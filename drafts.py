@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from aiogram.fsm.storage.memory import MemoryStorage
+from fsm_storage import SQLiteStorage
+
+logger = logging.getLogger(__name__)
+
+# Ключ черновика в данных FSM
+DRAFT_KEY = "draft"
+
+
+# Черновик траты, которую пользователь заполняет по шагам. В данных FSM
+# хранится компактным списком [категория, сумма, тип, комментарий, создан],
+# время создания -- последним элементом (по нему черновики удаляются по TTL).
+@dataclass(slots=True)
+class ExpenseDraft:
+    category: str
+    amount: float = None
+    expense_type: str = None  # "personal" или "family"
+    comment: str = ""
+    created: float = field(default_factory=time.time)
+
+    def pack(self) -> list:
+        return [self.category, self.amount, self.expense_type, self.comment, int(self.created)]
+
+    @classmethod
+    def unpack(cls, packed):
+        return cls(*packed) if packed else None
+
+    def expired(self, ttl: float, now: float = None) -> bool:
+        return (now or time.time()) - self.created > ttl
+
+
+# Фоновое удаление брошенных черновиков (пользователь выбрал категорию и ушел)
+# и счетчик живых черновиков. Для Redis то же самое делает data_ttl хранилища.
+class DraftSweeper:
+    def __init__(self, storage, ttl: float = 86400, interval: float = 600, state_prefix: str = "AddExpense:"):
+        self.storage = storage
+        self.ttl = ttl
+        self.interval = interval
+        self.state_prefix = state_prefix
+        # Живых черновиков после последней очистки; None -- хранилище их не считает (Redis)
+        self.live = 0 if isinstance(storage, (SQLiteStorage, MemoryStorage)) else None
+
+    async def sweep(self) -> int:
+        cutoff = time.time() - self.ttl
+        removed = 0
+        if isinstance(self.storage, SQLiteStorage):
+            removed = await self.storage.expire_field(DRAFT_KEY, cutoff, self.state_prefix)
+            self.live = await self.storage.count_field(DRAFT_KEY)
+        elif isinstance(self.storage, MemoryStorage):
+            live = 0
+            for record in self.storage.storage.values():
+                packed = record.data.get(DRAFT_KEY)
+                if not packed:
+                    continue
+                if packed[-1] < cutoff:
+                    del record.data[DRAFT_KEY]
+                    if record.state and record.state.startswith(self.state_prefix):
+                        record.state = None
+                    removed += 1
+                else:
+                    live += 1
+            self.live = live
+        else:
+            return removed
+        logger.info(f"Черновиков трат: {self.live}, удалено устаревших: {removed}")
+        return removed
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка очистки черновиков: {e}")
+            await asyncio.sleep(self.interval)
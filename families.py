@@ -0,0 +1,59 @@
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+# Индекс членства в семьях, построенный по листу families_list:
+# user_id -> family_id и family_id -> {user_id: role}
+class FamilyIndex:
+    def __init__(self):
+        self._user_family = {}
+        self._members = defaultdict(dict)
+
+    def load(self, values):
+        # Полностью пересобираем индекс по строкам families_list (get_all_values),
+        # колонки находим по заголовку в первой строке
+        header = [str(name).strip() for name in values[0]] if values else []
+        positions = [header.index(name) if name in header else default
+                     for default, name in enumerate(("family_id", "user_id", "role"))]
+
+        user_family = {}
+        members = defaultdict(dict)
+        for record in values[1:]:
+            family_id, user_id, role = (
+                str(record[index]).strip() if index < len(record) else "" for index in positions
+            )
+            if not family_id or not user_id:
+                continue
+            if user_id in user_family and user_family[user_id] != family_id:
+                # Ручная правка листа: пользователь в нескольких семьях, учитываем первую
+                logger.warning(f"Пользователь {user_id} состоит в нескольких семьях, используется {user_family[user_id]}")
+                continue
+            user_family[user_id] = family_id
+            members[family_id][user_id] = role or "member"
+
+        self._user_family = user_family
+        self._members = members
+        logger.info(f"Индекс семей загружен: {len(members)} семей, {len(user_family)} участников")
+
+    def add(self, family_id: str, user_id, role: str):
+        user_id = str(user_id)
+        self._user_family[user_id] = family_id
+        self._members[family_id][user_id] = role
+
+    def family_of(self, user_id):
+        return self._user_family.get(str(user_id))
+
+    def items(self):
+        # [(user_id, family_id, role)] -- для импорта в SQLite
+        return [(user_id, family_id, role) for family_id, users in self._members.items() for user_id, role in users.items()]
+
+    def members_of(self, family_id: str):
+        return dict(self._members.get(family_id, {}))
+
+    def exists(self, family_id: str) -> bool:
+        return family_id in self._members
+
+    def __len__(self):
+        return len(self._members)
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}'
+);
+"""
+
+
+# Хранилище состояний диалогов (FSM) и черновиков в файле SQLite. В отличие
+# от MemoryStorage переживает перезапуск, а в режиме WAL его могут одновременно
+# использовать несколько процессов бота на одной машине.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path: str = "fsm.db", busy_timeout: float = 5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        # Одно соединение и один поток, как и в SQLiteRepository
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+        self._conn = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    def _connection(self):
+        if self._conn is None:
+            # timeout -- сколько ждать, пока запись держит другой процесс
+            self._conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, partial(func, *args))
+
+    def _get(self, key: str):
+        return self._connection().execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+
+    def _set_state(self, key: str, state):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET state = excluded.state",
+                (key, state)
+            )
+            conn.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+    def _set_data(self, key: str, data: dict):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET data = excluded.data",
+                (key, json.dumps(data, ensure_ascii=False))
+            )
+            conn.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+    def _update_data(self, key: str, data: dict):
+        # Чтение и запись в одной транзакции, чтобы не потерять параллельное обновление
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM fsm WHERE key = ?", (key,)).fetchone()
+            current = json.loads(row[0]) if row else {}
+            current.update(data)
+            conn.execute(
+                "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET data = excluded.data",
+                (key, json.dumps(current, ensure_ascii=False))
+            )
+        return current
+
+    def _expire_field(self, field: str, cutoff: float, state_prefix: str):
+        # field -- список, последний элемент которого -- время создания (unix time)
+        with self._connection() as conn:
+            cursor = conn.execute(
+                f"""
+                UPDATE fsm SET
+                    data = json_remove(data, '$.{field}'),
+                    state = CASE WHEN state LIKE ? THEN NULL ELSE state END
+                WHERE json_extract(data, '$.{field}[#-1]') < ?
+                """,
+                (state_prefix + "%", cutoff)
+            )
+            conn.execute("DELETE FROM fsm WHERE state IS NULL AND data = '{}'")
+            return cursor.rowcount
+
+    def _count_field(self, field: str):
+        return self._connection().execute(
+            f"SELECT COUNT(*) FROM fsm WHERE json_extract(data, '$.{field}') IS NOT NULL"
+        ).fetchone()[0]
+
+    async def expire_field(self, field: str, cutoff: float, state_prefix: str = ""):
+        # Удаляет устаревшие записи поля данных и сбрасывает связанные с ним состояния
+        return await self._run(self._expire_field, field, cutoff, state_prefix)
+
+    async def count_field(self, field: str) -> int:
+        return await self._run(self._count_field, field)
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        await self._run(self._set_state, self._key(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey):
+        row = await self._run(self._get, self._key(key))
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        await self._run(self._set_data, self._key(key), data)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        row = await self._run(self._get, self._key(key))
+        return json.loads(row[1]) if row else {}
+
+    async def update_data(self, key: StorageKey, data: dict) -> dict:
+        return (await self._run(self._update_data, self._key(key), data)).copy()
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,51 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Индекс "ID траты -> (лист, номер строки)". Заполняется попутно при чтении
+# и записи листов и сдвигается при удалении строк, поэтому удаление и
+# редактирование обходятся без полнотекстового поиска find по листам.
+class ExpenseLocator:
+    def __init__(self):
+        self._titles = {}  # title -> {expense_id: row}
+        self._ids = {}  # expense_id -> title
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, expense_id: str):
+        title = self._ids.get(expense_id)
+        if title is None:
+            return None
+        return title, self._titles[title][expense_id]
+
+    def put(self, title: str, row: int, expense_id: str):
+        if not expense_id:
+            return
+        previous = self._ids.get(expense_id)
+        if previous is not None and previous != title:
+            self._titles[previous].pop(expense_id, None)
+        self._ids[expense_id] = title
+        self._titles.setdefault(title, {})[expense_id] = row
+
+    def forget(self, expense_id: str):
+        title = self._ids.pop(expense_id, None)
+        if title is not None:
+            self._titles[title].pop(expense_id, None)
+
+    def note_delete(self, title: str, row: int, count: int = 1):
+        # Строки ниже удаленных поднимаются на count позиций
+        rows = self._titles.get(title)
+        if not rows:
+            return
+        for expense_id, expense_row in list(rows.items()):
+            if row <= expense_row < row + count:
+                del rows[expense_id]
+                self._ids.pop(expense_id, None)
+            elif expense_row >= row + count:
+                rows[expense_id] = expense_row - count
+
+    def invalidate(self, title: str):
+        for expense_id in self._titles.pop(title, {}):
+            self._ids.pop(expense_id, None)
@@ -0,0 +1,203 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм по умолчанию, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+INF_BUCKET = 'le="+Inf"'
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+# Метрики пишутся из цикла событий и из потоков пула gspread: обновление -- словарь
+# под блокировкой без аллокаций сверх ключа меток, поэтому их можно не выключать в продакшене
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # метки -> [счетчики корзин..., сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return series[-1] if series else 0
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                le = _format_labels(self.labels, label_values, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(self.labels, label_values, INF_BUCKET)} {values[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(values[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {values[-1]}"
+
+
+# Значение, которое считается в момент выгрузки (глубина очереди, токены квоты).
+# func возвращает число или словарь {значения меток (кортеж): число}; None -- нет данных
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, func, labels=(), type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.func = func
+        self.type = type
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.error(f"Ошибка чтения метрики {self.name}: {e}")
+            return
+        if value is None:
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for label_values, number in sorted(value.items()):
+            if number is not None:
+                yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(number)}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        # Повторная регистрация (например, create_app в тестах) заменяет функцию, но сохраняет
+        # накопленные значения счетчиков и гистограмм
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, Gauge):
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, func, labels=(), type: str = "gauge") -> Gauge:
+        # type="counter" -- для накопительных значений, которые уже считает сам объект
+        return self._register(Gauge(name, help, func, labels, type))
+
+    def render(self) -> str:
+        # Текстовый формат Prometheus 0.0.4
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Общий реестр процесса; модули объявляют свои метрики при импорте, как логгеры
+registry = MetricsRegistry()
+
+cache_lookups = registry.counter(
+    "bot_cache_lookups_total", "Обращения к кэшам: result=hit -- ответ из памяти, miss -- запрос к хранилищу",
+    ("cache", "result")
+)
+
+
+def cache_lookup(cache: str, hit: bool):
+    cache_lookups.inc(cache, "hit" if hit else "miss")
+
+
+# aiohttp-приложение с GET /metrics
+def create_metrics_app(metrics: MetricsRegistry = registry) -> web.Application:
+    async def handle_metrics(request):
+        return web.Response(body=metrics.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+# Метрики на локальном порту. Возвращает AppRunner, который закрывается через cleanup()
+async def serve_metrics(host: str = "127.0.0.1", port: int = 9108, metrics: MetricsRegistry = registry):
+    runner = web.AppRunner(create_metrics_app(metrics), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+
+# Ведро токенов: не больше rate операций в секунду в среднем и не больше
+# capacity подряд. Ожидающие обслуживаются по очереди (FIFO).
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while delay := self.try_acquire():
+                await asyncio.sleep(delay)
+
+    def try_acquire(self, reserve: float = 0) -> float:
+        # Берет токен без ожидания, если после этого в ведре останется не меньше reserve
+        # токенов, и возвращает 0; иначе -- сколько секунд подождать до следующей попытки
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= 1 + reserve:
+            self._tokens -= 1
+            return 0
+        return (1 + reserve - self._tokens) / self.rate
+
+    def spend(self, count: float):
+        # Списывает count токенов сверх взятых через acquire (отрицательное count -- возврат).
+        # Баланс может уйти в минус: тогда следующие acquire ждут, пока он восстановится
+        self._tokens = min(self.capacity, self._tokens - count)
+
+    @property
+    def available(self) -> float:
+        now = time.monotonic()
+        if now <= self._updated:
+            return self._tokens
+        return min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+
+    def pause(self, seconds: float):
+        # Полная остановка на seconds (например, по ответу сервера "повторите через N секунд")
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+        self._updated = max(self._updated, self._paused_until)
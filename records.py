@@ -0,0 +1,148 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from gspread.utils import rowcol_to_a1
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Заголовки листов с тратами
+PERSONAL_HEADER = ["ID", "Дата", "Категория", "Сумма", "Теги", "Тип", "Комментарий"]
+FAMILY_HEADER = ["ID", "Дата", "Категория", "Сумма", "Теги", "Тип", "user_id", "Комментарий"]
+
+# Нулевой день серийных дат Google Sheets (так приходят ячейки с форматом даты)
+SHEETS_EPOCH = datetime(1899, 12, 30)
+
+
+# Одна трата независимо от того, где она хранится
+@dataclass(slots=True)
+class Expense:
+    id: str
+    date: str  # "%Y-%m-%d %H:%M:%S"
+    category: str
+    amount: float
+    user_id: str
+    family_id: str = None  # None -- личная трата
+    comment: str = ""
+    tags: str = ""
+
+    @property
+    def kind(self) -> str:
+        return "family" if self.family_id else "personal"
+
+    @property
+    def timestamp(self) -> datetime:
+        return parse_timestamp(self.date)
+
+
+# Разбор даты срезами по фиксированным позициям (в разы быстрее strptime).
+# Понимает "ГГГГ-ММ-ДД чч:мм:сс", "ГГГГ-ММ-ДД", "ДД.ММ.ГГГГ[ чч:мм:сс]" (ручной ввод
+# в русской локали таблицы) и серийные числа Google Sheets; иначе возвращает None
+def parse_timestamp(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return SHEETS_EPOCH + timedelta(seconds=round(value * 86400))
+    value = str(value)
+    try:
+        if len(value) >= 10 and value[4] == "-" and value[7] == "-":
+            year, month, day = int(value[:4]), int(value[5:7]), int(value[8:10])
+        elif len(value) >= 10 and value[2] == "." and value[5] == ".":
+            year, month, day = int(value[6:10]), int(value[3:5]), int(value[:2])
+        else:
+            return None
+        if len(value) >= 19:
+            return datetime(year, month, day, int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        return datetime(year, month, day)
+    except ValueError:
+        return None
+
+
+# Дата в формате DATE_FORMAT; строка, уже записанная в нем, возвращается без разбора
+def format_timestamp(value):
+    if isinstance(value, str) and len(value) == 19 and value[4] == "-" and value[10] == " ":
+        return value
+    moment = parse_timestamp(value)
+    return moment.strftime(DATE_FORMAT) if moment else None
+
+
+# Номера колонок листа трат, найденные по строке заголовка. Личные и семейные листы
+# различаются раскладкой (в семейном есть user_id), а в старых листах колонки могли
+# переставить вручную -- строки разбираются по позициям, без словаря на каждую строку
+class SheetLayout:
+    __slots__ = ("id", "date", "category", "amount", "tags", "user_id", "comment", "width")
+
+    COLUMNS = {
+        "ID": "id", "Дата": "date", "Категория": "category", "Сумма": "amount",
+        "Теги": "tags", "user_id": "user_id", "Комментарий": "comment",
+    }
+
+    def __init__(self, header):
+        positions = {}
+        for index, name in enumerate(header):
+            field = self.COLUMNS.get(str(name).strip())
+            if field and field not in positions:
+                positions[field] = index
+        for field in self.COLUMNS.values():
+            setattr(self, field, positions.get(field))
+        self.width = max(positions.values(), default=-1) + 1
+
+    @classmethod
+    def default(cls, title: str) -> "SheetLayout":
+        return FAMILY_LAYOUT if title.startswith("family-") else PERSONAL_LAYOUT
+
+    @property
+    def complete(self) -> bool:
+        return None not in (self.date, self.category, self.amount)
+
+    # Буква колонки поля ("B" для даты) и последней колонки с данными трат
+    def column(self, field: str) -> str:
+        return rowcol_to_a1(1, getattr(self, field) + 1)[:-1]
+
+    @property
+    def last_column(self) -> str:
+        return rowcol_to_a1(1, self.width)[:-1]
+
+    # Номер колонки поля для update_cell (с 1) или None, если колонки нет
+    def column_number(self, field: str):
+        index = getattr(self, field)
+        return index + 1 if index is not None else None
+
+    @staticmethod
+    def _text(values, index) -> str:
+        return str(values[index]) if index is not None and index < len(values) else ""
+
+    def expense_id(self, values) -> str:
+        return self._text(values, self.id)
+
+    def decode(self, values, family_id=None, user_id=None):
+        # Трата из строки листа; неполные и битые строки -- None
+        try:
+            date = format_timestamp(values[self.date])
+            if date is None:
+                return None
+            return Expense(
+                id=self._text(values, self.id),
+                date=date,
+                category=str(values[self.category]),
+                amount=float(values[self.amount]),
+                user_id=self._text(values, self.user_id) if self.user_id is not None else str(user_id),
+                family_id=family_id,
+                comment=self._text(values, self.comment),
+                tags=self._text(values, self.tags)
+            )
+        except (IndexError, TypeError, ValueError):
+            return None
+
+    def decode_all(self, rows, family_id=None, user_id=None):
+        expenses = []
+        for values in rows:
+            expense = self.decode(values, family_id, user_id)
+            if expense is not None:
+                expenses.append(expense)
+        return expenses
+
+    # Ключ сводки для строки листа: (день, категория, сумма) или None
+    def rollup_key(self, values):
+        expense = self.decode(values)
+        return (expense.date[:10], expense.category, expense.amount) if expense else None
+
+
+PERSONAL_LAYOUT = SheetLayout(PERSONAL_HEADER)
+FAMILY_LAYOUT = SheetLayout(FAMILY_HEADER)
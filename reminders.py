@@ -0,0 +1,199 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+import pytz
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+run_seconds = metrics.histogram(
+    "bot_reminder_run_seconds", "Обработка пачки напоминаний одного вида (рассылка)", ("kind",),
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+)
+
+
+# Планировщик напоминаний: одна куча (время отправки, вид, user_id) на всех
+# пользователей и одна задача, которая спит до ближайшего срока. У каждого
+# пользователя свой часовой пояс и время ежедневного напоминания, а сдвиг
+# в пределах spread секунд (стабильный для пользователя) размазывает отправку,
+# чтобы все не получали сообщение в одну секунду. Очередь и настройки
+# сохраняются в JSON и переживают перезапуск.
+class ReminderScheduler:
+    KINDS = ("daily", "weekly")
+
+    def __init__(self, handlers: dict, path: str = "reminders.json", default_tz: str = "Europe/Moscow",
+                 daily_time: str = "21:00", weekly_time: str = "11:00", weekly_day: int = 6,
+                 spread: int = 900, grace: int = 3600, max_batch: int = 1000):
+        self.handlers = handlers  # вид -> async (список user_id) -> None
+        self.path = path
+        self.default_tz = default_tz
+        self.daily_time = daily_time
+        self.weekly_time = weekly_time
+        self.weekly_day = weekly_day  # 0 -- понедельник, 6 -- воскресенье
+        self.spread = spread
+        self.grace = grace  # Пропущенные дольше этого (бот был остановлен) не отправляем
+        self.max_batch = max_batch
+        self._prefs = {}  # user_id -> {"tz": ..., "daily": "HH:MM" или None}
+        self._heap = []  # (время, вид, user_id); устаревшие записи пропускаются
+        self._due = {}  # (вид, user_id) -> актуальное время
+        self._wakeup = asyncio.Event()
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._due)
+
+    ###
+    ### Настройки пользователей
+    ###
+
+    def timezone_of(self, user_id):
+        return pytz.timezone(self._prefs.get(str(user_id), {}).get("tz", self.default_tz))
+
+    def daily_time_of(self, user_id):
+        return self._prefs.get(str(user_id), {}).get("daily", self.daily_time)
+
+    def local_date(self, user_id) -> str:
+        return datetime.now(self.timezone_of(user_id)).strftime("%Y-%m-%d")
+
+    def set_timezone(self, user_id, tz_name: str):
+        pytz.timezone(tz_name)  # pytz.UnknownTimeZoneError для неизвестного пояса
+        self._prefs.setdefault(str(user_id), {})["tz"] = tz_name
+        self._reschedule(user_id)
+
+    def set_daily_time(self, user_id, value):
+        # value -- "HH:MM" или None, чтобы отключить ежедневное напоминание
+        if value is not None:
+            datetime.strptime(value, "%H:%M")  # ValueError для неверного формата
+        self._prefs.setdefault(str(user_id), {})["daily"] = value
+        self._reschedule(user_id)
+
+    ###
+    ### Очередь
+    ###
+
+    def _jitter(self, kind: str, user_id: str) -> int:
+        return zlib.crc32(f"{kind}:{user_id}".encode()) % (self.spread + 1)
+
+    def next_due(self, kind: str, user_id, after: float):
+        # Ближайшее время напоминания строго после after (unix time) или None
+        user_id = str(user_id)
+        if kind == "daily":
+            at = self.daily_time_of(user_id)
+            if at is None:
+                return None
+        else:
+            at = self.weekly_time
+        hour, minute = map(int, at.split(":"))
+        tz = self.timezone_of(user_id)
+        local_day = datetime.fromtimestamp(after, tz).date()
+        for days in range(9):
+            day = local_day + timedelta(days=days)
+            if kind == "weekly" and day.weekday() != self.weekly_day:
+                continue
+            # localize для каждой даты отдельно, чтобы учесть переход на летнее время
+            local = tz.localize(datetime(day.year, day.month, day.day, hour, minute))
+            due = local.timestamp() + self._jitter(kind, user_id)
+            if due > after:
+                return due
+        return None
+
+    def _push(self, kind: str, user_id: str, due):
+        if due is None:
+            self._due.pop((kind, user_id), None)
+        else:
+            self._due[(kind, user_id)] = due
+            heapq.heappush(self._heap, (due, kind, user_id))
+            if due <= self._heap[0][0]:
+                self._wakeup.set()  # Новый срок раньше того, до которого спит цикл
+        self._dirty = True
+
+    def _reschedule(self, user_id, after: float = None):
+        user_id = str(user_id)
+        after = time.time() if after is None else after
+        for kind in self.KINDS:
+            self._push(kind, user_id, self.next_due(kind, user_id, after))
+
+    def ensure_user(self, user_id):
+        # Ставит напоминания пользователю, если их еще нет в очереди
+        user_id = str(user_id)
+        now = time.time()
+        for kind in self.KINDS:
+            if (kind, user_id) not in self._due:
+                due = self.next_due(kind, user_id, now)
+                if due is not None:
+                    self._push(kind, user_id, due)
+
+    ###
+    ### Сохранение
+    ###
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except ValueError as e:
+            logger.error(f"Не удалось прочитать {self.path}: {e}")
+            return
+        self._prefs = state.get("prefs", {})
+        self._due = {(kind, user_id): due for due, kind, user_id in state.get("jobs", [])}
+        self._heap = [(due, kind, user_id) for (kind, user_id), due in self._due.items()]
+        heapq.heapify(self._heap)
+        logger.info(f"Загружено напоминаний в очереди: {len(self._due)}")
+
+    def save(self):
+        if not self._dirty:
+            return
+        state = {
+            "prefs": self._prefs,
+            "jobs": [[due, kind, user_id] for (kind, user_id), due in self._due.items()]
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    ###
+    ### Выполнение
+    ###
+
+    def pop_due(self, now: float):
+        # Снимает с кучи наступившие напоминания (не больше max_batch) и ставит следующие
+        batch = defaultdict(list)
+        taken = 0
+        while self._heap and self._heap[0][0] <= now and taken < self.max_batch:
+            due, kind, user_id = heapq.heappop(self._heap)
+            if self._due.get((kind, user_id)) != due:
+                continue  # Запись устарела: пользователь поменял настройки
+            if now - due <= self.grace:
+                batch[kind].append(int(user_id))
+                taken += 1
+            self._push(kind, user_id, self.next_due(kind, user_id, max(now, due)))
+        return batch
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            timeout = self._heap[0][0] - now if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for kind, user_ids in self.pop_due(now).items():
+                try:
+                    with run_seconds.time(kind):
+                        await self.handlers[kind](user_ids)
+                except Exception as e:
+                    logger.error(f"Ошибка напоминания {kind}: {e}")
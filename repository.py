@@ -0,0 +1,892 @@
+import asyncio
+import heapq
+import logging
+import re
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import islice
+import gspread
+from gspread.utils import ValueRenderOption
+from sheets import (
+    QuotaGovernor, SheetsExecutor, WorksheetRegistry, background_priority, batch_get_values, first_row_where,
+    read_date_range
+)
+from families import FamilyIndex
+from write_queue import AppendQueue
+from rollups import RollupStore
+from locator import ExpenseLocator
+from budgets import BudgetStore
+from analytics import ExpenseFrame
+from metrics import cache_lookup
+from records import DATE_FORMAT, FAMILY_HEADER, PERSONAL_HEADER, PERSONAL_LAYOUT, Expense, SheetLayout
+
+logger = logging.getLogger(__name__)
+
+
+def family_sheet_title(family_id: str) -> str:
+    return f"family-{family_id}"
+
+
+# Архив старых строк листа трат за год: "123456-2025", "family-...-2025"
+ARCHIVE_TITLE = re.compile(r"(.+)-(\d{4})")
+
+
+def archive_sheet_title(title: str, year) -> str:
+    return f"{title}-{year}"
+
+
+# Лист трат, к которому относится лист: сам лист для рабочего листа и исходный
+# лист для архива; None для служебных листов (budgets, families_list, ...)
+def expense_sheet_owner(title: str):
+    match = ARCHIVE_TITLE.fullmatch(title)
+    owner = match.group(1) if match else title
+    if owner.isdigit() or (owner.startswith("family-") and not ARCHIVE_TITLE.fullmatch(owner)):
+        return owner
+    return None
+
+
+def is_expense_sheet(title: str) -> bool:
+    return expense_sheet_owner(title) == title
+
+
+# Интерфейс хранилища: хендлеры работают только с ним
+class Repository(ABC):
+    async def start(self):
+        # Прогрев кэшей и восстановление состояния при запуске
+        pass
+
+    def background_tasks(self):
+        # Корутины фоновых задач, которые запускает main()
+        return []
+
+    async def close(self):
+        pass
+
+    def pending_writes(self) -> int:
+        # Изменения, принятые, но еще не записанные в таблицу
+        return 0
+
+    def sheets_quota(self) -> dict:
+        # Расход квоты Google Sheets API и события ограничения (пустой словарь -- таблица не используется)
+        return {}
+
+    # Пользователи
+    @abstractmethod
+    async def ensure_user(self, user_id): ...
+
+    @abstractmethod
+    async def last_expense_dates(self):
+        # Возвращает {user_id: дата последней траты или ""} по всем пользователям
+        ...
+
+    # Траты
+    @abstractmethod
+    async def add_expense(self, expense: Expense): ...
+
+    @abstractmethod
+    async def delete_expense(self, user_id, expense_id: str):
+        # Возвращает тип удаленной траты ("personal"/"family") или None
+        ...
+
+    @abstractmethod
+    async def update_expense(self, user_id, expense_id: str, field: str, value) -> bool: ...
+
+    @abstractmethod
+    async def category_totals(self, user_id, stats_type: str, start_date, end_date): ...
+
+    @abstractmethod
+    async def expense_frame(self, user_id, stats_type: str) -> ExpenseFrame:
+        # Вся история трат для отчета (личные, семейные или все) в колоночном виде
+        ...
+
+    @abstractmethod
+    async def last_expenses(self, user_id, limit: int = 5, cursor: str = None):
+        # Возвращает (траты от новых к старым, курсор следующей страницы или None)
+        ...
+
+    # Бюджеты
+    @abstractmethod
+    async def get_budgets(self, user_id): ...
+
+    @abstractmethod
+    async def set_budget(self, user_id, category: str, amount: float): ...
+
+    # Семьи
+    @abstractmethod
+    async def family_of(self, user_id): ...
+
+    @abstractmethod
+    async def family_exists(self, family_id: str) -> bool: ...
+
+    @abstractmethod
+    async def create_family(self, family_id: str, user_id): ...
+
+    @abstractmethod
+    async def join_family(self, family_id: str, user_id): ...
+
+
+# Хранилище поверх Google Sheets: листы по user_id, family-*, budgets и families_list
+class SheetsRepository(Repository):
+    def __init__(self, spreadsheet=None, max_workers: int = 4, journal_path: str = "pending_rows.jsonl",
+                 flush_interval: float = 2.0, batch_size: int = 50, reconcile_interval: float = 600,
+                 rollups_path: str = "rollups.json", open_spreadsheet=None, archive_after_days: int = None,
+                 archive_interval: float = 3600, archive_batch: int = 500, quota_per_minute: float = None,
+                 quota_burst: float = None, quota_reserve: float = 0):
+        self.spreadsheet = spreadsheet
+        # Если таблица не передана, она открывается этой функцией в start()
+        self._open_spreadsheet = open_spreadsheet
+        # Кэш дескрипторов листов, чтобы не запрашивать метаданные таблицы на каждое обновление
+        self.registry = WorksheetRegistry(spreadsheet)
+        # Пул потоков для вызовов gspread с общей квотой запросов к API (None -- без ограничения)
+        self.sheets = SheetsExecutor(
+            max_workers=max_workers,
+            quota=QuotaGovernor(quota_per_minute, burst=quota_burst, reserve=quota_reserve),
+            registry=self.registry
+        )
+        self._layouts = {}  # title -> (заголовок, SheetLayout)
+        # Индекс членства в семьях (загружается при старте и сверяется с листом в фоне)
+        self.family_index = FamilyIndex()
+        self._family_lock = asyncio.Lock()  # Сверка индекса не пересекается с записью в families_list
+        # Очередь отложенной записи трат: строки уходят в таблицу пачками
+        self.write_queue = AppendQueue(
+            self._append_rows,
+            journal_path=journal_path,
+            flush_interval=flush_interval,
+            max_batch=batch_size
+        )
+        self.reconcile_interval = reconcile_interval
+        # Суммы по дням и категориям для отчетов без чтения листов
+        self.rollups = RollupStore(rollups_path)
+        self._rollup_builds = {}  # title -> фоновая задача сборки сводки
+        # Где лежит каждая трата (лист и строка), чтобы удалять и править ее без поиска
+        self.locator = ExpenseLocator()
+        # Бюджеты всех пользователей: читаются из листа один раз и обновляются при записи
+        self.budgets = BudgetStore()
+        self._budget_lock = asyncio.Lock()
+        # Строки старше archive_after_days дней переносятся в архивные листы по годам (None -- не переносятся)
+        self.archive_after_days = archive_after_days
+        self.archive_interval = archive_interval
+        self.archive_batch = archive_batch
+        self._archived_before = {}  # title -> дата, раньше которой строк в листе уже нет
+        # Удаление строк сдвигает номера остальных: удаление трат и архивация не пересекаются
+        self._rows_lock = asyncio.Lock()
+
+    ###
+    ### Листы
+    ###
+
+    def get_user_sheet(self, user_id):
+        try:
+            sheet = self.registry.get(str(user_id))
+            # Проверяем наличие колонки ID (один раз на лист)
+            return self.registry.ensure_id_column(sheet)
+        except gspread.WorksheetNotFound:
+            return self.registry.add(str(user_id), rows=100, cols=11, header=PERSONAL_HEADER)
+
+    # Лист со списком семей
+    def setup_families_list(self):
+        try:
+            return self.registry.get("families_list")
+        except gspread.WorksheetNotFound:
+            return self.registry.add("families_list", rows=100, cols=3, header=["family_id", "user_id", "role"])
+
+    def get_family_sheet(self, family_id):
+        try:
+            return self.registry.ensure_id_column(self.registry.get(family_sheet_title(family_id)))
+        except gspread.WorksheetNotFound:
+            return None
+
+    def get_budgets_sheet(self):
+        try:
+            return self.registry.get("budgets")
+        except gspread.WorksheetNotFound:
+            return self.registry.add("budgets", rows=100, cols=3, header=["user_id", "category", "budget"])
+
+    # Запись накопленной пачки строк в лист (вызывается очередью отложенной записи)
+    async def _append_rows(self, title: str, rows: list):
+        try:
+            sheet = await self.sheets.call(self.registry.get, title)
+        except gspread.WorksheetNotFound:
+            logger.error(f"Лист {title} не найден, строки отброшены: {len(rows)}")
+            return
+        response = await self.sheets.call(sheet.append_rows, rows)
+        first_row = self.registry.note_append(title, response)
+        if first_row:
+            self._remember_rows(title, first_row, rows)
+
+    # Запоминаем расположение прочитанных или записанных строк листа
+    def _remember_rows(self, title: str, first_row: int, rows, layout: SheetLayout = PERSONAL_LAYOUT):
+        for offset, values in enumerate(rows):
+            if values:
+                self.locator.put(title, first_row + offset, layout.expense_id(values))
+
+    # Раскладка колонок листа по его заголовку (заголовок читается один раз на лист).
+    # Если в заголовке нет нужных колонок, считаем раскладку стандартной
+    def _layout(self, sheet) -> SheetLayout:
+        header = tuple(self.registry.header(sheet))
+        cached = self._layouts.get(sheet.title)
+        if cached is None or cached[0] != header:
+            layout = SheetLayout(header)
+            if not layout.complete:
+                layout = SheetLayout.default(sheet.title)
+            cached = self._layouts[sheet.title] = (header, layout)
+        return cached[1]
+
+    # Номер последней заполненной строки листа (ищется по колонке дат его раскладки)
+    def _last_row(self, sheet) -> int:
+        return self.registry.last_row(sheet, self._layout(sheet).column("date"))
+
+    # Лист трат пользователя или семьи
+    def _expense_sheet(self, user_id, family_id=None):
+        if family_id:
+            return self.get_family_sheet(family_id)
+        return self.get_user_sheet(user_id)
+
+    # Строки листа за период [start, end] в его раскладке
+    def _read_period(self, sheet, start: str, end: str):
+        layout = self._layout(sheet)
+        first_row, rows = read_date_range(
+            sheet, start, end, date_column=layout.column("date"), last_column=layout.last_column
+        )
+        return layout, first_row, rows
+
+    # Траты листа за период: ищем границы периода по колонке дат
+    # и читаем только строки между ними, а не весь лист
+    async def _period_expenses(self, user_id, start_date, end_date, family_id=None):
+        sheet = await self.sheets.call(self._expense_sheet, user_id, family_id)
+        if not sheet:
+            return []
+
+        start = f"{start_date:%Y-%m-%d} 00:00:00"
+        end = f"{end_date:%Y-%m-%d} 23:59:59"
+        layout, first_row, rows = await self.sheets.call(self._read_period, sheet, start, end)
+        self._remember_rows(sheet.title, first_row, rows, layout)
+        expenses = layout.decode_all(rows, family_id, user_id)
+
+        # Строки очереди записаны в стандартной раскладке
+        expenses += [
+            expense
+            for expense in SheetLayout.default(sheet.title).decode_all(self.write_queue.pending(sheet.title), family_id, user_id)
+            if start <= expense.date <= end
+        ]
+
+        # Начало периода старше строк рабочего листа -- дочитываем архивы за годы периода
+        if start < self._archived_before.get(sheet.title, "9999"):
+            for archive in self._archive_titles(sheet.title, start_date.year, end_date.year):
+                archive_sheet = await self.sheets.call(self.registry.get, archive)
+                archive_layout, _, archive_rows = await self.sheets.call(self._read_period, archive_sheet, start, end)
+                expenses += archive_layout.decode_all(archive_rows, family_id, user_id)
+
+        unique = {}
+        for expense in expenses:
+            unique.setdefault(expense.id, expense)
+        return list(unique.values())
+
+    # Траты из полного содержимого листа (первая строка -- заголовок)
+    @staticmethod
+    def _decode_sheet(title: str, values, family_id=None, user_id=None):
+        layout = SheetLayout(values[0]) if values else SheetLayout.default(title)
+        if not layout.complete:
+            layout = SheetLayout.default(title)
+        return layout, layout.decode_all(values[1:], family_id, user_id)
+
+    # Все траты листов (вместе с архивами и еще не отправленными строками). Листы
+    # и их архивы читаются целиком одним запросом values_batch_get.
+    # sources -- [(название листа, family_id)]; возвращает {название листа: [трата]}
+    # pending -- {название листа: строки очереди}, снятые вызывающим; по умолчанию текущие
+    async def _read_expenses(self, user_id, sources, pending=None):
+        sources = [
+            (title, family_id) for title, family_id in sources
+            if await self.sheets.call(self._expense_sheet, user_id, family_id)  # Личный лист создается, если его нет
+        ]
+        titles = []
+        for title, _ in sources:
+            titles += self._archive_titles(title) + [title]
+        values = await self.sheets.call(batch_get_values, self.spreadsheet, [(title, None) for title in titles])
+        values = dict(zip(titles, values))
+
+        expenses = {}
+        for title, family_id in sources:
+            expenses[title] = []
+            for archive in self._archive_titles(title):
+                expenses[title] += self._decode_sheet(archive, values.get(archive, []), family_id, user_id)[1]
+            layout, sheet_expenses = self._decode_sheet(title, values.get(title, []), family_id, user_id)
+            self._remember_rows(title, 2, values.get(title, [])[1:], layout)
+            expenses[title] += sheet_expenses
+            rows = pending[title] if pending is not None else self.write_queue.pending(title)
+            expenses[title] += SheetLayout.default(title).decode_all(rows, family_id, user_id)
+        return expenses
+
+    # Пересборка сводок листов по их полному содержимому
+    async def _rebuild_rollups(self, user_id, sources):
+        # Пока читаем листы, очередь не сбрасывается (иначе строки могли бы уйти из очереди
+        # в лист уже после чтения и не попасть в сводку), а удаления, правки и архивация
+        # ждут _rows_lock. Строки очереди берутся на момент начала сборки; траты, записанные
+        # во время чтения, копит сводка и применяет после replace
+        expenses = {}
+        async with self._rows_lock, self.write_queue.hold():
+            pending = {title: self.write_queue.pending(title) for title, _ in sources}
+            for title, _ in sources:
+                self.rollups.begin_build(title)
+            try:
+                expenses = await self._read_expenses(user_id, sources, pending)
+            finally:
+                for title, _ in sources:
+                    if title not in expenses:
+                        self.rollups.cancel_build(title)
+        for title, sheet_expenses in expenses.items():
+            self.rollups.replace(title, ((e.date[:10], e.category, e.amount) for e in sheet_expenses))
+            logger.info(f"Сводка листа {title} пересобрана: {len(sheet_expenses)} трат")
+
+    async def rebuild_rollups(self):
+        # Восстановление всех сводок из листов (python bot.py rebuild-rollups)
+        for worksheet in await self.sheets.call(self.registry.refresh):
+            title = worksheet.title
+            if not is_expense_sheet(title):
+                continue  # Архивы читаются вместе со своим листом
+            try:
+                if title.isdigit():
+                    await self._rebuild_rollups(title, [(title, None)])
+                else:
+                    await self._rebuild_rollups(None, [(title, title[len("family-"):])])
+            except Exception as e:
+                logger.error(f"Ошибка пересборки сводки листа {title}: {e}")
+        self.rollups.save()
+
+    # Сводки собираются в фоне, чтобы полное чтение листов не задерживало ответ.
+    # Листы, которых еще нет в сборке, читаются одной задачей и одним запросом.
+    # Возвращает задачи, собирающие сводки всех переданных листов
+    def _schedule_rollups(self, user_id, sources):
+        missing = [(title, family_id) for title, family_id in sources if title not in self._rollup_builds]
+        if missing:
+            task = asyncio.create_task(self._rebuild_rollups(user_id, missing))
+            for title, _ in missing:
+                self._rollup_builds[title] = task
+
+            def done(task):
+                for title, _ in missing:
+                    if self._rollup_builds.get(title) is task:
+                        del self._rollup_builds[title]
+                if not task.cancelled() and task.exception():
+                    logger.error(f"Ошибка сборки сводок листов {[title for title, _ in missing]}: {task.exception()}")
+            task.add_done_callback(done)
+        return {self._rollup_builds[title] for title, _ in sources}
+
+    async def _save_rollups(self):
+        while True:
+            await asyncio.sleep(60)
+            try:
+                self.rollups.save()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения сводок: {e}")
+
+    ###
+    ### Жизненный цикл
+    ###
+
+    async def start(self):
+        if self.spreadsheet is None:
+            # Авторизация и открытие таблицы -- сетевые вызовы, поэтому не в конструкторе
+            self.spreadsheet = await self.sheets.call(self._open_spreadsheet)
+            self.registry.spreadsheet = self.spreadsheet
+        self.sheets.quota.install(self.spreadsheet.client)
+        await self.sheets.call(self.registry.refresh)  # Прогреваем кэш листов одним запросом
+        await self._load_family_index()
+        await self._load_budgets()
+        self.rollups.load()
+        self.write_queue.replay()  # Досылаем строки, оставшиеся в журнале после остановки
+
+    def background_tasks(self):
+        tasks = [self.write_queue.run(), self._reconcile_indexes(), self._save_rollups()]
+        if self.archive_after_days:
+            tasks.append(self._archive_loop())
+        return tasks
+
+    def pending_writes(self) -> int:
+        return len(self.write_queue)
+
+    def sheets_quota(self) -> dict:
+        return {**self.sheets.quota.usage(), "calls_in_flight": self.sheets.pending}
+
+    async def close(self):
+        await self.write_queue.flush()
+        self.rollups.close()
+        self.sheets.shutdown(wait=False)
+
+    async def _load_family_index(self):
+        families_list = await self.sheets.call(self.setup_families_list)
+        # Под блокировкой: иначе семья, созданная во время чтения, пропала бы из индекса до следующей сверки
+        async with self._family_lock:
+            self.family_index.load(await self.sheets.call(families_list.get_all_values))
+
+    async def _load_budgets(self):
+        budgets_sheet = await self.sheets.call(self.get_budgets_sheet)
+        async with self._budget_lock:
+            self.budgets.load(await self.sheets.call(budgets_sheet.get_all_values))
+
+    # Периодическая сверка индексов семей и бюджетов на случай ручной правки листов
+    async def _reconcile_indexes(self):
+        with background_priority():
+            while True:
+                await asyncio.sleep(self.reconcile_interval)
+                try:
+                    await self._load_family_index()
+                except Exception as e:
+                    logger.error(f"Ошибка сверки индекса семей: {e}")
+                try:
+                    await self._load_budgets()
+                except Exception as e:
+                    logger.error(f"Ошибка сверки бюджетов: {e}")
+
+    ###
+    ### Пользователи
+    ###
+
+    async def ensure_user(self, user_id):
+        await self.sheets.call(self.get_user_sheet, user_id)  # Создаем лист при первом обращении
+
+    async def last_expense_dates(self):
+        # Траты дописываются в конец листов, поэтому последняя строка листа -- последняя трата.
+        # Для семейного листа это дата только того участника, кто записал трату последним
+        dates = {}
+        for worksheet in await self.sheets.call(self.registry.refresh):
+            title = worksheet.title
+            if not is_expense_sheet(title):
+                continue
+            if title.isdigit():
+                dates.setdefault(title, "")
+            try:
+                pending = self.write_queue.pending(title)
+                if pending:
+                    expense = SheetLayout.default(title).decode(pending[-1])
+                else:
+                    last_row = await self.sheets.call(self._last_row, worksheet)
+                    layout, values = await self._read_row(worksheet, last_row)
+                    expense = layout.decode(values) if last_row >= 2 else None
+            except Exception as e:
+                logger.error(f"Ошибка чтения последней траты листа {title}: {e}")
+                continue
+
+            user_id = title if title.isdigit() else (expense.user_id if expense else "")
+            if user_id and expense:
+                dates[user_id] = max(dates.get(user_id, ""), expense.date)
+        return dates
+
+    ###
+    ### Траты
+    ###
+
+    async def add_expense(self, expense: Expense):
+        if expense.family_id:
+            family_sheet = await self.sheets.call(self.get_family_sheet, expense.family_id)
+            if not family_sheet:
+                logger.error("Лист семьи не найден!")
+                return False
+            row = [
+                expense.id, expense.date, expense.category, expense.amount,
+                expense.tags, "Семейная", str(expense.user_id), expense.comment
+            ]
+            self.write_queue.put(family_sheet.title, row)
+            self.rollups.add(family_sheet.title, expense.date[:10], expense.category, expense.amount)
+        else:
+            sheet = await self.sheets.call(self.get_user_sheet, expense.user_id)  # Лист должен существовать до сброса очереди
+            row = [
+                expense.id, expense.date, expense.category, expense.amount,
+                expense.tags, "Личная", expense.comment
+            ]
+            self.write_queue.put(sheet.title, row)
+            self.rollups.add(sheet.title, expense.date[:10], expense.category, expense.amount)
+        return True
+
+    # Одна строка листа: (раскладка листа, значения строки)
+    async def _read_row(self, sheet, row: int):
+        layout = await self.sheets.call(self._layout, sheet)
+        if row < 2:
+            return layout, []
+        values = await self.sheets.call(
+            sheet.get, f"A{row}:{layout.last_column}{row}", value_render_option=ValueRenderOption.unformatted
+        )
+        return layout, values[0] if values else []
+
+    # Ищет строку траты в личном листе и в листе семьи. Известное расположение
+    # проверяется чтением одной строки; поиск по листам -- только если индекс
+    # не знает трату или лист правили вручную.
+    # Возвращает (тип, лист, раскладка листа, номер строки, значения строки)
+    async def _locate(self, user_id, expense_id: str):
+        sources = [("personal", await self.sheets.call(self.get_user_sheet, user_id))]
+        family_id = self.family_index.family_of(user_id)
+        family_sheet = await self.sheets.call(self.get_family_sheet, family_id) if family_id else None
+        if family_sheet:
+            sources.append(("family", family_sheet))
+
+        location = self.locator.get(expense_id)
+        if location:
+            title, row = location
+            for kind, sheet in sources:
+                if sheet.title == title:
+                    layout, values = await self._read_row(sheet, row)
+                    if layout.expense_id(values) == expense_id:
+                        cache_lookup("locator", True)
+                        return kind, sheet, layout, row, values
+            self.locator.forget(expense_id)
+        cache_lookup("locator", False)  # Трату ищем по колонке ID
+
+        for kind, sheet in sources:
+            layout = await self.sheets.call(self._layout, sheet)
+            if layout.id is None:
+                continue
+            cell = await self.sheets.call(sheet.find, expense_id, in_column=layout.id + 1)
+            if cell:
+                self.locator.put(sheet.title, cell.row, expense_id)
+                _, values = await self._read_row(sheet, cell.row)
+                return kind, sheet, layout, cell.row, values
+        return None, None, None, None, None
+
+    # Трата еще в очереди: досылаем ее, чтобы править уже строку листа
+    async def _flush_if_pending(self, expense_id: str):
+        if expense_id in self.write_queue:
+            await self.write_queue.flush()
+
+    async def delete_expense(self, user_id, expense_id: str):
+        # Трата могла еще не дойти до таблицы. Очередь удерживается, чтобы строка не ушла
+        # в лист между проверкой и удалением: если ее пачка уже отправляется, дожидаемся
+        # отправки и удаляем строку уже из листа
+        async with self.write_queue.hold():
+            discarded = self.write_queue.discard(expense_id)
+        if discarded:
+            title, values = discarded
+            if key := SheetLayout.default(title).rollup_key(values):
+                self.rollups.remove(title, *key)
+            return "family" if title.startswith("family-") else "personal"
+
+        async with self._rows_lock:
+            kind, sheet, layout, row, values = await self._locate(user_id, expense_id)
+            if kind:
+                await self.sheets.call(sheet.delete_rows, row)
+                self.registry.note_delete(sheet.title)
+                self.locator.note_delete(sheet.title, row)
+        if kind and (key := layout.rollup_key(values)):
+            self.rollups.remove(sheet.title, *key)
+        return kind
+
+    async def update_expense(self, user_id, expense_id: str, field: str, value) -> bool:
+        await self._flush_if_pending(expense_id)
+        async with self._rows_lock:
+            kind, sheet, layout, row, old_values = await self._locate(user_id, expense_id)
+            column = layout.column_number(field) if kind else None
+            if not column:
+                return False
+            await self.sheets.call(sheet.update_cell, row, column, value)
+
+        # Категория и сумма участвуют в сводке -- переносим трату в новую корзину
+        old_key = layout.rollup_key(old_values)
+        if field in ("category", "amount") and old_key:
+            day, category, amount = old_key
+            self.rollups.remove(sheet.title, day, category, amount)
+            if field == "category":
+                category = value
+            else:
+                amount = float(value)
+            self.rollups.add(sheet.title, day, category, amount)
+        return True
+
+    # Листы, из которых собирается отчет: [(название, family_id)]
+    def _stats_sources(self, user_id, stats_type: str):
+        sources = []
+
+        # Личные траты
+        if stats_type in ["stats_personal", "stats_all"]:
+            sources.append((str(user_id), None))
+
+        # Семейные траты
+        if stats_type in ["stats_family", "stats_all"]:
+            family_id = self.family_index.family_of(user_id)
+            if family_id:
+                sources.append((family_sheet_title(family_id), family_id))
+        return sources
+
+    async def category_totals(self, user_id, stats_type: str, start_date, end_date):
+        stats = defaultdict(float)
+        for title, family_id in self._stats_sources(user_id, stats_type):
+            cache_lookup("rollups", self.rollups.has(title))
+            if self.rollups.has(title):
+                for category, amount in self.rollups.totals(title, start_date, end_date).items():
+                    stats[category] += amount
+                continue
+
+            # Сводки еще нет: отвечаем по строкам периода, а сводку собираем в фоне
+            for expense in await self._period_expenses(user_id, start_date, end_date, family_id):
+                stats[expense.category] += expense.amount
+            self._schedule_rollups(user_id, [(title, family_id)])
+        return stats
+
+    async def expense_frame(self, user_id, stats_type: str) -> ExpenseFrame:
+        sources = self._stats_sources(user_id, stats_type)
+        missing = []
+        for title, family_id in sources:
+            cache_lookup("rollups", self.rollups.has(title))
+            if not self.rollups.has(title):
+                missing.append((title, family_id))
+        if missing:
+            # Отчет может охватывать всю историю -- здесь сводки приходится дождаться
+            for task in self._schedule_rollups(user_id, missing):
+                await asyncio.shield(task)
+        return ExpenseFrame.concat([self.rollups.frame(title) for title, _ in sources])
+
+    # Последние строки листа, начиная со строки end и вверх. Неотправленные строки
+    # очереди считаются продолжением листа (строки last_row + 1, ...): после сброса
+    # они займут ровно эти номера, поэтому курсор страниц остается верным.
+    # Возвращает (раскладка, первая строка, последняя строка, последняя строка листа,
+    # диапазон листа для чтения или None, если все строки -- из очереди)
+    def _tail_range(self, sheet, end, limit: int, pending_count: int):
+        layout = self._layout(sheet)
+        last_row = self._last_row(sheet)
+        total = last_row + pending_count
+        end = total if end is None else min(end, total)
+        start = max(2, end - limit + 1)
+        a1 = f"A{start}:{layout.last_column}{min(end, last_row)}" if start <= min(end, last_row) else None
+        return layout, start, end, last_row, a1
+
+    # Разбор прочитанного хвоста листа: список (номер строки, трата) от новых к старым
+    def _decode_tail(self, sheet, tail_range, values, user_id, family_id=None):
+        layout, start, end, last_row, a1 = tail_range
+        if end < start:
+            return []
+
+        # Строки листа разбираются по его раскладке, строки очереди -- по стандартной
+        rows = []
+        if a1:
+            self._remember_rows(sheet.title, start, values, layout)
+            rows += [(layout, row_values) for row_values in values]
+            rows += [(layout, [])] * (min(end, last_row) - start + 1 - len(values))  # Пустые строки в конце диапазона
+        if end > last_row:
+            default = SheetLayout.default(sheet.title)
+            pending = self.write_queue.pending(sheet.title)
+            rows += [(default, row_values) for row_values in pending[max(0, start - last_row - 1):end - last_row]]
+
+        tail = []
+        for offset, (row_layout, row_values) in enumerate(rows):
+            expense = row_layout.decode(row_values, family_id, user_id)
+            if expense:
+                tail.append((start + offset, expense))
+        tail.reverse()
+        return tail
+
+    async def last_expenses(self, user_id, limit: int = 5, cursor: str = None):
+        # Курсор -- номера строк, с которых продолжать чтение: "p<личный>f<семейный>"
+        ends = {"p": None, "f": None}
+        if cursor:
+            match = re.fullmatch(r"p(\d+)(?:f(\d+))?", cursor)
+            if not match:
+                return [], None
+            ends = {"p": int(match.group(1)), "f": int(match.group(2)) if match.group(2) else 0}
+
+        sources = [("p", await self.sheets.call(self.get_user_sheet, user_id), None)]
+        family_id = self.family_index.family_of(user_id)
+        family_sheet = await self.sheets.call(self.get_family_sheet, family_id) if family_id else None
+        if family_sheet:
+            sources.append(("f", family_sheet, family_id))
+
+        # С каждого листа берем не больше limit последних строк (все листы -- одним запросом
+        # values_batch_get) и сливаем их кучей. Пока читаем, очередь не сбрасывается,
+        # чтобы номера строк не сдвинулись
+        streams = {}
+        async with self.write_queue.hold():
+            plans = []
+            for key, sheet, source_family in sources:
+                if ends[key] is not None and ends[key] < 2:
+                    continue  # Этот лист уже прочитан до конца
+                pending_count = len(self.write_queue.pending(sheet.title))
+                plans.append((key, sheet, source_family, await self.sheets.call(
+                    self._tail_range, sheet, ends[key], limit, pending_count
+                )))
+
+            ranges = [(sheet.title, tail_range[4]) for _, sheet, _, tail_range in plans if tail_range[4]]
+            values = iter(await self.sheets.call(batch_get_values, self.spreadsheet, ranges))
+            for key, sheet, source_family, tail_range in plans:
+                rows = next(values) if tail_range[4] else []
+                tail = self._decode_tail(sheet, tail_range, rows, user_id, source_family)
+                streams[key] = tail
+                # Если на странице нет ни одной траты, следующая начинается над ней
+                ends[key] = tail[0][0] if tail else tail_range[1] - 1
+
+        merged = heapq.merge(
+            *[[(expense.date, row, key, expense) for row, expense in tail] for key, tail in streams.items()],
+            key=lambda item: item[0],
+            reverse=True
+        )
+        expenses = []
+        for _, row, key, expense in islice(merged, limit):
+            expenses.append(expense)
+            ends[key] = row - 1
+
+        # Следующая страница есть, если хоть в одном листе остались строки выше прочитанных
+        if all(end is None or end < 2 for end in ends.values()):
+            return expenses, None
+        next_cursor = f"p{ends['p'] or 0}"
+        if family_sheet:
+            next_cursor += f"f{ends['f'] or 0}"
+        return expenses, next_cursor
+
+    ###
+    ### Архив
+    ###
+
+    # Архивы листа (все или за годы first_year..last_year) в порядке лет
+    def _archive_titles(self, title: str, first_year: int = None, last_year: int = None):
+        archives = []
+        for candidate in self.registry.titles():
+            match = ARCHIVE_TITLE.fullmatch(candidate)
+            if not match or match.group(1) != title:
+                continue
+            year = int(match.group(2))
+            if (first_year is None or year >= first_year) and (last_year is None or year <= last_year):
+                archives.append((year, candidate))
+        return [candidate for _, candidate in sorted(archives)]
+
+    # Архив создается с заголовком исходного листа, чтобы строки переносились как есть
+    def _get_archive_sheet(self, title: str, year: str, header):
+        try:
+            return self.registry.get(archive_sheet_title(title, year))
+        except gspread.WorksheetNotFound:
+            return self.registry.add(archive_sheet_title(title, year), rows=100, cols=len(header), header=header)
+
+    # Переносит в архив одну пачку самых старых строк листа (дата раньше cutoff).
+    # Сначала строки дописываются в архив, затем удаляются из листа; если процесс
+    # прервался между этими шагами, при повторе уже перенесенные строки узнаются
+    # по ID в хвосте архива и не дублируются. Возвращает число перенесенных строк
+    async def _archive_batch(self, title: str, cutoff: str) -> int:
+        sheet = await self.sheets.call(self.registry.get, title)
+        async with self._rows_lock:
+            layout = await self.sheets.call(self._layout, sheet)
+            if layout.id is None:
+                return 0  # Без колонки ID повторный проход не отличит перенесенные строки
+            stop = await self.sheets.call(
+                first_row_where, sheet, layout.column("date"), lambda value: value == "" or value >= cutoff
+            )
+            last = min(stop - 1, self.archive_batch + 1)
+            if last < 2:
+                return 0
+            rows = await self.sheets.call(
+                sheet.get, f"A2:{layout.last_column}{last}", value_render_option=ValueRenderOption.unformatted
+            )
+
+            by_year = defaultdict(list)
+            for offset, values in enumerate(rows):
+                expense = layout.decode(values)
+                if expense is None:
+                    # Нераспознанную строку оставляем на месте вместе со всеми после нее
+                    logger.warning(f"Строка {offset + 2} листа {title} не архивируется: {values}")
+                    last = offset + 1
+                    break
+                by_year[expense.date[:4]].append(values)
+            if last < 2:
+                return 0
+
+            header = await self.sheets.call(self.registry.header, sheet)
+            id_column = layout.column("id")
+            for year, year_rows in by_year.items():
+                archive = await self.sheets.call(self._get_archive_sheet, title, year, header)
+                archive_last = await self.sheets.call(self._last_row, archive)
+                archived = set()
+                if archive_last >= 2:
+                    tail = await self.sheets.call(
+                        archive.get, f"{id_column}{max(2, archive_last - len(year_rows) + 1)}:{id_column}{archive_last}"
+                    )
+                    archived = {str(values[0]) for values in tail if values}
+                year_rows = [values for values in year_rows if layout.expense_id(values) not in archived]
+                if year_rows:
+                    response = await self.sheets.call(archive.append_rows, year_rows)
+                    self.registry.note_append(archive.title, response)
+
+            # Сброс очереди ждет: иначе append_rows мог бы пройти во время удаления, и номер
+            # последней строки и строки новых трат в локаторе сдвинулись бы на last - 1
+            async with self.write_queue.hold():
+                await self.sheets.call(sheet.delete_rows, 2, last)
+                self.registry.note_delete(title, last - 1)
+                self.locator.note_delete(title, 2, last - 1)
+        return last - 1
+
+    # Один проход архивации по всем листам трат. Идет пачками, поэтому его можно
+    # прервать в любой момент: следующий проход продолжит с того же места
+    async def archive_old_rows(self):
+        cutoff = f"{datetime.now() - timedelta(days=self.archive_after_days):%Y-%m-%d} 00:00:00"
+        moved = 0
+        for title in self.registry.titles():
+            if not is_expense_sheet(title):
+                continue
+            try:
+                while count := await self._archive_batch(title, cutoff):
+                    moved += count
+                    logger.info(f"В архив листа {title} перенесено строк: {count}")
+            except Exception as e:
+                logger.error(f"Ошибка архивации листа {title}: {e}")
+                continue
+            self._archived_before[title] = cutoff
+        return moved
+
+    async def _archive_loop(self):
+        with background_priority():
+            while True:
+                await asyncio.sleep(self.archive_interval)
+                try:
+                    await self.archive_old_rows()
+                except Exception as e:
+                    logger.error(f"Ошибка архивации: {e}")
+
+    ###
+    ### Бюджеты
+    ###
+
+    async def get_budgets(self, user_id):
+        if not self.budgets.loaded:
+            await self._load_budgets()
+        return self.budgets.budgets_of(user_id)
+
+    async def set_budget(self, user_id, category: str, amount: float):
+        if not self.budgets.loaded:
+            await self._load_budgets()
+        budgets_sheet = await self.sheets.call(self.get_budgets_sheet)
+        values = [str(user_id), category, amount]
+
+        async with self._budget_lock:
+            row = self.budgets.row_of(user_id, category)
+            if row:
+                # Бюджет уже есть -- перезаписываем его строку на месте
+                await self.sheets.call(budgets_sheet.update, f"A{row}:C{row}", [values])
+            else:
+                response = await self.sheets.call(budgets_sheet.append_row, values)
+                row = self.registry.note_append(budgets_sheet.title, response)
+
+        if row:
+            self.budgets.set(user_id, category, amount, row)
+        else:
+            await self._load_budgets()  # Не смогли определить строку -- перечитываем лист
+
+    ###
+    ### Семьи
+    ###
+
+    async def family_of(self, user_id):
+        return self.family_index.family_of(user_id)
+
+    async def family_exists(self, family_id: str) -> bool:
+        return self.family_index.exists(family_id)
+
+    async def create_family(self, family_id: str, user_id):
+        # Создание листа для семьи
+        await self.sheets.call(
+            self.registry.add, family_sheet_title(family_id), rows=100, cols=10, header=FAMILY_HEADER
+        )
+        # Добавляем создателя семьи в families_list
+        families_list = await self.sheets.call(self.setup_families_list)
+        async with self._family_lock:
+            await self.sheets.call(families_list.append_row, [family_id, str(user_id), "creator"])
+            self.family_index.add(family_id, user_id, "creator")
+
+    async def join_family(self, family_id: str, user_id):
+        families_list = await self.sheets.call(self.setup_families_list)
+        async with self._family_lock:
+            await self.sheets.call(families_list.append_row, [family_id, str(user_id), "member"])
+            self.family_index.add(family_id, user_id, "member")
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import timedelta
+from analytics import ExpenseFrame
+from metrics import cache_lookup
+
+logger = logging.getLogger(__name__)
+
+
+# Суммы трат по ключу (владелец, день, категория). Владелец -- название листа
+# (личный лист пользователя или лист семьи). Обновляется при каждой записи и удалении,
+# поэтому отчет за неделю или месяц -- это сложение нескольких корзин, а не чтение листа.
+class RollupStore:
+    def __init__(self, path: str = "rollups.json"):
+        self.path = path
+        self._owners = {}  # owner -> {day: {category: amount}}
+        self._frames = {}  # owner -> ExpenseFrame, сбрасывается при изменении сводки
+        self._building = {}  # owner -> [(день, категория, сумма)], изменения во время сборки
+        self._dirty = False
+
+    @property
+    def _marker_path(self) -> str:
+        return self.path + ".open"
+
+    def load(self):
+        # Метка лежит рядом со снимком, пока процесс работает, и удаляется в close().
+        # Если она осталась от прошлого запуска, процесс упал: снимок мог отстать от
+        # листов или разойтись с журналом очереди записи (строки из него досылаются
+        # повторно), поэтому сводки не загружаются и собираются из листов заново
+        unclean = os.path.exists(self._marker_path)
+        open(self._marker_path, "w").close()
+        if unclean:
+            logger.warning(f"Предыдущий запуск не сохранил сводки при остановке, {self.path} будет пересобран")
+            self._owners = {}
+            self._frames.clear()
+            self._dirty = True
+            return
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._owners = json.load(f)
+        except ValueError as e:
+            # Поврежденный снимок просто пересобирается из листов по мере обращения
+            logger.error(f"Не удалось прочитать {self.path}: {e}")
+            self._owners = {}
+        self._frames.clear()
+        logger.info(f"Загружены сводки для {len(self._owners)} листов")
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._owners, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    # Сохранение при штатной остановке: после него снимку можно верить при следующем запуске
+    def close(self):
+        self.save()
+        if os.path.exists(self._marker_path):
+            os.remove(self._marker_path)
+
+    def has(self, owner: str) -> bool:
+        return owner in self._owners
+
+    def owners(self):
+        return list(self._owners)
+
+    def add(self, owner: str, day: str, category: str, amount: float):
+        if owner in self._building:
+            self._building[owner].append((day, category, amount))
+            return
+        # Незагруженного владельца пропускаем: его сводка будет собрана целиком при первом отчете
+        days = self._owners.get(owner)
+        if days is None:
+            return
+        self._frames.pop(owner, None)
+        categories = days.setdefault(day, {})
+        total = categories.get(category, 0.0) + amount
+        if abs(total) < 1e-9:
+            categories.pop(category, None)
+            if not categories:
+                del days[day]
+        else:
+            categories[category] = total
+        self._dirty = True
+
+    def remove(self, owner: str, day: str, category: str, amount: float):
+        self.add(owner, day, category, -amount)
+
+    # Сборка сводки по содержимому листа. Между begin_build и replace (или cancel_build)
+    # изменения владельца копятся и применяются поверх собранной сводки: прочитанное
+    # содержимое листа их еще не включает
+    def begin_build(self, owner: str):
+        self._building[owner] = []
+
+    def cancel_build(self, owner: str):
+        self._building.pop(owner, None)
+
+    def replace(self, owner: str, rows):
+        # rows -- итерируемое из (день, категория, сумма)
+        days = defaultdict(lambda: defaultdict(float))
+        for day, category, amount in rows:
+            days[day][category] += amount
+        self._owners[owner] = {day: dict(categories) for day, categories in days.items()}
+        self._frames.pop(owner, None)
+        self._dirty = True
+        for change in self._building.pop(owner, []):
+            self.add(owner, *change)
+
+    def drop(self, owner: str):
+        self._frames.pop(owner, None)
+        if self._owners.pop(owner, None) is not None:
+            self._dirty = True
+
+    def totals(self, owner: str, start_date, end_date):
+        stats = defaultdict(float)
+        days = self._owners.get(owner, {})
+        day = start_date
+        while day <= end_date:
+            for category, amount in days.get(day.strftime("%Y-%m-%d"), {}).items():
+                stats[category] += amount
+            day += timedelta(days=1)
+        return stats
+
+    # Вся история владельца в колоночном виде для отчетов за произвольные периоды
+    def frame(self, owner: str) -> ExpenseFrame:
+        frame = self._frames.get(owner)
+        cache_lookup("frames", frame is not None)
+        if frame is None:
+            frame = ExpenseFrame.from_rows(
+                (day, category, amount)
+                for day, categories in self._owners.get(owner, {}).items()
+                for category, amount in categories.items()
+            )
+            self._frames[owner] = frame
+        return frame
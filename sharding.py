@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import multiprocessing
+import queue as queue_module
+import signal
+import time
+from functools import partial
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+# Пользователь, от которого пришел апдейт (message.from, callback_query.from, ...).
+# Апдейты без пользователя (например, channel_post) идут по чату
+def update_user_id(update: dict):
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user") or event.get("chat") or {}
+        if "id" in user:
+            return user["id"]
+    return None
+
+
+def shard_of(user_id, workers: int) -> int:
+    return int(user_id) % workers if user_id is not None else 0
+
+
+# Последовательная обработка апдейтов одного пользователя внутри процесса:
+# апдейты разных пользователей обрабатываются конкурентно, а апдейты одного --
+# строго в порядке поступления (на этом держится пошаговая запись траты)
+class UserSerialFeeder:
+    def __init__(self, feed):
+        self._feed = feed  # async (update: dict) -> None
+        self._tails = {}  # user_id -> задача последнего апдейта пользователя
+
+    def __len__(self):
+        return len(self._tails)
+
+    def submit(self, user_id, update: dict):
+        previous = self._tails.get(user_id)
+
+        async def run():
+            if previous is not None:
+                await asyncio.wait([previous])
+            try:
+                await self._feed(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}")
+
+        task = asyncio.create_task(run())
+        self._tails[user_id] = task
+
+        def done(task):
+            if self._tails.get(user_id) is task:
+                del self._tails[user_id]
+        task.add_done_callback(done)
+        return task
+
+    async def drain(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+# Передний процесс: получает апдейты (long polling или вебхук) и раскладывает их
+# по очередям рабочих процессов по user_id. Следит за рабочими: перезапускает
+# упавшие и зависшие (давно не обновлявшие heartbeat).
+class ShardSupervisor:
+    def __init__(self, target, workers: int = 4, heartbeat_timeout: float = 60.0,
+                 check_interval: float = 5.0, queue_size: int = 1000):
+        self._ctx = multiprocessing.get_context("spawn")  # Чистый интерпретатор без унаследованного цикла событий
+        self.target = target  # Функция рабочего: (номер, число рабочих, очередь, heartbeats)
+        self.workers = workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.check_interval = check_interval
+        self.queue_size = queue_size
+        self.queues = [self._ctx.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.heartbeats = self._ctx.Array("d", workers)  # Время последнего heartbeat каждого рабочего
+        self.processes = [None] * workers
+        self.restarts = [0] * workers
+        self.routed = [0] * workers
+
+    def _spawn(self, shard: int):
+        self.heartbeats[shard] = time.time()  # Даем время на запуск
+        process = self._ctx.Process(
+            target=self.target,
+            args=(shard, self.workers, self.queues[shard], self.heartbeats),
+            name=f"worker-{shard}",
+            daemon=False
+        )
+        process.start()
+        self.processes[shard] = process
+        logger.info(f"Запущен рабочий процесс {shard} (pid {process.pid})")
+
+    def start(self):
+        for shard in range(self.workers):
+            self._spawn(shard)
+
+    async def route(self, update: dict):
+        shard = shard_of(update_user_id(update), self.workers)
+        self.routed[shard] += 1
+        while True:
+            # Очередь перечитывается на каждой попытке: при перезапуске рабочего она заменяется
+            queue = self.queues[shard]
+            try:
+                queue.put_nowait(update)
+                return
+            except queue_module.Full:
+                pass
+            # Очередь рабочего заполнена -- ждем в потоке, не блокируя цикл событий
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, partial(queue.put, update, timeout=1.0))
+                return
+            except queue_module.Full:
+                continue
+
+    def _replace_queue(self, shard: int):
+        # Убитый процесс мог держать внутреннюю блокировку чтения очереди (рабочий ждет
+        # в queue.get), и новый рабочий ждал бы на ней вечно. Поэтому у перезапущенного
+        # рабочего новая очередь, а апдейты, оставшиеся в старой, теряются
+        old = self.queues[shard]
+        try:
+            backlog = old.qsize()
+        except NotImplementedError:
+            backlog = "?"
+        self.queues[shard] = self._ctx.Queue(maxsize=self.queue_size)
+        old.cancel_join_thread()  # Иначе выход переднего процесса ждал бы отправки в очередь без читателя
+        old.close()
+        logger.warning(f"Очередь рабочего {shard} заменена, потеряно апдейтов: {backlog}")
+
+    def check(self):
+        now = time.time()
+        for shard, process in enumerate(self.processes):
+            if process is None:
+                continue
+            if not process.is_alive():
+                logger.error(f"Рабочий процесс {shard} завершился с кодом {process.exitcode}, перезапускаем")
+            elif now - self.heartbeats[shard] > self.heartbeat_timeout:
+                logger.error(f"Рабочий процесс {shard} не отвечает {now - self.heartbeats[shard]:.0f} с, перезапускаем")
+                process.kill()
+                process.join()
+            else:
+                continue
+            self.restarts[shard] += 1
+            self._replace_queue(shard)
+            self._spawn(shard)
+
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            self.check()
+
+    def status(self):
+        now = time.time()
+        return {
+            f"worker_{shard}": {
+                "alive": bool(process and process.is_alive()),
+                "heartbeat_age": round(now - self.heartbeats[shard], 1),
+                "routed": self.routed[shard],
+                "restarts": self.restarts[shard],
+            }
+            for shard, process in enumerate(self.processes)
+        }
+
+    def stop(self, timeout: float = 60.0):
+        # Пустое значение в очереди -- сигнал рабочему дообработать свое и завершиться
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.time() + timeout
+        for shard, process in enumerate(self.processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.time()))
+            if process.is_alive():
+                logger.warning(f"Рабочий процесс {shard} не завершился вовремя, останавливаем принудительно")
+                process.terminate()
+                process.join()
+
+
+# Прием апдейтов long polling'ом в переднем процессе
+async def poll_updates(bot, supervisor: ShardSupervisor, allowed_updates):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка получения апдейтов: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            await supervisor.route(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+            offset = update.update_id + 1
+
+
+# Прием апдейтов вебхуком в переднем процессе: проверка секрета и раскладка по рабочим
+def create_front_app(supervisor: ShardSupervisor, settings) -> web.Application:
+    secret = getattr(settings, "WEBHOOK_SECRET", None)
+
+    async def handle(request):
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token", "") != secret:
+            return web.Response(body="Unauthorized", status=401)
+        await supervisor.route(await request.json())
+        return web.json_response({})
+
+    async def health_check(request):
+        status = supervisor.status()
+        healthy = all(worker["alive"] for worker in status.values())
+        return web.json_response({"status": "ok" if healthy else "degraded", **status}, status=200 if healthy else 503)
+
+    app = web.Application()
+    app.router.add_post(getattr(settings, "WEBHOOK_PATH", "/webhook"), handle)
+    app.router.add_get("/health", health_check)
+    return app
@@ -0,0 +1,461 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import gspread
+from gspread.utils import ValueRenderOption, absolute_range_name
+from metrics import cache_lookup, registry as metrics
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+sheets_requests = metrics.counter(
+    "bot_sheets_requests_total", "HTTP-запросы к Google Sheets API по вызову и типу листа", ("method", "worksheet")
+)
+sheets_call_seconds = metrics.histogram(
+    "bot_sheets_call_seconds", "Вызовы таблицы целиком: ожидание квоты и потока пула и все их запросы", ("method",)
+)
+sheets_retries = metrics.counter("bot_sheets_retries_total", "Повторы запросов после ответов 429 и 5xx", ("status",))
+quota_wait_seconds = metrics.histogram("bot_sheets_quota_wait_seconds", "Ожидание токена квоты", ("priority",))
+
+
+# Тип листа для меток метрик: названия листов пользователей и семей не подходят --
+# у каждого пользователя свой лист, и рядов в Prometheus стало бы по числу пользователей
+def worksheet_kind(title: str) -> str:
+    if re.fullmatch(r"\d+", title):
+        return "personal"
+    if re.search(r"-\d{4}$", title):
+        return "archive"
+    if title.startswith("family-"):
+        return "family"
+    return title
+
+
+# Метки вызова пула: имя функции gspread (или хранилища) и тип листа, с которым она работает
+def call_labels(func, args) -> tuple:
+    method = getattr(func, "__name__", type(func).__name__)
+    owner = getattr(func, "__self__", None)
+    if not isinstance(owner, gspread.Worksheet):
+        owner = next((arg for arg in args if isinstance(arg, gspread.Worksheet)), None)
+    return method, worksheet_kind(owner.title) if owner is not None else "-"
+
+
+# Классы приоритета запросов к таблице. По умолчанию вызовы считаются запросами
+# пользователей; фоновые задачи (сверка индексов, архивация, зеркало SQLite) работают
+# в background_priority() и пропускают вперед всех, кто ждет квоту
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BACKGROUND: "background"}
+
+_priority = contextvars.ContextVar("sheets_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def background_priority():
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+# Квота Google Sheets API на всю таблицу: ведро токенов на requests_per_minute HTTP-запросов
+# в минуту и повтор ответов 429/5xx с экспоненциальной задержкой со случайным разбросом.
+# Токен берется до вызова в пуле, а после него списываются запросы, которые вызов
+# сделал на самом деле (вызовы, обслуженные из кэшей, токен возвращают). Фоновые вызовы
+# не берут последние reserve токенов, оставляя их запросам пользователей.
+# requests_per_minute=None -- без ограничения, только повторы и счетчики
+class QuotaGovernor:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, requests_per_minute: float = None, burst: float = None, reserve: float = 0,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 64.0):
+        self.requests_per_minute = requests_per_minute
+        self.bucket = None
+        self.reserve = 0
+        if requests_per_minute:
+            self.bucket = TokenBucket(requests_per_minute / 60, burst or max(1.0, requests_per_minute / 6))
+            self.reserve = max(0.0, min(reserve, self.bucket.capacity - 1))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._waiting = []  # Куча (приоритет, порядковый номер) вызовов, ждущих токен
+        self._order = itertools.count()
+        self._changed = asyncio.Condition()
+        self._loop = None
+        self._local = threading.local()  # Счетчик HTTP-запросов текущего вызова в потоке пула
+        self._clients = []
+        self._recent = deque()  # Время отправки запросов за последнюю минуту
+        self.requests = 0
+        self.delayed = {name: 0 for name in PRIORITY_NAMES.values()}  # Вызовы, ждавшие квоту
+        self.rate_limited = 0  # Ответы 429
+        self.server_errors = 0  # Ответы 5xx
+        self.retries = 0
+
+    async def acquire(self, priority: int = INTERACTIVE):
+        self._loop = asyncio.get_running_loop()
+        if self.bucket is None:
+            return
+
+        entry = (priority, next(self._order))
+        reserve = self.reserve if priority > INTERACTIVE else 0
+        started = time.monotonic()
+        async with self._changed:
+            heapq.heappush(self._waiting, entry)
+            try:
+                delayed = False
+                while True:
+                    # Токен берет только первый в очереди приоритетов, остальные ждут его ухода
+                    delay = self.bucket.try_acquire(reserve) if self._waiting[0] == entry else None
+                    if delay == 0:
+                        break
+                    delayed = True
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                if delayed:
+                    self.delayed[PRIORITY_NAMES[priority]] += 1
+                quota_wait_seconds.observe(time.monotonic() - started, PRIORITY_NAMES[priority])
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._changed.notify_all()
+
+    def run(self, func, labels=("-", "-")):
+        # Выполняется в потоке пула после acquire(): один токен уже взят, остальные
+        # запросы вызова списываются по факту. labels -- метки запросов для метрик
+        self._local.requests = 0
+        self._local.labels = labels
+        try:
+            return func()
+        finally:
+            extra = self._local.requests - 1
+            if self.bucket is not None and extra and self._loop is not None:
+                self._loop.call_soon_threadsafe(self.bucket.spend, extra)
+
+    def install(self, client):
+        # Все HTTP-запросы gspread проходят через client.request: здесь они считаются
+        # и повторяются при превышении квоты и ошибках сервера
+        if any(installed is client for installed in self._clients):
+            return
+        self._clients.append(client)
+        request = client.request
+
+        def governed_request(*args, **kwargs):
+            for attempt in itertools.count():
+                self._count_request()
+                try:
+                    return request(*args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    status = getattr(e.response, "status_code", None)
+                    if status not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                        raise
+                    time.sleep(self._backoff(attempt, status, e.response))
+
+        client.request = governed_request
+
+    def _count_request(self):
+        self._local.requests = getattr(self._local, "requests", 0) + 1
+        sheets_requests.inc(*getattr(self._local, "labels", ("-", "-")))
+        self._recent.append(time.monotonic())
+        self.requests += 1
+
+    def _backoff(self, attempt: int, status: int, response) -> float:
+        # Задержка 2^attempt секунд (не больше max_delay) со случайным разбросом в ее половину,
+        # чтобы одновременно отклоненные запросы не вернулись разом. Retry-After сервера -- нижняя граница
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        retry_after = str(getattr(response, "headers", {}).get("Retry-After", ""))
+        if retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+
+        self.retries += 1
+        sheets_retries.inc(str(status))
+        if status == 429:
+            self.rate_limited += 1
+            # Квота общая: останавливаем выдачу токенов всем, а не только этому вызову
+            if self.bucket is not None and self._loop is not None:
+                self._loop.call_soon_threadsafe(self.bucket.pause, delay)
+        else:
+            self.server_errors += 1
+        logger.warning(f"Google Sheets ответил {status}, повтор через {delay:.1f} с (попытка {attempt + 1})")
+        return delay
+
+    def usage(self) -> dict:
+        horizon = time.monotonic() - 60
+        while self._recent and self._recent[0] < horizon:
+            self._recent.popleft()
+        waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _ in self._waiting:
+            waiting[PRIORITY_NAMES[priority]] += 1
+        return {
+            "limit_per_minute": self.requests_per_minute,
+            "requests_last_minute": len(self._recent),
+            "tokens": round(self.bucket.available, 1) if self.bucket is not None else None,
+            "waiting": waiting,
+            "delayed": dict(self.delayed),
+            "rate_limited": self.rate_limited,
+            "server_errors": self.server_errors,
+            "retries": self.retries,
+            "requests": self.requests,
+        }
+
+
+# Асинхронный фасад над gspread: все синхронные вызовы уходят в ограниченный пул потоков,
+# чтобы HTTP-запросы к Google не блокировали цикл событий aiogram
+class SheetsExecutor:
+    def __init__(self, max_workers: int = 4, quota: QuotaGovernor = None, registry=None):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+        self._pending = 0
+        # Вызовы ждут квоту до захода в пул, чтобы фоновые задачи не занимали потоки
+        self.quota = quota or QuotaGovernor()
+        # Реестр, чьи дескрипторы листов перезапрашиваются, если API отвечает на них 400/404
+        self.registry = registry
+
+    @property
+    def pending(self) -> int:
+        # Количество вызовов, которые ждут свободный поток или выполняются
+        return self._pending
+
+    async def call(self, func, *args, **kwargs):
+        self._pending += 1
+        try:
+            try:
+                return await self._run(func, args, kwargs)
+            except gspread.exceptions.APIError as e:
+                stale = self._stale_worksheets(e, func, args)
+                if not stale:
+                    raise
+                # Лист удалили, переименовали или пересоздали вручную, а в реестре остался
+                # старый дескриптор: резолвим название заново и повторяем вызов один раз
+                fresh = {}
+                for worksheet in stale:
+                    logger.warning(f"Дескриптор листа {worksheet.title} устарел ({e.response.status_code}), запрашиваем заново")
+                    fresh[id(worksheet)] = await self._run(self.registry.reload, (worksheet,), {})
+                owner = getattr(func, "__self__", None)
+                if id(owner) in fresh:
+                    func = getattr(fresh[id(owner)], func.__name__)
+                args = tuple(fresh.get(id(arg), arg) for arg in args)
+                return await self._run(func, args, kwargs)
+        finally:
+            self._pending -= 1
+
+    async def _run(self, func, args, kwargs):
+        loop = asyncio.get_running_loop()
+        labels = call_labels(func, args)
+        with sheets_call_seconds.time(labels[0]):
+            await self.quota.acquire(_priority.get())
+            return await loop.run_in_executor(self._pool, self.quota.run, partial(func, *args, **kwargs), labels)
+
+    # Закэшированные реестром дескрипторы, с которыми был вызов (сам объект метода или аргументы)
+    def _stale_worksheets(self, error, func, args):
+        status = getattr(getattr(error, "response", None), "status_code", None)
+        if self.registry is None or status not in (400, 404):
+            return []
+        stale = {}
+        for candidate in (getattr(func, "__self__", None), *args):
+            if isinstance(candidate, gspread.Worksheet) and self.registry.is_cached(candidate):
+                stale[id(candidate)] = candidate
+        return list(stale.values())
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+# Реестр листов на весь процесс: каждое название резолвится один раз,
+# а проверка заголовка "ID" выполняется только при первом обращении к листу
+class WorksheetRegistry:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self._worksheets = {}
+        self._checked = set()
+        self._last_rows = {}  # title -> номер последней заполненной строки
+        self._headers = {}  # title -> строка заголовка
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        # Один запрос метаданных загружает дескрипторы всех листов сразу
+        worksheets = self.spreadsheet.worksheets()
+        with self._lock:
+            self._worksheets = {ws.title: ws for ws in worksheets}
+            self._checked &= set(self._worksheets)
+            self._last_rows.clear()  # Листы могли править вручную
+            self._headers.clear()
+        logger.info(f"Загружено листов: {len(worksheets)}")
+        return worksheets
+
+    def titles(self):
+        with self._lock:
+            return list(self._worksheets)
+
+    def get(self, title):
+        with self._lock:
+            worksheet = self._worksheets.get(title)
+        cache_lookup("worksheets", worksheet is not None)
+        if worksheet is not None:
+            return worksheet
+
+        try:
+            worksheet = self.spreadsheet.worksheet(title)
+        except gspread.WorksheetNotFound:
+            self.invalidate(title)
+            raise
+
+        with self._lock:
+            self._worksheets[title] = worksheet
+        return worksheet
+
+    def is_cached(self, worksheet) -> bool:
+        with self._lock:
+            return self._worksheets.get(worksheet.title) is worksheet
+
+    # Забывает устаревший дескриптор и резолвит название заново (WorksheetNotFound, если листа нет)
+    def reload(self, worksheet):
+        self.invalidate(worksheet.title)
+        return self.get(worksheet.title)
+
+    def add(self, title, rows, cols, header):
+        worksheet = self.spreadsheet.add_worksheet(title=title, rows=rows, cols=cols)
+        worksheet.append_row(header)
+        with self._lock:
+            self._worksheets[title] = worksheet
+            self._checked.add(title)
+            self._headers[title] = list(header)
+        return worksheet
+
+    def ensure_id_column(self, worksheet):
+        # Старые листы могли быть созданы без колонки ID -- добавляем ее один раз
+        if worksheet.title in self._checked:
+            return worksheet
+        header = worksheet.row_values(1)
+        if header[0] != "ID":
+            worksheet.insert_cols([{"values": ["ID"]}], 1)  # Добавляем колонку ID в начало
+            header = ["ID"] + header
+        with self._lock:
+            self._checked.add(worksheet.title)
+            self._headers[worksheet.title] = header
+        return worksheet
+
+    def header(self, worksheet):
+        # Строка заголовка листа: читается один раз и хранится до обновления реестра
+        with self._lock:
+            header = self._headers.get(worksheet.title)
+        cache_lookup("headers", header is not None)
+        if header is None:
+            header = worksheet.row_values(1)
+            with self._lock:
+                self._headers[worksheet.title] = header
+        return header
+
+    def last_row(self, worksheet, column: str) -> int:
+        # Номер последней заполненной строки: из кэша или поиском пустой ячейки в колонке дат (column)
+        with self._lock:
+            last_row = self._last_rows.get(worksheet.title)
+        cache_lookup("last_rows", last_row is not None)
+        if last_row is None:
+            last_row = first_row_where(worksheet, column, lambda value: value == "") - 1
+            with self._lock:
+                self._last_rows[worksheet.title] = last_row
+        return last_row
+
+    def note_append(self, title: str, response):
+        # Ответ append_rows содержит обновленный диапазон, например 'Лист'!A5:G7.
+        # Возвращает номер первой записанной строки или None
+        match = re.search(r"(\d+)(?::[A-Z]+(\d+))?$", (response or {}).get("updates", {}).get("updatedRange", ""))
+        with self._lock:
+            if not match:
+                self._last_rows.pop(title, None)
+                return None
+            self._last_rows[title] = int(match.group(2) or match.group(1))
+        return int(match.group(1))
+
+    def note_delete(self, title: str, count: int = 1):
+        with self._lock:
+            if title in self._last_rows:
+                self._last_rows[title] -= count
+
+    def invalidate(self, title=None):
+        with self._lock:
+            if title is None:
+                self._worksheets.clear()
+                self._checked.clear()
+                self._last_rows.clear()
+                self._headers.clear()
+            else:
+                self._worksheets.pop(title, None)
+                self._checked.discard(title)
+                self._last_rows.pop(title, None)
+                self._headers.pop(title, None)
+
+
+def _cell_value(value_range):
+    return str(value_range[0][0]) if value_range and value_range[0] else ""
+
+
+# Поиск первой строки, для значения колонки которой predicate истинен.
+# predicate должен быть монотонным по строкам (False ... False True ... True),
+# пустые ячейки в конце листа передаются в него как "". Вместо двоичного поиска
+# по одной ячейке за запрос берем `probes` точек одним batch_get -- так лист
+# в десятки тысяч строк сужается до нужной строки за 3-4 запроса.
+def first_row_where(worksheet, column: str, predicate, first_row: int = 2, probes: int = 16) -> int:
+    lo = first_row
+    hi = max(worksheet.row_count, first_row) + 1
+
+    # row_count из метаданных может отставать после append_rows -- расширяем границу
+    while not predicate(_cell_value(worksheet.get(f"{column}{hi - 1}"))):
+        lo, hi = hi, hi * 2
+
+    # Инвариант: во всех строках до lo predicate ложен, в строке hi -- истинен
+    while hi - lo > probes:
+        step = (hi - lo) / (probes + 1)
+        points = sorted({lo + int(step * (i + 1)) for i in range(probes)})
+        values = worksheet.batch_get([f"{column}{row}" for row in points])
+        for row, value_range in zip(points, values):
+            if predicate(_cell_value(value_range)):
+                hi = row
+                break
+            lo = row + 1
+
+    if hi > lo:
+        # Остаток читаем одним диапазоном
+        tail = worksheet.get(f"{column}{lo}:{column}{hi - 1}")
+        for offset in range(hi - lo):
+            value = str(tail[offset][0]) if offset < len(tail) and tail[offset] else ""
+            if predicate(value):
+                return lo + offset
+    return hi
+
+
+# Строки листа, у которых значение в колонке дат попадает в [start, end].
+# Строки должны идти по возрастанию даты (траты дописываются в конец листа).
+# Возвращает (номер первой строки, значения строк).
+def read_date_range(worksheet, start: str, end: str, date_column: str = "B", last_column: str = "H"):
+    first = first_row_where(worksheet, date_column, lambda value: value == "" or value >= start)
+    stop = first_row_where(worksheet, date_column, lambda value: value == "" or value > end, first_row=first)
+    if stop <= first:
+        return first, []
+    return first, worksheet.get(f"A{first}:{last_column}{stop - 1}", value_render_option=ValueRenderOption.unformatted)
+
+
+# Диапазоны нескольких листов одним запросом values_batch_get.
+# ranges -- [(название листа, диапазон "A2:H10" или None для всего листа)];
+# возвращает значения диапазонов в том же порядке
+def batch_get_values(spreadsheet, ranges, value_render_option=ValueRenderOption.unformatted):
+    if not ranges:
+        return []
+    response = spreadsheet.values_batch_get(
+        [absolute_range_name(title, a1) for title, a1 in ranges],
+        params={"valueRenderOption": value_render_option}
+    )
+    return [value_range.get("values", []) for value_range in response.get("valueRanges", [])]
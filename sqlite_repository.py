@@ -0,0 +1,443 @@
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from gspread.utils import ValueRenderOption
+from repository import Repository, SheetsRepository, Expense, expense_sheet_owner
+from analytics import ExpenseFrame
+from records import SheetLayout
+from sheets import background_priority
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS expenses (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    family_id TEXT,
+    date TEXT NOT NULL,
+    category TEXT NOT NULL,
+    amount REAL NOT NULL,
+    tags TEXT NOT NULL DEFAULT '',
+    comment TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date);
+CREATE INDEX IF NOT EXISTS idx_expenses_family_date ON expenses (family_id, date);
+CREATE TABLE IF NOT EXISTS budgets (
+    user_id TEXT NOT NULL,
+    category TEXT NOT NULL,
+    amount REAL NOT NULL,
+    PRIMARY KEY (user_id, category)
+);
+CREATE TABLE IF NOT EXISTS families (
+    user_id TEXT PRIMARY KEY,
+    family_id TEXT NOT NULL,
+    role TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_families_family ON families (family_id);
+CREATE TABLE IF NOT EXISTS mirror_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    payload TEXT NOT NULL
+);
+"""
+
+EXPENSE_COLUMNS = "id, date, category, amount, user_id, family_id, comment, tags"
+
+
+# Основное хранилище в локальной SQLite. Каждое изменение в той же транзакции
+# записывается в mirror_outbox, откуда фоновая задача по порядку переносит его
+# в Google Sheets (SheetsRepository), чтобы таблица оставалась доступной для людей.
+class SQLiteRepository(Repository):
+    def __init__(self, path: str = "bot.db", mirror: SheetsRepository = None, mirror_interval: float = 5.0,
+                 drain_mirror: bool = True):
+        self.path = path
+        self.mirror = mirror
+        self.mirror_interval = mirror_interval
+        # Когда базу делят несколько процессов, outbox пишут все, а в таблицу переносит один
+        self.drain_mirror = drain_mirror
+        # Одно соединение и один поток: SQLite не любит конкурентную запись
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        self._mirror_wakeup = asyncio.Event()
+
+    ###
+    ### Доступ к базе (выполняется в потоке пула)
+    ###
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def _fetch(self, sql: str, params=()):
+        return self._connection().execute(sql, params).fetchall()
+
+    def _write(self, sql: str, params=(), op: str = None, payload: dict = None):
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(sql, params)
+            # В таблицу переносим только реально изменившие базу операции
+            if op and self.mirror is not None and cursor.rowcount > 0:
+                conn.execute(
+                    "INSERT INTO mirror_outbox (op, payload) VALUES (?, ?)",
+                    (op, json.dumps(payload, ensure_ascii=False))
+                )
+            return cursor.rowcount
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, partial(func, *args, **kwargs))
+
+    async def _query(self, sql: str, params=()):
+        return await self._run(self._fetch, sql, params)
+
+    async def _execute(self, sql: str, params=(), op: str = None, payload: dict = None):
+        rowcount = await self._run(self._write, sql, params, op, payload)
+        if op and self.mirror is not None:
+            self._mirror_wakeup.set()
+        return rowcount
+
+    ###
+    ### Жизненный цикл
+    ###
+
+    async def start(self):
+        await self._run(self._connection)
+        if self.mirror is not None and self.drain_mirror:
+            await self.mirror.start()
+
+    def pending_writes(self) -> int:
+        return self.mirror.pending_writes() if self.mirror is not None else 0
+
+    def sheets_quota(self) -> dict:
+        return self.mirror.sheets_quota() if self.mirror is not None else {}
+
+    def background_tasks(self):
+        if self.mirror is None or not self.drain_mirror:
+            return []
+        return self.mirror.background_tasks() + [self._mirror_loop()]
+
+    async def close(self):
+        if self.mirror is not None and self.drain_mirror:
+            await self._drain_outbox()
+            await self.mirror.close()
+        await self._run(lambda: self._conn and self._conn.close())
+        self._pool.shutdown(wait=False)
+
+    ###
+    ### Зеркалирование в Google Sheets
+    ###
+
+    async def _mirror_loop(self):
+        # Пользователи зеркала не ждут: его запросы уступают квоту остальным
+        with background_priority():
+            while True:
+                try:
+                    await asyncio.wait_for(self._mirror_wakeup.wait(), timeout=self.mirror_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._mirror_wakeup.clear()
+                await self._drain_outbox()
+
+    async def _drain_outbox(self):
+        while True:
+            rows = await self._query("SELECT id, op, payload FROM mirror_outbox ORDER BY id LIMIT 100")
+            if not rows:
+                return
+            for outbox_id, op, payload in rows:
+                try:
+                    await self._apply_mirror(op, json.loads(payload))
+                except Exception as e:
+                    # Останавливаемся, чтобы не нарушить порядок изменений; повторим позже
+                    logger.error(f"Ошибка зеркалирования {op} в таблицу: {e}")
+                    return
+                await self._run(self._write, "DELETE FROM mirror_outbox WHERE id = ?", (outbox_id,))
+
+    async def _apply_mirror(self, op: str, payload: dict):
+        if op == "ensure_user":
+            await self.mirror.ensure_user(payload["user_id"])
+        elif op == "add_expense":
+            await self.mirror.add_expense(Expense(**payload))
+        elif op == "delete_expense":
+            await self.mirror.delete_expense(payload["user_id"], payload["id"])
+        elif op == "update_expense":
+            await self.mirror.update_expense(payload["user_id"], payload["id"], payload["field"], payload["value"])
+        elif op == "set_budget":
+            await self.mirror.set_budget(payload["user_id"], payload["category"], payload["amount"])
+        elif op == "create_family":
+            await self.mirror.create_family(payload["family_id"], payload["user_id"])
+        elif op == "join_family":
+            await self.mirror.join_family(payload["family_id"], payload["user_id"])
+        else:
+            logger.warning(f"Неизвестная операция зеркалирования: {op}")
+
+    ###
+    ### Пользователи
+    ###
+
+    async def ensure_user(self, user_id):
+        await self._execute(
+            "INSERT OR IGNORE INTO users (user_id) VALUES (?)", (str(user_id),),
+            op="ensure_user", payload={"user_id": str(user_id)}
+        )
+
+    async def last_expense_dates(self):
+        rows = await self._query(
+            """
+            SELECT u.user_id, COALESCE(MAX(e.date), '') FROM users u
+            LEFT JOIN expenses e ON e.user_id = u.user_id
+            GROUP BY u.user_id
+            """
+        )
+        return {str(user_id): date for user_id, date in rows}
+
+    ###
+    ### Траты
+    ###
+
+    async def add_expense(self, expense: Expense):
+        await self._execute(
+            f"INSERT INTO expenses ({EXPENSE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (expense.id, expense.date, expense.category, expense.amount,
+             str(expense.user_id), expense.family_id, expense.comment, expense.tags),
+            op="add_expense",
+            payload={
+                "id": expense.id, "date": expense.date, "category": expense.category,
+                "amount": expense.amount, "user_id": str(expense.user_id),
+                "family_id": expense.family_id, "comment": expense.comment, "tags": expense.tags
+            }
+        )
+        return True
+
+    # Условие "трата видна пользователю": личная трата или трата его семьи
+    async def _owner_filter(self, user_id):
+        family_id = await self.family_of(user_id)
+        return "((user_id = ? AND family_id IS NULL) OR family_id = ?)", (str(user_id), family_id)
+
+    async def delete_expense(self, user_id, expense_id: str):
+        condition, params = await self._owner_filter(user_id)
+        rows = await self._query(f"SELECT family_id FROM expenses WHERE id = ? AND {condition}", (expense_id, *params))
+        if not rows:
+            return None
+        await self._execute(
+            "DELETE FROM expenses WHERE id = ?", (expense_id,),
+            op="delete_expense", payload={"user_id": str(user_id), "id": expense_id}
+        )
+        return "family" if rows[0][0] else "personal"
+
+    async def update_expense(self, user_id, expense_id: str, field: str, value) -> bool:
+        column = {"category": "category", "amount": "amount", "comment": "comment"}[field]
+        if field == "amount":
+            value = float(value)
+        condition, params = await self._owner_filter(user_id)
+        updated = await self._execute(
+            f"UPDATE expenses SET {column} = ? WHERE id = ? AND {condition}",
+            (value, expense_id, *params),
+            op="update_expense",
+            payload={"user_id": str(user_id), "id": expense_id, "field": field, "value": value}
+        )
+        return updated > 0
+
+    # Условия выборки трат для отчета: [(условие, владелец)]
+    async def _stats_queries(self, user_id, stats_type: str):
+        queries = []
+
+        # Личные траты
+        if stats_type in ["stats_personal", "stats_all"]:
+            queries.append(("user_id = ? AND family_id IS NULL", str(user_id)))
+
+        # Семейные траты
+        if stats_type in ["stats_family", "stats_all"]:
+            family_id = await self.family_of(user_id)
+            if family_id:
+                queries.append(("family_id = ?", family_id))
+        return queries
+
+    async def category_totals(self, user_id, stats_type: str, start_date, end_date):
+        stats = defaultdict(float)
+        bounds = (f"{start_date:%Y-%m-%d} 00:00:00", f"{end_date:%Y-%m-%d} 23:59:59")
+        for condition, owner in await self._stats_queries(user_id, stats_type):
+            rows = await self._query(
+                f"SELECT category, SUM(amount) FROM expenses WHERE {condition} AND date BETWEEN ? AND ? GROUP BY category",
+                (owner, *bounds)
+            )
+            for category, total in rows:
+                stats[category] += total
+        return stats
+
+    async def expense_frame(self, user_id, stats_type: str) -> ExpenseFrame:
+        # База сворачивает траты до сумм по дням и категориям, остальное считается в кадре
+        frames = []
+        for condition, owner in await self._stats_queries(user_id, stats_type):
+            rows = await self._query(
+                f"SELECT substr(date, 1, 10), category, SUM(amount) FROM expenses WHERE {condition} GROUP BY 1, 2",
+                (owner,)
+            )
+            frames.append(ExpenseFrame.from_rows(rows))
+        return ExpenseFrame.concat(frames)
+
+    async def last_expenses(self, user_id, limit: int = 5, cursor: str = None):
+        family_id = await self.family_of(user_id)
+
+        # Курсор -- дата и ID последней показанной траты: "ГГГГММДДччммсс.<id>"
+        before = ("9999-12-31 23:59:59", "")
+        if cursor:
+            digits, _, last_id = cursor.partition(".")
+            if len(digits) != 14 or not digits.isdigit():
+                return [], None
+            before = (f"{digits[:4]}-{digits[4:6]}-{digits[6:8]} {digits[8:10]}:{digits[10:12]}:{digits[12:]}", last_id)
+        keyset = "(date < ? OR (date = ? AND id < ?))"
+        keyset_params = (before[0], before[0], before[1] or "\uffff")
+
+        # Каждая половина идет по своему индексу, затем результаты сливаются;
+        # берем на одну строку больше, чтобы понять, есть ли следующая страница
+        rows = await self._query(
+            f"""
+            SELECT * FROM (
+                SELECT {EXPENSE_COLUMNS} FROM expenses
+                WHERE user_id = ? AND family_id IS NULL AND {keyset} ORDER BY date DESC, id DESC LIMIT ?
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT {EXPENSE_COLUMNS} FROM expenses
+                WHERE family_id = ? AND {keyset} ORDER BY date DESC, id DESC LIMIT ?
+            )
+            ORDER BY date DESC, id DESC LIMIT ?
+            """,
+            (str(user_id), *keyset_params, limit + 1, family_id, *keyset_params, limit + 1, limit + 1)
+        )
+        expenses = [Expense(*row) for row in rows[:limit]]
+        if len(rows) <= limit:
+            return expenses, None
+        last = expenses[-1]
+        return expenses, f"{re.sub(r'[^0-9]', '', last.date)}.{last.id}"
+
+    ###
+    ### Бюджеты
+    ###
+
+    async def get_budgets(self, user_id):
+        rows = await self._query("SELECT category, amount FROM budgets WHERE user_id = ?", (str(user_id),))
+        return dict(rows)
+
+    async def set_budget(self, user_id, category: str, amount: float):
+        await self._execute(
+            """
+            INSERT INTO budgets (user_id, category, amount) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, category) DO UPDATE SET amount = excluded.amount
+            """,
+            (str(user_id), category, amount),
+            op="set_budget", payload={"user_id": str(user_id), "category": category, "amount": amount}
+        )
+
+    ###
+    ### Семьи
+    ###
+
+    async def family_of(self, user_id):
+        rows = await self._query("SELECT family_id FROM families WHERE user_id = ?", (str(user_id),))
+        return rows[0][0] if rows else None
+
+    async def family_exists(self, family_id: str) -> bool:
+        rows = await self._query("SELECT 1 FROM families WHERE family_id = ? LIMIT 1", (family_id,))
+        return bool(rows)
+
+    async def create_family(self, family_id: str, user_id):
+        await self._execute(
+            "INSERT INTO families (user_id, family_id, role) VALUES (?, ?, 'creator')",
+            (str(user_id), family_id),
+            op="create_family", payload={"family_id": family_id, "user_id": str(user_id)}
+        )
+
+    async def join_family(self, family_id: str, user_id):
+        await self._execute(
+            "INSERT INTO families (user_id, family_id, role) VALUES (?, ?, 'member')",
+            (str(user_id), family_id),
+            op="join_family", payload={"family_id": family_id, "user_id": str(user_id)}
+        )
+
+    ###
+    ### Миграция
+    ###
+
+    # Импорт текущих листов в базу. Повторный запуск безопасен: существующие
+    # записи не дублируются, а в очередь зеркалирования ничего не попадает.
+    async def import_from_sheets(self, source: SheetsRepository):
+        await source.start()
+        await source.write_queue.flush()  # Досылаем строки из журнала, чтобы они попали в импорт
+        call = source.sheets.call
+        counts = defaultdict(int)
+
+        # Возвращает число вставленных строк (INSERT OR IGNORE пропускает существующие)
+        def insert_many(sql, rows):
+            conn = self._connection()
+            with conn:
+                before = conn.total_changes
+                conn.executemany(sql, rows)
+                return conn.total_changes - before
+
+        families = source.family_index.items()  # Индекс семей уже загружен в source.start()
+        await self._run(insert_many, "INSERT OR IGNORE INTO families (user_id, family_id, role) VALUES (?, ?, ?)", families)
+        counts["families"] = len(families)
+
+        budgets = source.budgets.items()  # Лист бюджетов уже прочитан в source.start()
+        await self._run(
+            insert_many,
+            "INSERT INTO budgets (user_id, category, amount) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, category) DO UPDATE SET amount = excluded.amount",
+            budgets
+        )
+        counts["budgets"] = len(budgets)
+
+        for worksheet in await call(source.registry.refresh):
+            title = worksheet.title
+            owner = expense_sheet_owner(title)  # Архивы "123-2025" импортируются вместе с листом "123"
+            if owner is None:
+                continue
+            if owner.isdigit():
+                user_id, family_id = owner, None
+                await self._run(insert_many, "INSERT OR IGNORE INTO users (user_id) VALUES (?)", [(owner,)])
+            else:
+                user_id, family_id = None, owner[len("family-"):]
+
+            values = await call(worksheet.get_all_values, value_render_option=ValueRenderOption.unformatted)
+            layout = SheetLayout(values[0]) if values else SheetLayout.default(owner)
+            if not layout.complete:
+                layout = SheetLayout.default(owner)
+
+            expenses = []
+            for number, row in enumerate(values[1:], start=2):
+                expense = layout.decode(row, family_id, user_id)
+                if expense is None or not expense.user_id:
+                    # Без пользователя (пустая колонка в листе семьи) строку не вставить: user_id NOT NULL
+                    if any(str(value).strip() for value in row):
+                        counts["skipped"] += 1
+                        logger.warning(f"Пропущена строка {number} листа {title}: {row}")
+                    continue
+                expenses.append((
+                    # Старые строки без ID получают ID от листа, строки и даты: повторный импорт их не дублирует
+                    expense.id or str(uuid.uuid5(uuid.NAMESPACE_URL, f"{title}:{number}:{expense.date}")),
+                    expense.date, expense.category, expense.amount, expense.user_id,
+                    family_id, expense.comment, expense.tags
+                ))
+            inserted = await self._run(
+                insert_many, f"INSERT OR IGNORE INTO expenses ({EXPENSE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", expenses
+            )
+            counts["expenses"] += inserted
+            if inserted < len(expenses):
+                counts["existing"] += len(expenses) - inserted
+                logger.info(f"Лист {title}: {len(expenses) - inserted} трат уже есть в базе")
+
+        logger.info(f"Импорт из таблицы завершен: {dict(counts)}")
+        return dict(counts)
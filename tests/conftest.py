@@ -1,12 +1,29 @@
 import pytest
-from aiogram import Dispatcher
-from aiogram.client.default import DefaultBotProperties
-from bot import dp
+from unittest.mock import AsyncMock
+from aiogram.fsm.storage.memory import MemoryStorage
+import bot
+from repository import Repository
+
+
+class StubConfig:
+    BOT_TOKEN = "123456:TEST-TOKEN"
+    SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/test"
+
 
 @pytest.fixture
-def mock_bot():
-    return MagicMock()
+def repo():
+    return AsyncMock(spec=Repository)
+
+
+@pytest.fixture
+def mock_bot(tmp_path, monkeypatch, repo):
+    # Приложение без сети и config.py: хранилище подменяется, снимки пишутся во временную папку
+    monkeypatch.chdir(tmp_path)
+    bot.create_app(StubConfig, storage=repo, fsm_storage=MemoryStorage())
+    bot.app_ready.set()
+    return AsyncMock()
+
 
 @pytest.fixture
 def dispatcher():
-    return dp
+    return bot.dp
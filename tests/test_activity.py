@@ -0,0 +1,19 @@
+from activity import ActivityIndex
+
+
+def test_activity_index_touch_and_inactive(tmp_path):
+    index = ActivityIndex(str(tmp_path / "activity.json"))
+    assert not index.load()
+
+    index.touch(1)
+    index.touch(2, "2024-01-01 10:00:00")
+    index.touch(2, "2023-12-31 10:00:00")  # Более старая дата не перетирает новую
+    index.touch(3, "2023-12-31 23:00:00")
+    assert index.last_expense(2) == "2024-01-01 10:00:00"
+    assert sorted(index.inactive_on("2024-01-01")) == [1, 3]
+
+    index.save()
+    restored = ActivityIndex(index.path)
+    assert restored.load()
+    assert restored.last_expense(3) == "2023-12-31 23:00:00"
+    assert len(restored) == 3
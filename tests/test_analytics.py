@@ -0,0 +1,38 @@
+import datetime
+from analytics import ExpenseFrame
+from rollups import RollupStore
+
+
+def test_frame_groups_by_category_day_and_month():
+    personal = ExpenseFrame.from_rows([
+        ("2024-12-31 10:00:00", "👶 Дети", 10.0),
+        ("2025-01-02 10:00:00", "🛒 Продукты", 100.0),
+        ("2025-01-02 18:00:00", "🛒 Продукты", 20.0),
+        ("испорчено", "🛒 Продукты", 1.0),
+    ])
+    family = ExpenseFrame.from_rows([("2025-02-15", "🏠 Дом", 30.0), ("2025-01-05", "👶 Дети", 5.0)])
+    frame = ExpenseFrame.concat([personal, family, ExpenseFrame()])
+
+    assert len(frame) == 5
+    assert frame.category_totals(datetime.date(2025, 1, 1), datetime.date(2025, 3, 31)) == {
+        "🛒 Продукты": 120.0, "👶 Дети": 5.0, "🏠 Дом": 30.0
+    }
+    assert frame.breakdown(datetime.date(2025, 1, 1), datetime.date(2025, 1, 7)) == [
+        (datetime.date(2025, 1, 2), 120.0), (datetime.date(2025, 1, 5), 5.0)
+    ]
+    assert frame.breakdown(datetime.date(2024, 12, 1), datetime.date(2025, 12, 31), "M") == [
+        (datetime.date(2024, 12, 1), 10.0), (datetime.date(2025, 1, 1), 125.0), (datetime.date(2025, 2, 1), 30.0)
+    ]
+    assert frame.first_day() == datetime.date(2024, 12, 31)
+    assert ExpenseFrame().category_totals(datetime.date(2025, 1, 1), datetime.date(2025, 1, 31)) == {}
+
+
+def test_rollup_frame_follows_writes(tmp_path):
+    store = RollupStore(str(tmp_path / "rollups.json"))
+    store.replace("123", [("2025-01-01", "🛒 Продукты", 100.0)])
+    year = (datetime.date(2025, 1, 1), datetime.date(2025, 12, 31))
+    assert store.frame("123").category_totals(*year) == {"🛒 Продукты": 100.0}
+
+    store.add("123", "2025-06-01", "👶 Дети", 20.0)
+    assert store.frame("123").category_totals(*year) == {"🛒 Продукты": 100.0, "👶 Дети": 20.0}
+    assert len(store.frame("456")) == 0
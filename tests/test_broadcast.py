@@ -0,0 +1,31 @@
+import pytest
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from broadcast import Broadcaster
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.flooded = False
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        if chat_id == 2 and not self.flooded:
+            self.flooded = True
+            raise TelegramRetryAfter(method=None, message="Too Many Requests", retry_after=0)
+        if chat_id == 3:
+            raise TelegramForbiddenError(method=None, message="bot was blocked by the user")
+        if chat_id == 4:
+            raise ConnectionError("network")
+        self.sent.append(chat_id)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retries_and_summary():
+    bot = FakeBot()
+    broadcaster = Broadcaster(bot, rate=1000, concurrency=3, max_retries=2, backoff=0)
+
+    result = await broadcaster.send("test", [1, 2, 3, 4, 5], "hi")
+
+    assert sorted(bot.sent) == [1, 2, 5]
+    assert (result.total, result.sent, result.blocked, result.failed) == (5, 3, 1, 1)
+    assert result.retries == 3  # Один повтор после flood control и два после сетевых ошибок
@@ -0,0 +1,21 @@
+from budgets import BudgetStore
+
+
+def test_budget_store_load_and_set():
+    store = BudgetStore()
+    store.load([
+        ["user_id", "category", "budget"],
+        ["123", "🍔 Еда", "5000"],
+        ["456", "🍔 Еда", "3000"],
+        ["123", "🍔 Еда", "7000"],
+        ["123", "🚕 Транспорт", "bad"],
+    ])
+
+    assert store.budgets_of(123) == {"🍔 Еда": 7000.0}
+    assert store.row_of(123, "🍔 Еда") == 4
+    assert store.row_of(123, "🚕 Транспорт") is None
+
+    store.set(123, "🚕 Транспорт", 1500.0, 6)
+    assert store.budgets_of("123") == {"🍔 Еда": 7000.0, "🚕 Транспорт": 1500.0}
+    assert len(store) == 3
+    assert ("456", "🍔 Еда", 3000.0) in store.items()
@@ -0,0 +1,38 @@
+import time
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from drafts import DRAFT_KEY, DraftSweeper, ExpenseDraft
+from fsm_storage import SQLiteStorage
+
+
+def test_draft_pack_roundtrip():
+    draft = ExpenseDraft("🛒 Продукты", 250.5, "personal", "молоко", created=1700000000)
+    assert draft.pack() == ["🛒 Продукты", 250.5, "personal", "молоко", 1700000000]
+    assert ExpenseDraft.unpack(draft.pack()) == draft
+    assert ExpenseDraft.unpack(None) is None
+    assert draft.expired(ttl=60, now=1700000061)
+
+
+@pytest.mark.asyncio
+async def test_sweeper_expires_old_drafts(tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "fsm.db"))
+    old = StorageKey(bot_id=1, chat_id=1, user_id=1)
+    fresh = StorageKey(bot_id=1, chat_id=2, user_id=2)
+    await storage.set_state(old, "AddExpense:ENTER_AMOUNT")
+    await storage.set_data(old, {DRAFT_KEY: ExpenseDraft("🛒 Продукты", created=time.time() - 7200).pack()})
+    await storage.set_state(fresh, "AddExpense:SELECT_TYPE")
+    await storage.set_data(fresh, {DRAFT_KEY: ExpenseDraft("👶 Дети", 100.0).pack()})
+
+    sweeper = DraftSweeper(storage, ttl=3600)
+    assert await sweeper.sweep() == 1
+    assert sweeper.live == 1
+    assert await storage.get_state(old) is None and await storage.get_data(old) == {}
+    assert await storage.get_state(fresh) == "AddExpense:SELECT_TYPE"
+    await storage.close()
+
+
+@pytest.mark.asyncio
+async def test_sweeper_does_not_count_uncountable_storage():
+    sweeper = DraftSweeper(object())  # Например, Redis: черновики удаляет data_ttl хранилища
+    assert await sweeper.sweep() == 0
+    assert sweeper.live is None
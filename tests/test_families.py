@@ -0,0 +1,54 @@
+import asyncio
+import threading
+from unittest.mock import MagicMock
+import pytest
+from families import FamilyIndex
+from repository import SheetsRepository
+
+
+def test_family_index_load_and_add():
+    index = FamilyIndex()
+    index.load([
+        ["family_id", "user_id", "role"],
+        ["family-abc123", 1, "creator"],
+        ["family-abc123", "2"],
+        ["", "3", "member"],
+    ])
+
+    assert index.family_of(1) == "family-abc123"
+    assert index.family_of("2") == "family-abc123"
+    assert index.family_of(3) is None
+    assert index.exists("family-abc123")
+    assert index.members_of("family-abc123") == {"1": "creator", "2": "member"}
+
+    index.add("family-xyz789", 3, "creator")
+    assert index.family_of(3) == "family-xyz789"
+    assert index.members_of("family-xyz789") == {"3": "creator"}
+    assert len(index) == 2
+
+
+@pytest.mark.asyncio
+async def test_family_joined_during_reconcile_is_kept(tmp_path):
+    started, release = threading.Event(), threading.Event()
+    families_list = MagicMock()
+
+    def read_families():
+        started.set()
+        release.wait(5)
+        return [["family_id", "user_id", "role"]]  # Лист прочитан до записи нового участника
+
+    families_list.get_all_values.side_effect = read_families
+    spreadsheet = MagicMock()
+    spreadsheet.worksheet.return_value = families_list
+    repo = SheetsRepository(spreadsheet, journal_path=str(tmp_path / "journal.jsonl"),
+                            rollups_path=str(tmp_path / "rollups.json"))
+
+    reconcile = asyncio.create_task(repo._load_family_index())
+    await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+    join = asyncio.create_task(repo.join_family("family-abc123", 7))
+    await asyncio.sleep(0.05)
+    release.set()
+    await asyncio.gather(reconcile, join)
+
+    assert repo.family_index.family_of(7) == "family-abc123"
+    repo.sheets.shutdown()
@@ -0,0 +1,26 @@
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+from fsm_storage import SQLiteStorage
+
+
+@pytest.mark.asyncio
+async def test_state_and_data_survive_reopen(tmp_path):
+    path = str(tmp_path / "fsm.db")
+    key = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+    storage = SQLiteStorage(path)
+    await storage.set_state(key, "AddExpense:ENTER_AMOUNT")
+    await storage.set_data(key, {"category": "🍔 Еда"})
+    assert await storage.update_data(key, {"amount": 150.0}) == {"category": "🍔 Еда", "amount": 150.0}
+    await storage.close()
+
+    # Другой процесс (или бот после перезапуска) видит тот же черновик
+    storage = SQLiteStorage(path)
+    assert await storage.get_state(key) == "AddExpense:ENTER_AMOUNT"
+    assert await storage.get_data(key) == {"category": "🍔 Еда", "amount": 150.0}
+
+    await storage.set_state(key, None)
+    await storage.set_data(key, {})
+    assert await storage.get_state(key) is None
+    assert await storage.get_data(key) == {}
+    await storage.close()
@@ -1,11 +1,12 @@
 import pytest
 from aiogram import types
-from unittest.mock import AsyncMock, MagicMock, patch
-from bot import dp, get_main_menu, get_categories_keyboard
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import SendMessage
+from bot import get_main_menu
 import datetime
 
 @pytest.mark.asyncio
-async def test_start_command():
+async def test_start_command(mock_bot, dispatcher, repo):
     message = types.Message(
         message_id=123,
         date=datetime.datetime.now(),
@@ -17,11 +18,65 @@ async def test_start_command():
     # Используем fake_update для корректного создания объекта Update
     fake_update = types.Update(update_id=123, message=message)
     
-    mock_bot = MagicMock()
-    await dp.feed_update(mock_bot, fake_update)
+    await dispatcher.feed_update(mock_bot, fake_update)
     
-    mock_bot.send_message.assert_called_with(
-        chat_id=123,
-        text="Добро пожаловать! 🤑\nВыберите действие:",
-        reply_markup=get_main_menu()
-    )
+    repo.ensure_user.assert_awaited_once_with(123)
+    method = mock_bot.call_args.args[0]
+    assert isinstance(method, SendMessage)
+    assert method.chat_id == 123
+    assert method.text == "Добро пожаловать! 🤑\nВыберите действие:"
+    assert method.reply_markup == get_main_menu()
+
+@pytest.mark.asyncio
+async def test_expense_draft_flow(mock_bot, dispatcher, repo):
+    user = types.User(id=321, is_bot=False, first_name="Test")
+    chat = types.Chat(id=321, type="private")
+    repo.add_expense.return_value = True
+
+    def message(update_id, text):
+        return types.Update(update_id=update_id, message=types.Message(
+            message_id=update_id, date=datetime.datetime.now(), chat=chat, from_user=user, text=text
+        ))
+
+    def callback(update_id, data):
+        return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+            id=str(update_id), from_user=user, chat_instance="1", data=data,
+            message=types.Message(message_id=update_id, date=datetime.datetime.now(), chat=chat, text="")
+        ))
+
+    await dispatcher.feed_update(mock_bot, callback(1, "🛒 Продукты"))
+    await dispatcher.feed_update(mock_bot, message(2, "250.5"))
+    await dispatcher.feed_update(mock_bot, callback(3, "personal"))
+    await dispatcher.feed_update(mock_bot, message(4, "молоко"))
+
+    expense = repo.add_expense.await_args.args[0]
+    assert (expense.category, expense.amount, expense.comment, expense.family_id) == ("🛒 Продукты", 250.5, "молоко", None)
+    # Черновик удален после сохранения
+    assert await dispatcher.storage.get_data(StorageKey(bot_id=mock_bot.id, chat_id=321, user_id=321)) == {}
+
+@pytest.mark.asyncio
+async def test_custom_range_stats(mock_bot, dispatcher, repo):
+    user = types.User(id=555, is_bot=False, first_name="Test")
+    chat = types.Chat(id=555, type="private")
+    repo.category_totals.return_value = {"🛒 Продукты": 300.0, "👶 Дети": 200.0}
+    repo.get_budgets.return_value = {"🛒 Продукты": 1000.0}
+
+    def callback(update_id, data):
+        return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+            id=str(update_id), from_user=user, chat_instance="1", data=data,
+            message=types.Message(message_id=update_id, date=datetime.datetime.now(), chat=chat, text="")
+        ))
+
+    await dispatcher.feed_update(mock_bot, callback(1, "stats_personal"))
+    await dispatcher.feed_update(mock_bot, callback(2, "custom"))
+    await dispatcher.feed_update(mock_bot, types.Update(update_id=3, message=types.Message(
+        message_id=3, date=datetime.datetime.now(), chat=chat, from_user=user, text="01.01.2025-31.03.2025"
+    )))
+
+    repo.category_totals.assert_awaited_with(555, "stats_personal", datetime.date(2025, 1, 1), datetime.date(2025, 3, 31))
+    repo.expense_frame.assert_not_awaited()  # Кадр всей истории нужен только для разбивки
+    report = [call.args[0] for call in mock_bot.call_args_list if isinstance(call.args[0], SendMessage)][-1]
+    # Месячный бюджет пересчитан на 90 дней периода
+    assert "🛒 Продукты: 300.00 / 3000.00 руб. (10%)" in report.text
+    assert "💵 *Итого:* 500.00 руб." in report.text
+    assert report.reply_markup.inline_keyboard[0][0].callback_data == "breakdown:stats_personal:20250101:20250331"
@@ -0,0 +1,17 @@
+from locator import ExpenseLocator
+
+
+def test_rows_shift_after_delete():
+    locator = ExpenseLocator()
+    locator.put("123", 2, "a")
+    locator.put("123", 3, "b")
+    locator.put("123", 4, "c")
+    locator.put("family-family-abc123", 2, "d")
+
+    locator.note_delete("123", 3)
+
+    assert locator.get("a") == ("123", 2)
+    assert locator.get("b") is None
+    assert locator.get("c") == ("123", 3)
+    assert locator.get("d") == ("family-family-abc123", 2)
+    assert len(locator) == 3
@@ -0,0 +1,46 @@
+import datetime
+import pytest
+from aiogram import types
+from aiohttp.test_utils import TestClient, TestServer
+from metrics import MetricsRegistry, create_metrics_app, registry
+
+
+def test_registry_renders_prometheus_text():
+    metrics = MetricsRegistry()
+    requests = metrics.counter("sheets_requests_total", "Запросы", ("method", "worksheet"))
+    latency = metrics.histogram("handler_seconds", "Обработчики", ("handler",), buckets=(0.1, 1))
+    metrics.gauge("queue_depth", "Очередь", lambda: 3)
+    requests.inc("append_rows", "personal")
+    requests.inc("append_rows", "personal")
+    latency.observe(0.05, "start")
+    latency.observe(2.5, "start")
+
+    lines = metrics.render().splitlines()
+
+    assert "# TYPE sheets_requests_total counter" in lines
+    assert 'sheets_requests_total{method="append_rows",worksheet="personal"} 2' in lines
+    assert 'handler_seconds_bucket{handler="start",le="0.1"} 1' in lines
+    assert 'handler_seconds_bucket{handler="start",le="1"} 1' in lines
+    assert 'handler_seconds_bucket{handler="start",le="+Inf"} 2' in lines
+    assert 'handler_seconds_count{handler="start"} 2' in lines
+    assert "queue_depth 3" in lines
+
+@pytest.mark.asyncio
+async def test_handler_latency_is_exported(mock_bot, dispatcher, repo):
+    repo.pending_writes.return_value = 0
+    update = types.Update(update_id=1, message=types.Message(
+        message_id=1, date=datetime.datetime.now(), chat=types.Chat(id=5, type="private"),
+        from_user=types.User(id=5, is_bot=False, first_name="Test"), text="/start"
+    ))
+    before = registry.histogram("bot_handler_seconds", "").count("send_welcome")
+
+    await dispatcher.feed_update(mock_bot, update)
+
+    assert registry.histogram("bot_handler_seconds", "").count("send_welcome") == before + 1
+    async with TestClient(TestServer(create_metrics_app())) as client:
+        response = await client.get("/metrics")
+        assert response.status == 200
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        text = await response.text()
+    assert 'bot_handler_seconds_count{handler="send_welcome"}' in text
+    assert "bot_ready 1" in text
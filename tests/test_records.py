@@ -0,0 +1,29 @@
+import datetime
+from records import FAMILY_LAYOUT, PERSONAL_LAYOUT, SheetLayout, format_timestamp, parse_timestamp
+
+
+def test_parse_timestamp_formats():
+    assert parse_timestamp("2025-01-02 10:11:12") == datetime.datetime(2025, 1, 2, 10, 11, 12)
+    assert parse_timestamp("02.01.2025 10:11:12") == datetime.datetime(2025, 1, 2, 10, 11, 12)
+    assert parse_timestamp("2025-01-02") == datetime.datetime(2025, 1, 2)
+    assert parse_timestamp(45659.5) == datetime.datetime(2025, 1, 2, 12, 0)  # Серийная дата Google Sheets
+    assert parse_timestamp("вчера") is None and parse_timestamp("2025-13-01") is None
+    assert format_timestamp(45659.5) == "2025-01-02 12:00:00"
+
+
+def test_layouts_decode_personal_family_and_reordered_rows():
+    expense = PERSONAL_LAYOUT.decode(["e1", "2025-01-02 10:00:00", "🛒 Продукты", "250.5", "", "Личная", "молоко"], user_id=7)
+    assert (expense.id, expense.amount, expense.user_id, expense.comment) == ("e1", 250.5, "7", "молоко")
+
+    expense = FAMILY_LAYOUT.decode(["e2", "2025-01-02 10:00:00", "👶 Дети", 100, "", "Семейная", 8], "family-abc123")
+    assert (expense.user_id, expense.family_id, expense.comment) == ("8", "family-abc123", "")
+
+    # Старый лист, где колонки переставили вручную
+    layout = SheetLayout(["Дата", "Сумма", "Категория", "ID", "Комментарий"])
+    assert layout.last_column == "E" and layout.column("date") == "A" and layout.column_number("comment") == 5
+    expense = layout.decode(["2025-01-03 09:00:00", 40, "🏠 Дом", "e3"], user_id=7)
+    assert (expense.id, expense.category, expense.comment) == ("e3", "🏠 Дом", "")
+
+    assert PERSONAL_LAYOUT.decode(["e4", "2025-01-02 10:00:00", "🛒 Продукты", ""]) is None
+    assert PERSONAL_LAYOUT.decode([]) is None
+    assert not SheetLayout(["family_id", "user_id"]).complete
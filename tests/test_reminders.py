@@ -0,0 +1,39 @@
+from datetime import datetime
+import pytz
+from reminders import ReminderScheduler
+
+
+def test_due_times_respect_timezone_and_preferences(tmp_path):
+    scheduler = ReminderScheduler({}, path=str(tmp_path / "reminders.json"), spread=0)
+    after = pytz.utc.localize(datetime(2024, 3, 1, 12, 0)).timestamp()  # Пятница
+
+    scheduler.set_timezone(1, "Asia/Yekaterinburg")
+    scheduler.set_daily_time(1, "20:30")
+    due = datetime.fromtimestamp(scheduler.next_due("daily", 1, after), pytz.timezone("Asia/Yekaterinburg"))
+    assert (due.day, due.hour, due.minute) == (1, 20, 30)
+
+    due = datetime.fromtimestamp(scheduler.next_due("weekly", 2, after), pytz.timezone("Europe/Moscow"))
+    assert (due.weekday(), due.hour) == (6, 11)
+
+    scheduler.set_daily_time(1, None)
+    assert scheduler.next_due("daily", 1, after) is None
+
+
+def test_pop_due_reschedules_and_persists(tmp_path):
+    path = str(tmp_path / "reminders.json")
+    scheduler = ReminderScheduler({}, path=path, spread=0)
+    scheduler.ensure_user(1)
+    scheduler.ensure_user(2)
+    scheduler.set_daily_time(2, "10:00")
+    assert len(scheduler) == 4
+
+    first_due = scheduler._due[("daily", "1")]
+    batch = scheduler.pop_due(first_due)
+    assert 1 in batch["daily"]
+    assert scheduler._due[("daily", "1")] == first_due + 24 * 3600
+
+    scheduler.save()
+    restored = ReminderScheduler({}, path=path, spread=0)
+    restored.load()
+    assert restored._due == scheduler._due
+    assert restored.daily_time_of(2) == "10:00"
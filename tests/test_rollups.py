@@ -0,0 +1,58 @@
+import datetime
+from rollups import RollupStore
+
+
+def test_rollup_totals_follow_writes(tmp_path):
+    store = RollupStore(str(tmp_path / "rollups.json"))
+    store.replace("123", [
+        ("2025-01-01", "🛒 Продукты", 100.0),
+        ("2025-01-05", "🛒 Продукты", 50.0),
+        ("2025-02-01", "👶 Дети", 10.0),
+    ])
+    store.add("123", "2025-01-06", "👶 Дети", 20.0)
+    store.remove("123", "2025-01-01", "🛒 Продукты", 100.0)
+    store.add("456", "2025-01-06", "👶 Дети", 20.0)  # Несобранный лист не трогаем
+
+    totals = store.totals("123", datetime.date(2025, 1, 1), datetime.date(2025, 1, 31))
+    assert dict(totals) == {"🛒 Продукты": 50.0, "👶 Дети": 20.0}
+    assert not store.has("456")
+
+    store.save()
+    restored = RollupStore(str(tmp_path / "rollups.json"))
+    restored.load()
+    assert restored.totals("123", datetime.date(2025, 2, 1), datetime.date(2025, 2, 28)) == {"👶 Дети": 10.0}
+
+
+def test_rollups_rebuilt_after_unclean_shutdown(tmp_path):
+    path = str(tmp_path / "rollups.json")
+    store = RollupStore(path)
+    store.load()
+    store.replace("123", [("2025-01-01", "🛒 Продукты", 100.0)])
+    store.close()
+
+    # Штатная остановка: снимку верим
+    restored = RollupStore(path)
+    restored.load()
+    assert restored.has("123")
+    restored.add("123", "2025-01-02", "🛒 Продукты", 5.0)
+    restored.save()  # Периодическое сохранение, затем падение без close()
+
+    crashed = RollupStore(path)
+    crashed.load()
+    assert not crashed.has("123")
+
+
+def test_changes_during_build_applied_after_replace(tmp_path):
+    store = RollupStore(str(tmp_path / "rollups.json"))
+    store.begin_build("123")
+    store.add("123", "2025-01-02", "👶 Дети", 20.0)
+    store.replace("123", [("2025-01-01", "🛒 Продукты", 100.0)])
+    store.remove("123", "2025-01-01", "🛒 Продукты", 100.0)
+
+    totals = store.totals("123", datetime.date(2025, 1, 1), datetime.date(2025, 1, 31))
+    assert dict(totals) == {"👶 Дети": 20.0}
+
+    store.begin_build("456")
+    store.cancel_build("456")
+    store.add("456", "2025-01-02", "👶 Дети", 20.0)
+    assert not store.has("456")
@@ -0,0 +1,99 @@
+import asyncio
+import queue as queue_module
+import time
+import pytest
+from sharding import ShardSupervisor, UserSerialFeeder, shard_of, update_user_id
+
+
+def test_update_user_id():
+    assert update_user_id({"update_id": 1, "message": {"from": {"id": 42}, "chat": {"id": 7}}}) == 42
+    assert update_user_id({"update_id": 2, "callback_query": {"from": {"id": 43}}}) == 43
+    assert update_user_id({"update_id": 3, "channel_post": {"chat": {"id": -100}}}) == -100
+    assert update_user_id({"update_id": 4}) is None
+    assert shard_of(42, 4) == shard_of("42", 4) == 2
+    assert shard_of(None, 4) == 0
+
+
+@pytest.mark.asyncio
+async def test_feeder_keeps_order_per_user():
+    log = []
+
+    async def feed(update):
+        user_id, step = update["user"], update["step"]
+        log.append((user_id, step, "start"))
+        # Первый апдейт первого пользователя обрабатывается дольше остальных
+        await asyncio.sleep(0.05 if (user_id, step) == (1, 0) else 0)
+        log.append((user_id, step, "end"))
+
+    feeder = UserSerialFeeder(feed)
+    for step in range(3):
+        for user_id in (1, 2):
+            feeder.submit(user_id, {"user": user_id, "step": step})
+    await feeder.drain()
+
+    assert len(feeder) == 0
+    assert [entry for entry in log if entry[0] == 1] == [(1, step, phase) for step in range(3) for phase in ("start", "end")]
+    # Второй пользователь не ждет медленный апдейт первого
+    assert log.index((2, 2, "end")) < log.index((1, 0, "end"))
+
+
+@pytest.mark.asyncio
+async def test_feeder_survives_handler_errors():
+    handled = []
+
+    async def feed(update):
+        if update["step"] == 0:
+            raise RuntimeError("boom")
+        handled.append(update["step"])
+
+    feeder = UserSerialFeeder(feed)
+    feeder.submit(1, {"update_id": 1, "step": 0})
+    feeder.submit(1, {"update_id": 2, "step": 1})
+    await feeder.drain()
+    assert handled == [1]
+
+
+# Рабочий для теста перезапуска: первый запуск "зависает" в queue.get без heartbeat,
+# следующие записывают полученные апдейты в файл
+def hanging_worker(index, workers, queue, heartbeats):
+    import os
+    marker = os.path.join(os.environ["SHARD_TEST_DIR"], "hung")
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        queue.get()
+        return
+    while True:
+        heartbeats[index] = time.time()
+        try:
+            update = queue.get(timeout=0.1)
+        except queue_module.Empty:
+            continue
+        if update is None:
+            return
+        with open(os.path.join(os.environ["SHARD_TEST_DIR"], "received"), "a") as f:
+            f.write(f"{update['update_id']}\n")
+
+
+@pytest.mark.asyncio
+async def test_restarted_worker_receives_updates(tmp_path, monkeypatch):
+    monkeypatch.setenv("SHARD_TEST_DIR", str(tmp_path))
+    supervisor = ShardSupervisor(hanging_worker, workers=1, heartbeat_timeout=0.5)
+    supervisor.start()
+    try:
+        await wait_until(lambda: (tmp_path / "hung").exists())
+        await asyncio.sleep(0.6)
+        supervisor.check()  # Heartbeat устарел: рабочий убит и запущен заново
+        assert supervisor.restarts == [1]
+
+        await supervisor.route({"update_id": 7, "message": {"from": {"id": 1}}})
+        await wait_until(lambda: (tmp_path / "received").exists())
+        assert (tmp_path / "received").read_text() == "7\n"
+    finally:
+        supervisor.stop(timeout=5)
+
+
+async def wait_until(predicate, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.05)
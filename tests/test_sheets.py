@@ -1,17 +1,232 @@
-from unittest.mock import MagicMock, patch
+import asyncio
+import re
+from datetime import datetime
+from unittest.mock import MagicMock
 import gspread
-from bot import get_user_sheet
+import pytest
+from repository import SheetsRepository
 
-@patch('gspread.authorize')
-def test_sheet_creation(mock_auth):
+def test_sheet_creation():
     mock_spreadsheet = MagicMock()
-    mock_auth.return_value.open_by_url.return_value = mock_spreadsheet
     
     # Эмулируем отсутствие листа
     mock_spreadsheet.worksheet.side_effect = gspread.WorksheetNotFound
     
-    get_user_sheet(123)
+    SheetsRepository(mock_spreadsheet).get_user_sheet(123)
     
     mock_spreadsheet.add_worksheet.assert_called_once_with(
         title="123", rows=100, cols=11
     )
+
+class ColumnSheet:
+    # Лист с одной колонкой дат (B) поверх списка; считает запросы к API
+    def __init__(self, dates, row_count):
+        self.rows = [["ID", "Дата"]] + [[f"id-{i}", d] for i, d in enumerate(dates)]
+        self.row_count = row_count
+        self.calls = 0
+
+    def _value(self, row):
+        return [[self.rows[row - 1][1]]] if row <= len(self.rows) else []
+
+    def get(self, range_name, **kwargs):
+        self.calls += 1
+        start, _, end = range_name.partition(":")
+        first = int(start[1:])
+        last = int(end[1:]) if end else first
+        if start[0] == "B":
+            return [v for row in range(first, last + 1) for v in self._value(row)]
+        return [self.rows[row - 1] for row in range(first, min(last, len(self.rows)) + 1)]
+
+    def batch_get(self, ranges, **kwargs):
+        self.calls += 1
+        return [self._value(int(r[1:])) for r in ranges]
+
+def test_read_date_range_bisects_instead_of_full_download():
+    from sheets import read_date_range
+    dates = [f"2024-{m:02d}-{d:02d} 12:00:00" for m in range(1, 13) for d in range(1, 29)]
+    sheet = ColumnSheet(dates, row_count=100)  # row_count отстает от реального числа строк
+    
+    first, rows = read_date_range(sheet, "2024-12-01 00:00:00", "2024-12-07 23:59:59")
+    
+    assert [row[1] for row in rows] == [f"2024-12-{d:02d} 12:00:00" for d in range(1, 8)]
+    assert first == len(dates) - 28 + 2
+    assert sheet.calls < 15
+
+def test_archive_titles_belong_to_their_sheet():
+    from repository import archive_sheet_title, expense_sheet_owner, is_expense_sheet
+    assert archive_sheet_title("123", 2025) == "123-2025"
+    assert expense_sheet_owner("123-2025") == "123"
+    assert expense_sheet_owner("family-family-aB3xYz-2024") == "family-family-aB3xYz"
+    assert expense_sheet_owner("budgets") is None
+    assert is_expense_sheet("family-family-aB3xYz")
+    assert not is_expense_sheet("123-2025")
+
+class ListSheet:
+    # Лист поверх списка строк (первая -- заголовок) с диапазонами вида "B5" и "A2:G9"
+    def __init__(self, title, header=None):
+        self.title = title
+        self.rows = [list(header)] if header else []
+        self.fail_delete = False
+
+    @property
+    def row_count(self):
+        return max(100, len(self.rows))
+
+    def _range(self, range_name):
+        match = re.fullmatch(r"([A-Z])(\d+)(?::([A-Z])(\d+))?", range_name)
+        first_col, first_row = ord(match.group(1)) - ord("A"), int(match.group(2))
+        last_col = ord(match.group(3)) - ord("A") if match.group(3) else first_col
+        last_row = int(match.group(4)) if match.group(4) else first_row
+        values = [row[first_col:last_col + 1] for row in self.rows[first_row - 1:last_row]]
+        while values and not any(values[-1]):
+            values.pop()
+        return values
+
+    def get(self, range_name, **kwargs):
+        return self._range(range_name)
+
+    def batch_get(self, ranges, **kwargs):
+        return [self._range(range_name) for range_name in ranges]
+
+    def row_values(self, row):
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values])
+
+    def append_rows(self, rows, **kwargs):
+        first = len(self.rows) + 1
+        self.rows += [list(values) for values in rows]
+        return {"updates": {"updatedRange": f"'{self.title}'!A{first}:G{len(self.rows)}"}}
+
+    def delete_rows(self, start, end=None):
+        if self.fail_delete:
+            self.fail_delete = False
+            raise RuntimeError("обрыв между дописыванием в архив и удалением")
+        del self.rows[start - 1:(end or start)]
+
+class ListSpreadsheet:
+    def __init__(self, *sheets):
+        self.sheets = {sheet.title: sheet for sheet in sheets}
+
+    def worksheets(self):
+        return list(self.sheets.values())
+
+    def worksheet(self, title):
+        if title not in self.sheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        sheet = self.sheets[title] = ListSheet(title)
+        return sheet
+
+@pytest.mark.asyncio
+async def test_archive_moves_old_rows_without_duplicates(tmp_path):
+    from records import PERSONAL_HEADER
+    sheet = ListSheet("123", PERSONAL_HEADER)
+    recent = f"{datetime.now():%Y-%m-%d} 10:00:00"
+    for expense_id, date in [("e1", "2023-12-30 10:00:00"), ("e2", "2024-01-05 10:00:00"),
+                             ("e3", "2024-01-06 10:00:00"), ("e4", recent), ("e5", recent)]:
+        sheet.rows.append([expense_id, date, "🛒 Продукты", 10.0, "", "Личная", ""])
+    spreadsheet = ListSpreadsheet(sheet)
+    repo = SheetsRepository(spreadsheet, journal_path=str(tmp_path / "journal.jsonl"),
+                            rollups_path=str(tmp_path / "rollups.json"), archive_after_days=30, archive_batch=2)
+    repo.registry.refresh()
+
+    # Первая пачка дописана в архивы, но удалить ее из листа не удалось
+    sheet.fail_delete = True
+    assert await repo.archive_old_rows() == 0
+    assert [row[0] for row in sheet.rows[1:]] == ["e1", "e2", "e3", "e4", "e5"]
+
+    # Повторный проход узнает уже перенесенные строки по ID и не дублирует их
+    assert await repo.archive_old_rows() == 3
+    assert [row[0] for row in spreadsheet.sheets["123-2023"].rows] == ["ID", "e1"]
+    assert [row[0] for row in spreadsheet.sheets["123-2024"].rows] == ["ID", "e2", "e3"]
+    assert [row[0] for row in sheet.rows[1:]] == ["e4", "e5"]
+    assert repo.registry.last_row(sheet, "B") == 3
+    repo.sheets.shutdown()
+
+def test_batch_get_values_reads_all_ranges_in_one_request():
+    from sheets import batch_get_values
+    spreadsheet = MagicMock()
+    spreadsheet.values_batch_get.return_value = {"valueRanges": [{"values": [["ID"], ["p1"]]}, {"range": "'7'!A5:H6"}]}
+
+    values = batch_get_values(spreadsheet, [("family-family-x", None), ("7", "A5:H6")])
+
+    spreadsheet.values_batch_get.assert_called_once()
+    assert spreadsheet.values_batch_get.call_args.args[0] == ["'family-family-x'", "'7'!A5:H6"]
+    assert values == [[["ID"], ["p1"]], []]
+    assert batch_get_values(spreadsheet, []) == []
+
+def test_quota_retries_rate_limited_requests_with_backoff():
+    from sheets import QuotaGovernor
+    responses = [MagicMock(status_code=429, headers={}), MagicMock(status_code=503, headers={}), "ok"]
+    client = MagicMock()
+
+    def request(*args, **kwargs):
+        response = responses.pop(0)
+        if response == "ok":
+            return response
+        raise gspread.exceptions.APIError(response)
+
+    client.request = request
+    quota = QuotaGovernor(base_delay=0)
+    quota.install(client)
+    quota.install(client)  # Повторный start() не оборачивает клиента дважды
+
+    assert client.request("get", "https://sheets.googleapis.com/v4/spreadsheets/test") == "ok"
+    usage = quota.usage()
+    assert (usage["rate_limited"], usage["server_errors"], usage["retries"], usage["requests"]) == (1, 1, 2, 3)
+
+@pytest.mark.asyncio
+async def test_quota_lets_interactive_calls_ahead_of_background():
+    from sheets import BACKGROUND, INTERACTIVE, QuotaGovernor
+    quota = QuotaGovernor(requests_per_minute=1200, burst=1)  # Токен раз в 50 мс
+    await quota.acquire(INTERACTIVE)  # Ведро пусто
+    order = []
+
+    async def call(name, priority):
+        await quota.acquire(priority)
+        order.append(name)
+
+    background = asyncio.create_task(call("background", BACKGROUND))
+    await asyncio.sleep(0.01)
+    await asyncio.gather(call("interactive", INTERACTIVE), background)
+
+    assert order == ["interactive", "background"]
+    assert quota.usage()["delayed"] == {"interactive": 1, "background": 1}
+
+# Лист с заданным ответом get_all_values: ошибкой API или значениями
+class FakeWorksheet(gspread.Worksheet):
+    def __init__(self, title, status=None):
+        self._properties = {"title": title}
+        self.status = status
+
+    def get_all_values(self, **kwargs):
+        if self.status:
+            raise gspread.exceptions.APIError(MagicMock(status_code=self.status))
+        return [["ID"]]
+
+@pytest.mark.asyncio
+async def test_stale_cached_worksheet_is_reloaded_once():
+    from sheets import SheetsExecutor, WorksheetRegistry
+    stale, fresh = FakeWorksheet("7", status=400), FakeWorksheet("7")
+    spreadsheet = MagicMock()
+    spreadsheet.worksheets.return_value = [stale]
+    spreadsheet.worksheet.return_value = fresh
+    registry = WorksheetRegistry(spreadsheet)
+    registry.refresh()
+    executor = SheetsExecutor(max_workers=1, registry=registry)
+
+    # Лист пересоздан вручную: дескриптор из кэша получает 400, вызов повторяется с новым
+    assert await executor.call(stale.get_all_values) == [["ID"]]
+    assert registry.get("7") is fresh
+    spreadsheet.worksheet.assert_called_once_with("7")
+
+    # Повтор только один: ошибка и у нового дескриптора уходит вызывающему
+    fresh.status = 404
+    with pytest.raises(gspread.exceptions.APIError):
+        await executor.call(fresh.get_all_values)
+    assert spreadsheet.worksheet.call_count == 2
+    executor.shutdown()
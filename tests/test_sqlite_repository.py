@@ -0,0 +1,35 @@
+import datetime
+import pytest
+from repository import Expense
+from sqlite_repository import SQLiteRepository
+
+
+@pytest.mark.asyncio
+async def test_expenses_budgets_and_families(tmp_path):
+    repo = SQLiteRepository(str(tmp_path / "bot.db"))
+    await repo.start()
+
+    await repo.create_family("family-abc123", 1)
+    await repo.add_expense(Expense("e1", "2025-01-02 10:00:00", "🛒 Продукты", 100.0, "1"))
+    await repo.add_expense(Expense("e2", "2025-01-03 10:00:00", "🛒 Продукты", 50.0, "2", "family-abc123"))
+    await repo.add_expense(Expense("e3", "2024-12-31 10:00:00", "👶 Дети", 10.0, "1"))
+    await repo.set_budget(1, "🛒 Продукты", 1000)
+    await repo.set_budget(1, "🛒 Продукты", 2000)
+
+    totals = await repo.category_totals(1, "stats_all", datetime.date(2025, 1, 1), datetime.date(2025, 1, 31))
+    assert dict(totals) == {"🛒 Продукты": 150.0}
+    frame = await repo.expense_frame(1, "stats_all")
+    assert frame.category_totals(datetime.date(2024, 10, 1), datetime.date(2025, 3, 31)) == {"🛒 Продукты": 150.0, "👶 Дети": 10.0}
+    expenses, cursor = await repo.last_expenses(1, limit=2)
+    assert [e.id for e in expenses] == ["e2", "e1"]
+    expenses, cursor = await repo.last_expenses(1, limit=2, cursor=cursor)
+    assert [e.id for e in expenses] == ["e3"] and cursor is None
+    assert await repo.get_budgets(1) == {"🛒 Продукты": 2000.0}
+
+    await repo.ensure_user(1)
+    await repo.ensure_user(4)
+    assert await repo.last_expense_dates() == {"1": "2025-01-02 10:00:00", "4": ""}
+
+    assert await repo.delete_expense(1, "e2") == "family"
+    assert await repo.delete_expense(3, "e1") is None
+    await repo.close()
@@ -1,29 +1,35 @@
 import pytest
-from aiogram import Dispatcher, types
-from aiogram.fsm.storage.memory import MemoryStorage
-from unittest.mock import MagicMock, AsyncMock, patch
+from aiogram import types
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import SendMessage
 from bot import BudgetStates
 import datetime
 
 @pytest.mark.asyncio
-async def test_budget_flow():
-    dispatcher = Dispatcher(storage=MemoryStorage())
+async def test_budget_flow(mock_bot, dispatcher, repo):
+    user = types.User(id=789, is_bot=False, first_name="Test")
+    chat = types.Chat(id=789, type="private")
     message = types.Message(
         message_id=456,
         date=datetime.datetime.now(),
-        chat=types.Chat(id=789, type="private"),
-        from_user=types.User(id=789, is_bot=False, first_name="Test"),
+        chat=chat,
+        from_user=user,
         text="Управление бюджетами"
     )
     
     fake_update = types.Update(update_id=456, message=message)
     
-    mock_bot = MagicMock()
     await dispatcher.feed_update(mock_bot, fake_update)
     
     # Проверяем отправку клавиатуры
-    mock_bot.send_message.assert_called_with(
-        chat_id=789,
-        text="Управление бюджетами:",
-        reply_markup=...
-    )
+    method = mock_bot.call_args.args[0]
+    assert isinstance(method, SendMessage)
+    assert method.text == "Управление бюджетами:"
+    assert [row[0].callback_data for row in method.reply_markup.inline_keyboard] == ["set_budget", "show_budgets"]
+
+    # Выбор "Установить бюджет" переводит в выбор категории
+    query = types.CallbackQuery(id="1", from_user=user, chat_instance="1", message=message, data="set_budget")
+    await dispatcher.feed_update(mock_bot, types.Update(update_id=457, callback_query=query))
+
+    key = StorageKey(bot_id=mock_bot.id, chat_id=789, user_id=789)
+    assert await dispatcher.storage.get_state(key) == BudgetStates.SELECT_CATEGORY.state
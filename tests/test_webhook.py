@@ -0,0 +1,28 @@
+import pytest
+import bot
+from aiohttp.test_utils import TestClient, TestServer
+from webhook import create_webhook_app
+
+
+class WebhookConfig:
+    WEBHOOK_SECRET = "secret"
+    WEBHOOK_PATH = "/webhook"
+
+
+@pytest.mark.asyncio
+async def test_webhook_checks_secret_and_reports_health(mock_bot, dispatcher):
+    ready = {"value": False}
+    app = create_webhook_app(dispatcher, bot.bot, WebhookConfig, lambda: (ready["value"], {"pending_writes": 0}))
+
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/health")
+        assert response.status == 503
+        assert (await response.json())["status"] == "starting"
+
+        ready["value"] = True
+        response = await client.get("/health")
+        assert response.status == 200
+        assert await response.json() == {"status": "ok", "pending_writes": 0}
+
+        response = await client.post("/webhook", json={"update_id": 1})
+        assert response.status == 401
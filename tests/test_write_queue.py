@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from write_queue import AppendQueue
+
+
+@pytest.mark.asyncio
+async def test_rows_are_batched_per_sheet(tmp_path):
+    sent = []
+
+    async def flush_func(title, rows):
+        sent.append((title, rows))
+
+    queue = AppendQueue(flush_func, journal_path=str(tmp_path / "journal.jsonl"))
+    queue.put("123", ["id-1", "2025-01-01 10:00:00", "🛒 Продукты", 100.0])
+    queue.put("123", ["id-2", "2025-01-01 11:00:00", "🛒 Продукты", 50.0])
+    queue.put("family-family-abc123", ["id-3", "2025-01-01 12:00:00", "👶 Дети", 10.0])
+    await queue.flush()
+
+    assert len(sent) == 2
+    assert [row[0] for row in sent[0][1]] == ["id-1", "id-2"]
+    assert len(queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_pending_rows_survive_restart(tmp_path):
+    journal = str(tmp_path / "journal.jsonl")
+
+    async def failing_flush(title, rows):
+        raise RuntimeError("quota")
+
+    queue = AppendQueue(failing_flush, journal_path=journal)
+    queue.put("123", ["id-1", "2025-01-01 10:00:00", "🛒 Продукты", 100.0])
+    queue.put("123", ["id-2", "2025-01-01 11:00:00", "🛒 Продукты", 50.0])
+    assert queue.discard("id-2")[0] == "123"
+    await queue.flush()
+
+    restored = AppendQueue(failing_flush, journal_path=journal)
+    assert restored.replay() == 1
+    assert restored.pending("123") == [["id-1", "2025-01-01 10:00:00", "🛒 Продукты", 100.0]]
+
+
+@pytest.mark.asyncio
+async def test_discard_waits_for_batch_in_flight(tmp_path):
+    started, release = asyncio.Event(), asyncio.Event()
+    sent = []
+
+    async def slow_flush(title, rows):
+        started.set()
+        await release.wait()
+        sent.extend(rows)
+
+    queue = AppendQueue(slow_flush, journal_path=str(tmp_path / "journal.jsonl"))
+    queue.put("123", ["id-1", "2025-01-01 10:00:00", "🛒 Продукты", 100.0])
+    flush = asyncio.create_task(queue.flush())
+    await started.wait()
+
+    async def discard():
+        async with queue.hold():
+            return queue.discard("id-1")
+    discarding = asyncio.create_task(discard())
+    await asyncio.sleep(0)
+    release.set()
+
+    # Строка уже ушла в лист: из очереди ее не удалить, удалять нужно из листа
+    assert await discarding is None
+    await flush
+    assert [row[0] for row in sent] == ["id-1"]
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import signal
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+
+# Обработчик вебхука, который при остановке сервера дожидается апдейтов,
+# еще обрабатываемых в фоне, и только потом закрывает сессию бота
+class DrainingRequestHandler(SimpleRequestHandler):
+    def __init__(self, *args, drain_timeout: float = 30.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.drain_timeout = drain_timeout
+
+    async def close(self):
+        tasks = set(getattr(self, "_background_feed_update_tasks", ()))
+        if tasks:
+            logger.info(f"Ожидаем завершения обработки апдейтов: {len(tasks)}")
+            _, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+            if pending:
+                logger.warning(f"Не дождались обработки апдейтов: {len(pending)}")
+        await super().close()
+
+
+# aiohttp-приложение: POST на путь вебхука (с проверкой секретного токена) и GET /health.
+# health -- функция без аргументов, возвращающая (готов ли бот, словарь с подробностями)
+def create_webhook_app(dp, bot, settings, health) -> web.Application:
+    app = web.Application()
+    handler = DrainingRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=getattr(settings, "WEBHOOK_SECRET", None),
+        drain_timeout=getattr(settings, "WEBHOOK_DRAIN_TIMEOUT", 30.0)
+    )
+    handler.register(app, path=getattr(settings, "WEBHOOK_PATH", "/webhook"))
+
+    async def health_check(request):
+        ready, details = health()
+        return web.json_response({"status": "ok" if ready else "starting", **details}, status=200 if ready else 503)
+
+    app.router.add_get("/health", health_check)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+# Обслуживание aiohttp-приложения до SIGTERM/SIGINT. При остановке сервер перестает
+# принимать запросы, дожидается начатых обработчиков и вызывает on_shutdown приложения
+async def serve_webhook(app: web.Application, bot, settings, allowed_updates=None):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    host = getattr(settings, "WEBHOOK_HOST", "0.0.0.0")
+    port = getattr(settings, "WEBHOOK_PORT", 8080)
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"Вебхук слушает {host}:{port}")
+
+    # Публичный адрес регистрируем в Telegram, если он задан (иначе вебхук настроен снаружи)
+    url = getattr(settings, "WEBHOOK_URL", None)
+    if url:
+        await bot.set_webhook(
+            url,
+            secret_token=getattr(settings, "WEBHOOK_SECRET", None),
+            allowed_updates=allowed_updates
+        )
+
+    try:
+        await wait_for_stop_signal()
+    finally:
+        logger.info("Останавливаем вебхук")
+        await runner.cleanup()
+
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def run_webhook(dp, bot, settings, health):
+    app = create_webhook_app(dp, bot, settings, health)
+    await serve_webhook(app, bot, settings, dp.resolve_used_update_types())
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+# Очередь отложенной записи: строки копятся по листам и уходят одним append_rows
+# по таймеру или при достижении размера пачки. Каждая строка сначала пишется
+# в локальный журнал, поэтому после падения процесса неотправленные строки
+# восстанавливаются при старте (доставка "как минимум один раз"). Запись в журнал
+# доходит до ОС сразу (переживает падение процесса), а fsync на диск делается
+# в потоке раз в тик очереди, а не на каждую строку в цикле событий.
+class AppendQueue:
+    def __init__(self, flush_func, journal_path: str = "pending_rows.jsonl",
+                 flush_interval: float = 2.0, max_batch: int = 50):
+        self._flush_func = flush_func  # async (title, rows) -> None
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = defaultdict(list)  # title -> [(seq, row)]
+        self._seq = 0
+        self._journal = None
+        self._unsynced = False
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self):
+        return sum(len(items) for items in self._pending.values())
+
+    def _write_journal(self, entry: dict):
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        self._unsynced = True
+
+    async def _sync(self):
+        # Вызывается под _flush_lock, чтобы _compact не закрыл журнал во время fsync
+        if self._unsynced and self._journal is not None:
+            self._unsynced = False
+            await asyncio.get_running_loop().run_in_executor(None, os.fsync, self._journal.fileno())
+
+    def replay(self):
+        # Восстанавливаем строки, которые не успели уйти в таблицу до остановки
+        if not os.path.exists(self.journal_path):
+            return 0
+
+        added = {}
+        with open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Недописанная строка при аварийной остановке
+                if entry["op"] == "add":
+                    added[entry["seq"]] = (entry["title"], entry["row"])
+                elif entry["op"] == "done":
+                    for seq in entry["seqs"]:
+                        added.pop(seq, None)
+
+        for seq, (title, row) in sorted(added.items()):
+            self._pending[title].append((seq, row))
+            self._seq = max(self._seq, seq)
+        self._compact()
+
+        if added:
+            logger.info(f"Из журнала восстановлено строк: {len(added)}")
+            self._wakeup.set()
+        return len(added)
+
+    def _compact(self):
+        # Переписываем журнал, оставляя только неотправленные строки
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for title, items in self._pending.items():
+                for seq, row in items:
+                    f.write(json.dumps({"op": "add", "seq": seq, "title": title, "row": row}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.journal_path)
+
+    def put(self, title: str, row: list):
+        self._seq += 1
+        self._write_journal({"op": "add", "seq": self._seq, "title": title, "row": row})
+        self._pending[title].append((self._seq, row))
+        if len(self._pending[title]) >= self.max_batch:
+            self._wakeup.set()
+
+    def __contains__(self, expense_id: str):
+        return any(row and row[0] == expense_id for items in self._pending.values() for _, row in items)
+
+    def pending(self, title: str):
+        return [row for _, row in self._pending.get(title, [])]
+
+    def discard(self, expense_id: str):
+        # Удаляем еще не отправленную строку (ID траты в первой колонке),
+        # возвращаем (название листа, строка) или None
+        for title, items in self._pending.items():
+            for seq, row in items:
+                if row and row[0] == expense_id:
+                    items.remove((seq, row))
+                    self._write_journal({"op": "done", "seqs": [seq]})
+                    return title, row
+        return None
+
+    def hold(self):
+        # Блокирует сброс очереди: пока удерживается, строки не переходят из очереди в лист
+        return self._flush_lock
+
+    async def flush(self):
+        async with self._flush_lock:
+            await self._sync()  # Строки на диске до отправки
+            for title in list(self._pending):
+                batch = list(self._pending[title])
+                if not batch:
+                    continue
+                try:
+                    await self._flush_func(title, [row for _, row in batch])
+                except Exception as e:
+                    logger.error(f"Ошибка записи пачки в лист {title}: {e}")
+                    continue  # Повторим на следующем тике
+
+                sent = {seq for seq, _ in batch}
+                self._pending[title] = [item for item in self._pending[title] if item[0] not in sent]
+                if not self._pending[title]:
+                    del self._pending[title]
+                self._write_journal({"op": "done", "seqs": sorted(sent)})
+
+            if not self._pending:
+                self._compact()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._pending:
+                await self.flush()
+            else:
+                async with self._flush_lock:
+                    await self._sync()